@@ -1,14 +1,17 @@
 # StudyMate - Modern AI Academic Assistant
 import streamlit as st
-import os
-import time
+import uuid
 from datetime import datetime
 from backend import (
-    get_all_pdf_text,
-    get_txt_text,
-    get_text_chunks,
-    get_vector_store_from_texts,
-    process_question
+    UploadedDocument,
+    iter_vector_store_for_files,
+    list_indexed_documents,
+    get_index_cache_stats,
+    get_answer_cache_stats,
+    get_last_request_timings,
+    get_store_memory,
+    track_session,
+    stream_question
 )
 
 # Custom CSS for modern UI
@@ -339,17 +342,9 @@ def load_custom_css():
     </style>
     """, unsafe_allow_html=True)
 
-def save_uploaded_files(uploaded_files):
-    temp_dir = "temp_uploaded_files"
-    if not os.path.exists(temp_dir):
-        os.makedirs(temp_dir)
-    saved_paths = []
-    for uploaded_file in uploaded_files:
-        file_path = os.path.join(temp_dir, uploaded_file.name)
-        with open(file_path, "wb") as f:
-            f.write(uploaded_file.getbuffer())
-        saved_paths.append(file_path)
-    return saved_paths
+def read_uploaded_files(uploaded_files):
+    """Wrap uploads for in-memory ingestion; nothing is written to disk unless a tool needs a file path."""
+    return [UploadedDocument(uploaded_file.name, uploaded_file.getvalue()) for uploaded_file in uploaded_files]
 
 # Helper functions for UI components
 def render_chat_message(message, is_user=True):
@@ -381,6 +376,15 @@ def render_expandable_content(content, max_length=300):
 
     return short_content
 
+def format_progress(event):
+    """Describe an ingestion progress event for the status line"""
+    if event["stage"] == "done":
+        return "⚡ Loaded previously processed materials!" if event.get("cached") else "✅ Processing complete!"
+    status = f"📖 {event['pages_done']}/{event['pages_total']} pages read · 🧠 {event['chunks_embedded']} chunks embedded"
+    if event["eta_seconds"] is not None:
+        status += f" · ⏱️ ~{int(event['eta_seconds']) + 1}s left"
+    return status
+
 def render_loading_animation(text="Processing"):
     """Render a loading animation"""
     return st.markdown(f"""
@@ -405,8 +409,15 @@ def main():
         st.session_state.vector_store = None
     if "messages" not in st.session_state:
         st.session_state.messages = []
+    if "scope_doc_ids" not in st.session_state:
+        st.session_state.scope_doc_ids = []
     if "processing" not in st.session_state:
         st.session_state.processing = False
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex[:12]
+    if "last_timings" not in st.session_state:
+        st.session_state.last_timings = {}
+    track_session(st.session_state.session_id, st.session_state.vector_store)
 
     # Sidebar with modern design
     with st.sidebar:
@@ -460,40 +471,22 @@ def main():
                 status_text = st.empty()
 
                 try:
-                    status_text.markdown("📂 Saving uploaded files...")
-                    progress_bar.progress(20)
-                    time.sleep(0.5)
-
-                    saved_file_paths = save_uploaded_files(uploaded_files)
-                    pdf_paths = [p for p in saved_file_paths if p.lower().endswith(".pdf")]
-                    txt_paths = [p for p in saved_file_paths if p.lower().endswith(".txt")]
-
-                    status_text.markdown("📖 Extracting text from documents...")
-                    progress_bar.progress(40)
-                    time.sleep(0.5)
-
-                    raw_text = ""
-                    if pdf_paths:
-                        raw_text += get_all_pdf_text(pdf_paths)
-                    if txt_paths:
-                        raw_text += get_txt_text(txt_paths)
+                    status_text.markdown("📂 Reading uploaded files...")
 
-                    if raw_text:
-                        status_text.markdown("✂️ Creating text chunks...")
-                        progress_bar.progress(60)
-                        time.sleep(0.5)
+                    documents = read_uploaded_files(uploaded_files)
+                    pdf_paths = [d for d in documents if d.name.lower().endswith(".pdf")]
+                    txt_paths = [d for d in documents if d.name.lower().endswith(".txt")]
 
-                        text_chunks = get_text_chunks(raw_text)
+                    # Reuses the cached index for a known upload set; otherwise only new files are embedded
+                    vector_store = None
+                    for event in iter_vector_store_for_files(pdf_paths, txt_paths, st.session_state.vector_store):
+                        progress_bar.progress(int(event["fraction"] * 100))
+                        status_text.markdown(format_progress(event))
+                        if event["stage"] == "done":
+                            vector_store = event["vector_store"]
 
-                        status_text.markdown("🧠 Building knowledge base...")
-                        progress_bar.progress(80)
-                        time.sleep(0.5)
-
-                        st.session_state.vector_store = get_vector_store_from_texts(text_chunks)
-
-                        progress_bar.progress(100)
-                        status_text.markdown("✅ Processing complete!")
-                        time.sleep(1)
+                    if vector_store:
+                        st.session_state.vector_store = vector_store
 
                         st.success("🎉 Documents processed successfully! You can now ask questions about your study materials.")
                         st.session_state.messages = []
@@ -523,6 +516,39 @@ def main():
             </div>
             """, unsafe_allow_html=True)
 
+            indexed_docs = list_indexed_documents(st.session_state.vector_store)
+            with st.expander("📚 Indexed documents"):
+                for doc in indexed_docs:
+                    st.markdown(f"- **{doc['source']}** · {doc['chunks']} chunks")
+
+            # Optional scope: only search the selected documents
+            doc_names = {doc["doc_id"]: doc["source"] for doc in indexed_docs}
+            st.session_state.scope_doc_ids = st.multiselect(
+                "🎯 Limit questions to",
+                options=list(doc_names),
+                default=[d for d in st.session_state.scope_doc_ids if d in doc_names],
+                format_func=lambda doc_id: doc_names[doc_id],
+                placeholder="All documents"
+            )
+
+        cache_stats = get_index_cache_stats()
+        st.caption(f"🗄️ Index cache: {cache_stats['hits']} hits · {cache_stats['misses']} misses")
+        answer_stats = get_answer_cache_stats()
+        st.caption(f"💬 Answer cache: {answer_stats['hit_rate']:.0%} hit rate · {answer_stats['coalesced']} coalesced")
+
+        # Optional debug panel: where the time went for the last answer
+        if st.checkbox("🛠️ Show timing breakdown", key="show_timings"):
+            if st.session_state.last_timings:
+                with st.expander("⏱️ Last answer", expanded=True):
+                    for stage, seconds in sorted(st.session_state.last_timings.items(), key=lambda item: -item[1]):
+                        st.markdown(f"- **{stage}** · {seconds * 1000:.0f} ms")
+            else:
+                st.caption("Ask a question to see its timing breakdown.")
+            if st.session_state.vector_store:
+                memory = get_store_memory(st.session_state.vector_store)
+                session_mb = (memory["index_bytes"] + memory["docstore_bytes"]) / (1024 * 1024)
+                st.caption(f"🧠 This session's index: {memory['vectors']} vectors · {session_mb:.1f} MB")
+
         st.markdown("---")
 
         # Tips section with modern styling
@@ -683,8 +709,14 @@ def main():
 
         if st.session_state.vector_store:
             # Process the question and add response
-            with st.spinner("🤔 StudyMate is thinking..."):
-                response = process_question(user_question, st.session_state.vector_store)
+            # Render tokens as they arrive instead of waiting for the full answer
+            with st.chat_message("assistant"):
+                response = st.write_stream(stream_question(
+                    user_question,
+                    st.session_state.vector_store,
+                    doc_ids=st.session_state.scope_doc_ids or None
+                ))
+            st.session_state.last_timings = get_last_request_timings()
 
             # Add assistant response with timestamp
             response_timestamp = datetime.now().strftime("%H:%M")
@@ -1,27 +1,16 @@
 # StudyMate - Simple Chat Version (No Conversation History)
 import streamlit as st
-import os
-import time
 from datetime import datetime
 from backend import (
-    get_all_pdf_text,
-    get_txt_text,
-    get_text_chunks,
-    get_vector_store_from_texts,
-    process_question
+    UploadedDocument,
+    iter_vector_store_for_files,
+    list_indexed_documents,
+    stream_question
 )
 
-def save_uploaded_files(uploaded_files):
-    temp_dir = "temp_uploaded_files"
-    if not os.path.exists(temp_dir):
-        os.makedirs(temp_dir)
-    saved_paths = []
-    for uploaded_file in uploaded_files:
-        file_path = os.path.join(temp_dir, uploaded_file.name)
-        with open(file_path, "wb") as f:
-            f.write(uploaded_file.getbuffer())
-        saved_paths.append(file_path)
-    return saved_paths
+def read_uploaded_files(uploaded_files):
+    """Wrap uploads for in-memory ingestion; nothing is written to disk unless a tool needs a file path."""
+    return [UploadedDocument(uploaded_file.name, uploaded_file.getvalue()) for uploaded_file in uploaded_files]
 
 def main():
     st.set_page_config(
@@ -36,6 +25,8 @@ def main():
         st.session_state.vector_store = None
     if "messages" not in st.session_state:
         st.session_state.messages = []
+    if "scope_doc_ids" not in st.session_state:
+        st.session_state.scope_doc_ids = []
     if "dark_mode" not in st.session_state:
         st.session_state.dark_mode = False
 
@@ -63,28 +54,44 @@ def main():
 
         if st.button("🚀 Process Documents", type="primary", use_container_width=True):
             if uploaded_files:
-                with st.spinner("Processing..."):
-                    saved_file_paths = save_uploaded_files(uploaded_files)
-                    pdf_paths = [p for p in saved_file_paths if p.lower().endswith(".pdf")]
-                    txt_paths = [p for p in saved_file_paths if p.lower().endswith(".txt")]
-                    raw_text = ""
-                    if pdf_paths:
-                        raw_text += get_all_pdf_text(pdf_paths)
-                    if txt_paths:
-                        raw_text += get_txt_text(txt_paths)
-                    if raw_text:
-                        text_chunks = get_text_chunks(raw_text)
-                        st.session_state.vector_store = get_vector_store_from_texts(text_chunks)
-                        st.success("✅ Documents processed successfully!")
-                        st.session_state.messages = []
-                    else:
-                        st.error("❌ Could not extract any text from the uploaded files.")
+                progress_bar = st.progress(0, text="Processing...")
+                documents = read_uploaded_files(uploaded_files)
+                pdf_paths = [d for d in documents if d.name.lower().endswith(".pdf")]
+                txt_paths = [d for d in documents if d.name.lower().endswith(".txt")]
+                vector_store = None
+                for event in iter_vector_store_for_files(pdf_paths, txt_paths, st.session_state.vector_store):
+                    eta = f" · ~{int(event['eta_seconds']) + 1}s left" if event["eta_seconds"] else ""
+                    progress_bar.progress(
+                        int(event["fraction"] * 100),
+                        text=f"{event['pages_done']}/{event['pages_total']} pages · {event['chunks_embedded']} chunks{eta}"
+                    )
+                    if event["stage"] == "done":
+                        vector_store = event["vector_store"]
+                progress_bar.empty()
+                if vector_store:
+                    st.session_state.vector_store = vector_store
+                    st.success("✅ Documents processed successfully!")
+                    st.session_state.messages = []
+                else:
+                    st.error("❌ Could not extract any text from the uploaded files.")
             else:
                 st.warning("⚠️ Please upload at least one document before processing.")
 
         # Status indicator
         if st.session_state.vector_store:
             st.success("📚 Study materials ready!")
+            indexed_docs = list_indexed_documents(st.session_state.vector_store)
+            for doc in indexed_docs:
+                st.caption(f"📄 {doc['source']} ({doc['chunks']} chunks)")
+
+            doc_names = {doc["doc_id"]: doc["source"] for doc in indexed_docs}
+            st.session_state.scope_doc_ids = st.multiselect(
+                "🎯 Limit questions to",
+                options=list(doc_names),
+                default=[d for d in st.session_state.scope_doc_ids if d in doc_names],
+                format_func=lambda doc_id: doc_names[doc_id],
+                placeholder="All documents"
+            )
 
         st.markdown("---")
 
@@ -153,8 +160,13 @@ def main():
         })
         
         if st.session_state.vector_store:
-            with st.spinner("🤔 StudyMate is thinking..."):
-                response = process_question(user_question, st.session_state.vector_store)
+            # Render tokens as they arrive instead of waiting for the full answer
+            with st.chat_message("assistant"):
+                response = st.write_stream(stream_question(
+                    user_question,
+                    st.session_state.vector_store,
+                    doc_ids=st.session_state.scope_doc_ids or None
+                ))
             
             response_timestamp = datetime.now().strftime("%H:%M")
             st.session_state.messages.append({
@@ -1,67 +1,664 @@
 # backend.py (Reverted, Compatible Version)
 import os
-import fitz
-from PIL import Image
-import pytesseract
-from pdf2image import convert_from_path
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import FAISS
-from langchain_huggingface import HuggingFaceEmbeddings, HuggingFaceEndpoint
-from langchain.prompts import PromptTemplate
-from langchain.chains.question_answering import load_qa_chain
-from langchain.chains import LLMChain
-from langchain.schema import Document
+import asyncio
+import contextvars
+import copy
+import functools
+import hashlib
+import heapq
+import importlib
+import json
+import math
+import multiprocessing
+import pickle
+import queue
+import re
+import shutil
+import threading
+import time
+import weakref
+try:
+    import fcntl
+except ImportError:  # Windows: the embedding cache falls back to in-process locking only
+    fcntl = None
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import traceback
 import logging
-from huggingface_hub import login
 from dotenv import load_dotenv
 
+class _LazyModule:
+    """Stand-in for a heavy module that is imported on first attribute access."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+# Heavy dependencies load on first use so importing backend stays fast and works offline;
+# langchain, PIL and pdf2image are imported inside the functions that need them
+np = _LazyModule("numpy")
+sparse = _LazyModule("scipy.sparse")
+faiss = _LazyModule("faiss")
+fitz = _LazyModule("fitz")
+pytesseract = _LazyModule("pytesseract")
+
 load_dotenv()
 logging.basicConfig(level=logging.INFO, format='[%(asctime)s - %(levelname)s] %(message)s')
 HF_API_KEY = os.getenv("HUGGINGFACEHUB_API_TOKEN")
-if not HF_API_KEY:
-    logging.error("Hugging Face API key not found.")
-    exit()
 os.environ["HF_HOME"] = os.path.expanduser("~/.cache/huggingface")
-try:
-    login(token=HF_API_KEY)
-    logging.info("Hugging Face authentication successful.")
-except Exception as e:
-    logging.error(f"Hugging Face login failed. Error: {e}")
-    exit()
-
-def get_pdf_text_with_ocr(pdf_path):
-    """Extract text from PDF using PyMuPDF, fallback to OCR if needed."""
-    text = ""
+_hf_logged_in = False
+
+# Chunking / embedding parameters (also part of the index cache fingerprint)
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+
+# Persistent index cache for processed uploads
+INDEX_CACHE_DIR = os.getenv("STUDYMATE_INDEX_CACHE_DIR", os.path.join(".studymate_cache", "indexes"))
+INDEX_CACHE_MAX_MB = float(os.getenv("STUDYMATE_INDEX_CACHE_MAX_MB", "1024"))
+INDEX_CACHE_VERSION = 5
+INDEX_CACHE_SAVE_DELAY = float(os.getenv("STUDYMATE_INDEX_CACHE_SAVE_DELAY", "60"))
+
+# Process-wide registry of loaded indexes, so sessions working on the same material share one copy
+SHARED_INDEX_MAX_MB = float(os.getenv("STUDYMATE_SHARED_INDEX_MAX_MB", "2048"))
+
+# Open saved indexes read-only via mmap, so processes share pages through the OS page cache
+INDEX_MMAP = os.getenv("STUDYMATE_INDEX_MMAP", "0") == "1"
+
+# Index type selection: exact flat search for small corpora, IVF/HNSW (optionally PQ) for large ones
+INDEX_TYPE = os.getenv("STUDYMATE_INDEX_TYPE", "auto")  # auto | flat | ivf | hnsw
+ANN_INDEX_TYPE = os.getenv("STUDYMATE_ANN_INDEX_TYPE", "ivf")  # what "auto" picks for large corpora
+ANN_MIN_VECTORS = int(os.getenv("STUDYMATE_ANN_MIN_VECTORS", "20000"))
+INDEX_USE_PQ = os.getenv("STUDYMATE_INDEX_PQ", "0") == "1"
+INDEX_STORAGE = os.getenv("STUDYMATE_INDEX_STORAGE", "float32")  # float32 | fp16 | int8 (scalar-quantised vectors)
+INDEX_BINARY_PREFILTER = os.getenv("STUDYMATE_INDEX_BINARY_PREFILTER", "0") == "1"  # LSH codes, re-ranked exactly
+INDEX_PARAMS_FILE = os.getenv("STUDYMATE_INDEX_PARAMS_FILE", os.path.join(".studymate_cache", "index_params.json"))
+DEFAULT_INDEX_PARAMS = {"nlist_factor": 4, "nprobe": 16, "M": 32, "efConstruction": 80, "efSearch": 64, "pq_m": 48,
+                        "lsh_bits_per_dim": 1, "refine_k_factor": 8}
+SCALAR_QUANTIZER_TYPES = {"fp16": "QT_fp16", "int8": "QT_8bit"}
+
+# Uploads are read straight from memory; a temp file (named by content hash) is written only for tools that need a path
+UPLOAD_TEMP_DIR = os.getenv("STUDYMATE_UPLOAD_DIR", os.path.join(".studymate_cache", "uploads"))
+UPLOAD_TEMP_MAX_MB = float(os.getenv("STUDYMATE_UPLOAD_DIR_MAX_MB", "512"))
+UPLOAD_TEMP_TTL = float(os.getenv("STUDYMATE_UPLOAD_TTL", "3600"))  # seconds since last use
+
+_upload_spill_lock = threading.Lock()
+_SPILL_FILE_NAME = re.compile(r"^[0-9a-f]{64}(\.[a-z0-9]{1,10})?$")  # only these are ever cleaned up
+
+# Parallel PDF extraction (1 worker = serial extraction in the calling thread)
+PDF_EXTRACT_WORKERS = int(os.getenv("STUDYMATE_PDF_WORKERS", "1"))
+PDF_PAGE_TIMEOUT = float(os.getenv("STUDYMATE_PDF_PAGE_TIMEOUT", "30"))
+PDF_PAGES_PER_TASK = int(os.getenv("STUDYMATE_PDF_PAGES_PER_TASK", "16"))
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("STUDYMATE_PDF_PARALLEL_MIN_PAGES", "32"))
+# Workers start from a fresh interpreter rather than forking a process that holds models and threads
+PDF_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+# Per-page OCR fallback
+OCR_PAGE_MIN_CHARS = int(os.getenv("STUDYMATE_OCR_PAGE_MIN_CHARS", "10"))  # less text than this = no text layer
+OCR_SAMPLE_PAGES = int(os.getenv("STUDYMATE_OCR_SAMPLE_PAGES", "3"))
+OCR_DPI = int(os.getenv("STUDYMATE_OCR_DPI", "200"))
+
+_tesseract_available = None
+
+# Streaming ingestion pipeline
+INGEST_QUEUE_BATCHES = int(os.getenv("STUDYMATE_INGEST_QUEUE_BATCHES", "4"))
+INGEST_EVENT_INTERVAL = 0.25  # seconds between page-progress events
+
+# Shared embedding model (one copy per process, used by every session)
+EMBEDDING_BATCH_SIZE = int(os.getenv("STUDYMATE_EMBED_BATCH_SIZE", "64"))
+EMBEDDING_DEVICE = os.getenv("STUDYMATE_EMBED_DEVICE", "cpu")
+EMBEDDING_THREADS = int(os.getenv("STUDYMATE_EMBED_THREADS", "0"))  # 0 = library default
+
+_embeddings = None
+_embeddings_lock = threading.Lock()
+
+# On-disk per-chunk embedding cache shared by every index (vectors.f32 rows + keys.bin digests)
+EMBEDDING_CACHE_DIR = os.getenv("STUDYMATE_EMBEDDING_CACHE_DIR", os.path.join(".studymate_cache", "embeddings"))
+EMBEDDING_CACHE_ENABLED = os.getenv("STUDYMATE_EMBEDDING_CACHE", "1") != "0"
+EMBEDDING_KEY_BYTES = 20  # sha1 digest
+
+_embedding_cache = None
+_embedding_cache_lock = threading.Lock()
+_embedding_cache_stats = {"hits": 0, "misses": 0}
+
+_file_hashes = {}
+_file_hashes_lock = threading.Lock()
+
+# Shared LLM chain (built once per process, rebuilt only after endpoint failures)
+LLM_MODEL_ID = os.getenv("STUDYMATE_LLM_MODEL", "ibm/granite-13b-instruct-v2")
+# Text-generation endpoint URL (a dedicated endpoint or a local stand-in) used instead of LLM_MODEL_ID
+LLM_ENDPOINT_URL = os.getenv("STUDYMATE_LLM_ENDPOINT_URL")
+LLM_HTTP_POOL_SIZE = int(os.getenv("STUDYMATE_LLM_POOL_SIZE", "16"))
+LLM_RETRY_SECONDS = float(os.getenv("STUDYMATE_LLM_RETRY_SECONDS", "30"))
+
+_qa_chain = None
+_llm_lock = threading.Lock()
+_llm_failed_at = float("-inf")
+_llm_override = None  # set by set_conversational_llm, e.g. a local stub for benchmarks
+
+# Process-wide concurrency limits shared by every session, sync or async
+LLM_CONCURRENCY = int(os.getenv("STUDYMATE_LLM_CONCURRENCY", str(LLM_HTTP_POOL_SIZE)))
+CPU_WORKERS = int(os.getenv("STUDYMATE_CPU_WORKERS", str(os.cpu_count() or 4)))
+
+_cpu_executor = None
+_cpu_executor_lock = threading.Lock()
+
+# Document/page metadata per index position for scoped retrieval, keyed by FAISS index so sessions sharing one reuse it
+_chunk_scopes = weakref.WeakKeyDictionary()
+_chunk_scopes_lock = threading.Lock()
+_store_fingerprints = weakref.WeakKeyDictionary()
+
+# Micro-batching of query embeddings and index searches across sessions (0 ms disables it)
+QUERY_BATCH_WINDOW_MS = float(os.getenv("STUDYMATE_QUERY_BATCH_WINDOW_MS", "2"))
+QUERY_BATCH_MAX = int(os.getenv("STUDYMATE_QUERY_BATCH_MAX", "64"))
+
+# Lexical index (sentence postings + BM25) built at ingestion time and stored next to the FAISS index
+LEXICAL_INDEX_FILE = "lexical.pkl"
+MIN_SENTENCE_CHARS = 20
+BM25_K1 = 1.5
+BM25_B = 0.75
+HYBRID_SEARCH = os.getenv("STUDYMATE_HYBRID_SEARCH", "0") == "1"
+HYBRID_RRF_K = 60  # reciprocal rank fusion constant
+# "lexical" scores fallback sentences by question-word overlap, "semantic" by cosine similarity to the question
+EXTRACTIVE_MODE = os.getenv("STUDYMATE_EXTRACTIVE_MODE", "lexical")
+EXTRACTIVE_TOP_SENTENCES = 3
+
+_lexical_indexes = weakref.WeakKeyDictionary()
+_lexical_lock = threading.Lock()
+
+# Context packing: how much retrieved text goes into the prompt
+CONTEXT_TOKEN_BUDGET = int(os.getenv("STUDYMATE_CONTEXT_TOKENS", "2000"))
+CONTEXT_FETCH_K = int(os.getenv("STUDYMATE_CONTEXT_FETCH_K", "20"))
+CONTEXT_MIN_SIMILARITY = float(os.getenv("STUDYMATE_CONTEXT_MIN_SIMILARITY", "0.2"))
+CONTEXT_DUPLICATE_SIMILARITY = 0.8  # Jaccard similarity of word sets above which a passage counts as a near-duplicate
+CONTEXT_BASELINE_K = 10  # chunks the prompt used to carry, for the tokens-saved log line
+CHARS_PER_TOKEN = 4  # estimate used when the model's tokenizer is unavailable
+
+_tokenizer = None  # None until loaded, False if it can't be
+_tokenizer_loading = False
+_tokenizer_lock = threading.Lock()
+
+# Semantic answer cache keyed by index fingerprint + query embedding
+ANSWER_CACHE_SIMILARITY = float(os.getenv("STUDYMATE_ANSWER_CACHE_SIMILARITY", "0.95"))
+ANSWER_CACHE_TTL = float(os.getenv("STUDYMATE_ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("STUDYMATE_ANSWER_CACHE_MAX_ENTRIES", "1000"))
+ANSWER_INFLIGHT_TIMEOUT = 120  # seconds a coalesced question waits for the first caller
+
+_answer_cache = OrderedDict()  # (cache key, normalised question) -> entry, oldest first
+_answer_cache_lock = threading.Lock()
+_answer_cache_stats = {"hits": 0, "misses": 0, "coalesced": 0}
+_answers_in_flight = {}
+
+_index_cache_lock = threading.Lock()
+_index_cache_stats = {"hits": 0, "memory_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+_shared_indexes = OrderedDict()  # fingerprint -> entry, least recently used first
+_shared_indexes_lock = threading.RLock()  # re-entrant: handle finalizers may run during garbage collection
+_shared_handles = weakref.WeakKeyDictionary()  # session handle -> finalizer releasing its reference
+_shared_index_stats = {"hits": 0, "misses": 0, "evictions": 0}
+_memory_mapped_indexes = weakref.WeakKeyDictionary()  # store -> index file its read-only index maps
+
+# Pipeline metrics: counters, per-stage latency histograms and per-question timing breakdowns
+METRICS_FILE = os.getenv("STUDYMATE_METRICS_FILE")  # JSON snapshot written after questions when set
+METRICS_WRITE_INTERVAL = float(os.getenv("STUDYMATE_METRICS_WRITE_INTERVAL", "10"))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_metrics_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_request_timings = contextvars.ContextVar("studymate_request_timings", default=None)
+_live_vector_stores = weakref.WeakSet()
+_session_stores = weakref.WeakValueDictionary()
+_metrics_written_at = float("-inf")
+
+def increment_counter(name, amount=1):
+    with _metrics_lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+def record_latency(stage, seconds):
+    """Add one observation to the stage's histogram and to the current question's breakdown."""
+    with _metrics_lock:
+        histogram = _histograms.get(stage)
+        if histogram is None:
+            histogram = _histograms[stage] = {"buckets": [0] * (len(LATENCY_BUCKETS) + 1), "sum": 0.0, "count": 0}
+        histogram["buckets"][bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        histogram["sum"] += seconds
+        histogram["count"] += 1
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+@contextmanager
+def timed_stage(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_latency(stage, time.perf_counter() - started)
+
+def _begin_request_timings():
+    timings = {}
+    _request_timings.set(timings)
+    return timings
+
+def get_last_request_timings():
+    """Stage -> seconds for the last question answered in this thread (or async task)."""
+    timings = _request_timings.get()
+    return dict(timings) if timings else {}
+
+def _track_vector_store(vector_store):
+    if vector_store is not None:
+        _live_vector_stores.add(vector_store)
+    return vector_store
+
+def track_session(session_id, vector_store):
+    """Attribute a vector store to a UI session so its memory shows up in the metrics."""
+    if vector_store is None:
+        _session_stores.pop(session_id, None)
+    else:
+        _session_stores[session_id] = vector_store
+
+def _index_nbytes(index):
+    if hasattr(index, "refine_index"):  # binary prefilter: LSH codes plus the vectors used for re-ranking
+        base, refine = faiss.downcast_index(index.base_index), faiss.downcast_index(index.refine_index)
+        return _index_nbytes(base) + _index_nbytes(refine)
+    try:
+        return int(index.sa_code_size()) * index.ntotal
+    except Exception:
+        return index.ntotal * index.d * 4  # uncompressed float32 vectors
+
+def get_store_memory(vector_store):
+    """Approximate memory held by one vector store: index codes plus chunk text."""
+    return {
+        "vectors": int(vector_store.index.ntotal),
+        "index_bytes": _index_nbytes(vector_store.index),
+        "docstore_bytes": sum(len(doc.page_content) for doc in vector_store.docstore._dict.values()),
+        "memory_mapped": vector_store in _memory_mapped_indexes,
+    }
+
+def _process_resident_bytes():
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except Exception:
+        try:
+            import resource
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # peak, in KiB on Linux
+        except Exception:
+            return None
+
+def get_metrics():
+    """Snapshot of all counters, stage latencies, index sizes, per-session memory and cache stats."""
+    with _metrics_lock:
+        counters = dict(_counters)
+        stages = {}
+        for stage, histogram in _histograms.items():
+            cumulative, buckets = 0, {}
+            for bound, count in zip(list(LATENCY_BUCKETS) + ["+Inf"], histogram["buckets"]):
+                cumulative += count
+                buckets[str(bound)] = cumulative
+            stages[stage] = {
+                "count": histogram["count"],
+                "sum_seconds": histogram["sum"],
+                "mean_ms": histogram["sum"] * 1000 / histogram["count"],
+                "buckets": buckets,
+            }
+    indexes = {}
+    for vector_store in list(_live_vector_stores):
+        indexes[get_vector_store_fingerprint(vector_store)[:12]] = get_store_memory(vector_store)
+    sessions = {}
+    for session_id, vector_store in list(_session_stores.items()):
+        sessions[session_id] = dict(get_store_memory(vector_store),
+                                    index=get_vector_store_fingerprint(vector_store)[:12])
+    return {
+        "timestamp": time.time(),
+        "counters": counters,
+        "stages": stages,
+        "indexes": indexes,
+        "sessions": sessions,
+        "process": {"resident_bytes": _process_resident_bytes()},
+        "caches": {
+            "index_cache": get_index_cache_stats(),
+            "embedding_cache": get_embedding_cache_stats(),
+            "answer_cache": get_answer_cache_stats(),
+            "query_batching": get_query_batching_stats(),
+            "shared_indexes": get_shared_index_stats(),
+        },
+    }
+
+def _prometheus_labels(**labels):
+    return "{" + ",".join(f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+                          for k, v in labels.items()) + "}"
+
+def export_metrics_prometheus(metrics=None):
+    """Render metrics in the Prometheus text exposition format."""
+    metrics = metrics or get_metrics()
+    lines = []
+    for name, value in sorted(metrics["counters"].items()):
+        lines += [f"# TYPE studymate_{name} counter", f"studymate_{name} {value}"]
+
+    lines += ["# HELP studymate_stage_seconds Latency of pipeline stages", "# TYPE studymate_stage_seconds histogram"]
+    for stage, histogram in sorted(metrics["stages"].items()):
+        for bound, count in histogram["buckets"].items():
+            lines.append(f"studymate_stage_seconds_bucket{_prometheus_labels(stage=stage, le=bound)} {count}")
+        lines.append(f"studymate_stage_seconds_sum{_prometheus_labels(stage=stage)} {histogram['sum_seconds']}")
+        lines.append(f"studymate_stage_seconds_count{_prometheus_labels(stage=stage)} {histogram['count']}")
+
+    for key, name in [("vectors", "index_vectors"), ("index_bytes", "index_bytes"),
+                      ("docstore_bytes", "index_docstore_bytes")]:
+        lines.append(f"# TYPE studymate_{name} gauge")
+        for index_id, memory in sorted(metrics["indexes"].items()):
+            lines.append(f"studymate_{name}{_prometheus_labels(index=index_id)} {memory[key]}")
+    lines.append("# TYPE studymate_session_memory_bytes gauge")
+    for session_id, memory in sorted(metrics["sessions"].items()):
+        labels = _prometheus_labels(session=session_id, index=memory["index"])
+        lines.append(f"studymate_session_memory_bytes{labels} {memory['index_bytes'] + memory['docstore_bytes']}")
+    if metrics["process"]["resident_bytes"] is not None:
+        lines += ["# TYPE studymate_process_resident_bytes gauge",
+                  f"studymate_process_resident_bytes {metrics['process']['resident_bytes']}"]
+
+    for cache, stats in sorted(metrics["caches"].items()):
+        for key, value in sorted(_flatten_numbers(stats).items()):
+            lines += [f"# TYPE studymate_{cache}_{key} gauge", f"studymate_{cache}_{key} {value}"]
+    return "\n".join(lines) + "\n"
+
+def _flatten_numbers(stats, prefix=""):
+    flat = {}
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            flat.update(_flatten_numbers(value, f"{prefix}{key}_"))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+def write_metrics_file(path=None):
+    """Write a JSON metrics snapshot (to STUDYMATE_METRICS_FILE by default), replacing the file atomically."""
+    global _metrics_written_at
+    path = path or METRICS_FILE
+    if not path:
+        return None
+    try:
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(get_metrics(), f, indent=2)
+        os.replace(tmp_path, path)
+        _metrics_written_at = time.monotonic()
+        return path
+    except Exception as e:
+        logging.warning(f"Could not write metrics to {path}: {e}")
+        return None
+
+def _maybe_write_metrics():
+    if METRICS_FILE and time.monotonic() - _metrics_written_at >= METRICS_WRITE_INTERVAL:
+        write_metrics_file()
+
+class UploadedDocument:
+    """An uploaded file held in memory, accepted wherever ingestion takes a file path."""
+
+    def __init__(self, name, data):
+        self.name = os.path.basename(name)
+        self.data = data  # bytes; Streamlit's getvalue() hands over the upload's buffer without copying
+        self._digest = None
+
+    @property
+    def digest(self):
+        if self._digest is None:
+            self._digest = hashlib.sha256(self.data).hexdigest()
+        return self._digest
+
+    def __str__(self):
+        return self.name
+
+def _document_name(document):
+    return document.name if isinstance(document, UploadedDocument) else os.path.basename(document)
+
+def _open_pdf(document):
+    if isinstance(document, UploadedDocument):
+        return fitz.open(stream=document.data, filetype="pdf")
+    return fitz.open(document)
+
+def _read_text_document(document):
+    if isinstance(document, UploadedDocument):
+        return str(document.data, "utf-8", "ignore").strip()
+    with open(document, "r", encoding="utf-8", errors="ignore") as f:
+        return f.read().strip()
+
+def document_path(document):
+    """A file path for a document, spilling an in-memory upload to a content-hash-named temp file if needed.
+
+    Identical uploads from different sessions share one file, and users' file names never collide.
+    """
+    if not isinstance(document, UploadedDocument):
+        return document
+    extension = os.path.splitext(document.name)[1].lower()
+    if not _SPILL_FILE_NAME.match(document.digest + extension):
+        extension = ""
+    path = os.path.join(UPLOAD_TEMP_DIR, document.digest + extension)
+    with _upload_spill_lock:
+        try:
+            os.utime(path)  # already spilled: mark as recently used
+            return path
+        except FileNotFoundError:
+            pass
+        os.makedirs(UPLOAD_TEMP_DIR, exist_ok=True)
+        tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        with open(tmp_path, "wb") as f:
+            f.write(document.data)
+        os.replace(tmp_path, path)
+        cleanup_upload_dir(keep=path)
+    logging.info(f"Spilled {document.name} to {path}")
+    return path
+
+def cleanup_upload_dir(keep=None):
+    """Delete spilled uploads unused for UPLOAD_TEMP_TTL, then least recently used ones over UPLOAD_TEMP_MAX_MB.
+
+    Only files named like a spill (<sha256><ext>) are touched; anything else in the
+    directory, including other processes' in-flight writes, is left alone.
+    """
+    if not os.path.isdir(UPLOAD_TEMP_DIR):
+        return 0
+    entries = []
+    for name in os.listdir(UPLOAD_TEMP_DIR):
+        path = os.path.join(UPLOAD_TEMP_DIR, name)
+        if not _SPILL_FILE_NAME.match(name):
+            continue
+        try:
+            if os.path.isfile(path) and path != keep:
+                entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+        except OSError:
+            pass
+    budget = UPLOAD_TEMP_MAX_MB * 1024 * 1024
+    total = sum(size for _, size, _ in entries) + (os.path.getsize(keep) if keep else 0)
+    expired_before = time.time() - UPLOAD_TEMP_TTL
+    removed = 0
+    for mtime, size, path in sorted(entries):
+        if mtime >= expired_before and total <= budget:
+            break
+        try:
+            os.remove(path)
+            total -= size
+            removed += 1
+        except OSError:
+            pass
+    if removed:
+        logging.info(f"Removed {removed} temp upload files from {UPLOAD_TEMP_DIR}")
+    return removed
+
+def _has_tesseract():
+    """Check once per process whether the tesseract binary is available for OCR."""
+    global _tesseract_available
+    if _tesseract_available is None:
+        try:
+            pytesseract.get_tesseract_version()
+            _tesseract_available = True
+        except Exception as e:
+            logging.warning(f"Tesseract not available, OCR disabled: {e}")
+            _tesseract_available = False
+    return _tesseract_available
+
+def _render_page_image(doc, pdf_path, page_num):
+    """Render a single page for OCR so only one page image is held in memory at a time."""
+    from PIL import Image
+    try:
+        pix = doc[page_num].get_pixmap(dpi=OCR_DPI)
+        return Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+    except Exception as e:
+        logging.debug(f"PyMuPDF could not render page {page_num + 1}, falling back to pdf2image: {e}")
+        from pdf2image import convert_from_path
+        images = convert_from_path(document_path(pdf_path), dpi=OCR_DPI, first_page=page_num + 1, last_page=page_num + 1)
+        return images[0] if images else None
+
+def _ocr_page(doc, pdf_path, page_num):
+    image = _render_page_image(doc, pdf_path, page_num)
+    if image is None:
+        return ""
+    try:
+        return pytesseract.image_to_string(image).strip()
+    finally:
+        image.close()
+
+def _is_scanned_pdf(doc):
+    """Sample the first pages; a document whose sampled pages have no text layer is treated as scanned."""
+    sample = range(min(OCR_SAMPLE_PAGES, doc.page_count))
+    return all(len(doc[page_num].get_text("text").strip()) < OCR_PAGE_MIN_CHARS for page_num in sample)
+
+def _extract_page(doc, pdf_path, page_num, scanned, ocr_enabled):
+    """Return one page's text, OCR-ing it when it has no usable text layer.
+
+    The text layer is always read. In a scanned document every page with little text is
+    OCR'd; elsewhere only pages with no text at all (e.g. a scanned figure). OCR output
+    replaces the text layer only when it is longer.
+    """
+    page_text = doc[page_num].get_text("text").strip()
+    needs_ocr = len(page_text) < OCR_PAGE_MIN_CHARS if scanned else not page_text
+    if needs_ocr and ocr_enabled:
+        try:
+            ocr_text = _ocr_page(doc, pdf_path, page_num)
+            logging.debug(f"OCR extracted {len(ocr_text)} characters from page {page_num + 1}")
+            if len(ocr_text) > len(page_text):
+                page_text = ocr_text
+        except Exception as ocr_error:
+            logging.error(f"OCR failed for page {page_num + 1} of {pdf_path}: {ocr_error}")
+    logging.debug(f"Extracted {len(page_text)} characters from page {page_num + 1}")
+    return page_text
+
+_page_reports = None  # queue a worker process reports its pages on, set by _init_page_worker
+
+def _init_page_worker(page_reports):
+    global _page_reports
+    _page_reports = page_reports
+
+def _extract_page_range(pdf_path, start, end, scanned=False):
+    """Extract pages [start, end) in a worker process, reporting each page as it starts and finishes."""
+    ocr_enabled = _has_tesseract()
+    page_num = start
     try:
-        logging.info(f"Extracting text from PDF: {pdf_path}")
         with fitz.open(pdf_path) as doc:
-            for page_num, page in enumerate(doc):
-                page_text = page.get_text("text").strip()
-                if page_text:
-                    text += page_text + "\n"
-                logging.debug(f"Extracted {len(page_text)} characters from page {page_num + 1}")
+            for page_num in range(start, end):
+                _page_reports.put(("started", page_num, end))
+                try:
+                    page_text = _extract_page(doc, pdf_path, page_num, scanned, ocr_enabled)
+                except Exception as e:
+                    logging.error(f"Failed to extract page {page_num + 1} of {pdf_path}: {e}")
+                    page_text = ""
+                _page_reports.put(("done", page_num, page_text))
+    except Exception as e:
+        logging.error(f"Failed to extract pages {page_num + 1}-{end} of {pdf_path}: {e}")
+        for missing in range(page_num, end):
+            _page_reports.put(("done", missing, ""))
+
+def _iter_page_texts_parallel(pdf_path, page_count, workers, scanned=False):
+    """Extract page ranges on a process pool, yielding pages in order.
+
+    Workers report every page as it starts and finishes, so each page gets its own
+    PDF_PAGE_TIMEOUT: a stuck page is skipped, the pages its range already returned are
+    kept and the rest of the range is handed to another worker.
+    """
+    context = multiprocessing.get_context(PDF_START_METHOD)
+    page_reports = context.Queue()
+    ranges = deque((start, min(start + PDF_PAGES_PER_TASK, page_count))
+                   for start in range(0, page_count, PDF_PAGES_PER_TASK))
+    # Keep a small window in flight so finished-but-unread pages don't pile up in memory
+    window = workers * 2 * PDF_PAGES_PER_TASK
+    # Leaving the with-block terminates the pool, which also kills workers stuck on a bad page
+    with context.Pool(min(workers, len(ranges)), initializer=_init_page_worker, initargs=(page_reports,)) as pool:
+        started, page_texts, next_page = {}, {}, 0
+
+        def submit(start, end):
+            pool.apply_async(_extract_page_range, (pdf_path, start, end, scanned))
+
+        while next_page < page_count:
+            while ranges and ranges[0][0] < next_page + window:
+                submit(*ranges.popleft())
+            if next_page in page_texts:
+                started.pop(next_page, None)
+                yield page_texts.pop(next_page)
+                next_page += 1
+                continue
+            now = time.monotonic()
+            if next_page in started:
+                started_at, range_end = started[next_page]
+                if now - started_at >= PDF_PAGE_TIMEOUT:
+                    logging.warning(f"Timed out extracting page {next_page + 1} of {pdf_path}, skipping it")
+                    page_texts[next_page] = ""
+                    if next_page + 1 < range_end:
+                        submit(next_page + 1, range_end)
+                    continue
+                wait = started_at + PDF_PAGE_TIMEOUT - now
+            else:
+                wait = PDF_PAGE_TIMEOUT
+            try:
+                kind, page_num, value = page_reports.get(timeout=wait)
+            except queue.Empty:
+                if next_page in started:
+                    continue
+                # No worker reported anything for a whole page timeout: all are stuck or gone
+                logging.warning(f"PDF workers stopped responding, skipping pages {next_page + 1}-{page_count} of {pdf_path}")
+                for page_num in range(next_page, page_count):
+                    yield page_texts.pop(page_num, "")
+                return
+            if page_num < next_page:
+                continue  # a late report for a page that was already skipped
+            if kind == "started":
+                started.setdefault(page_num, (time.monotonic(), value))
+            else:
+                page_texts.setdefault(page_num, value)
+
+def iter_pdf_pages(pdf_path, workers=None):
+    """Yield the text of every page in order ('' for pages without text)."""
+    workers = PDF_EXTRACT_WORKERS if workers is None else workers
+    with _open_pdf(pdf_path) as doc:
+        page_count = doc.page_count
+        scanned = _is_scanned_pdf(doc)
+        if scanned:
+            logging.info(f"No text layer in the first pages of {pdf_path}, treating it as scanned")
+        if workers <= 1 or page_count < PDF_PARALLEL_MIN_PAGES:
+            ocr_enabled = _has_tesseract()
+            for page_num in range(page_count):
+                yield _extract_page(doc, pdf_path, page_num, scanned, ocr_enabled)
+            return
+    # Worker processes open the file themselves, so an in-memory upload needs a path here
+    yield from _iter_page_texts_parallel(document_path(pdf_path), page_count, workers, scanned)
+
+def get_pdf_text_with_ocr(pdf_path, workers=None):
+    """Extract text from PDF using PyMuPDF, OCR-ing only the pages that have no text layer."""
+    try:
+        logging.info(f"Extracting text from PDF: {pdf_path}")
+        page_texts = list(iter_pdf_pages(pdf_path, workers))
     except Exception as e:
         logging.error(f"Failed to extract text from {pdf_path}: {e}")
-        text = ""
-
-    # If extracted text is too short, try OCR
-    if len(text.strip()) < 100:
-        logging.info(f"Text extraction yielded minimal content, attempting OCR for {pdf_path}")
-        try:
-            images = convert_from_path(pdf_path)
-            ocr_text = ""
-            for i, img in enumerate(images):
-                page_ocr = pytesseract.image_to_string(img)
-                ocr_text += page_ocr + "\n"
-                logging.debug(f"OCR extracted {len(page_ocr)} characters from page {i + 1}")
-            text = ocr_text
-            logging.info(f"OCR completed for {pdf_path}, extracted {len(text)} characters")
-        except Exception as ocr_error:
-            logging.error(f"OCR failed for {pdf_path}: {ocr_error}")
-            return ""
+        return ""
 
-    return text
+    return "".join(page_text + "\n" for page_text in page_texts if page_text)
 
 def get_all_pdf_text(pdf_paths):
     all_text = ""
@@ -72,64 +669,1606 @@ def get_all_pdf_text(pdf_paths):
 def get_txt_text(txt_paths):
     text = ""
     for txt_file in txt_paths:
-        with open(txt_file, "r", encoding="utf-8", errors="ignore") as f:
-            text += f.read().strip() + "\n"
+        text += _read_text_document(txt_file) + "\n"
     return text
 
 def get_text_chunks(text):
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
     return text_splitter.split_text(text)
 
+def get_embeddings():
+    """Return the process-wide embedding model, loading it on first use."""
+    global _embeddings
+    if _embeddings is None:
+        with _embeddings_lock:
+            if _embeddings is None:
+                from langchain_huggingface import HuggingFaceEmbeddings
+                if EMBEDDING_THREADS > 0:
+                    import torch
+                    torch.set_num_threads(EMBEDDING_THREADS)
+                _embeddings = HuggingFaceEmbeddings(
+                    model_name=EMBEDDING_MODEL_NAME,
+                    model_kwargs={"device": EMBEDDING_DEVICE},
+                    encode_kwargs={"batch_size": EMBEDDING_BATCH_SIZE}
+                )
+                logging.info(f"Loaded embedding model {EMBEDDING_MODEL_NAME} on {EMBEDDING_DEVICE}")
+    return _embeddings
+
+def _embedding_cache_paths():
+    model_dir = os.path.join(EMBEDDING_CACHE_DIR, EMBEDDING_MODEL_NAME.replace("/", "__"))
+    return {
+        "dir": model_dir,
+        "vectors": os.path.join(model_dir, "vectors.f32"),
+        "keys": os.path.join(model_dir, "keys.bin"),
+        "meta": os.path.join(model_dir, "meta.json"),
+        "lock": os.path.join(model_dir, ".lock"),
+    }
+
+def _lock_embedding_files(lock_file, exclusive):
+    if fcntl is not None:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+def _refresh_embedding_cache(cache):
+    """Pick up rows appended since the last read, including rows written by other processes."""
+    paths = cache["paths"]
+    try:
+        key_bytes = os.path.getsize(paths["keys"])
+    except OSError:
+        return
+    if key_bytes // EMBEDDING_KEY_BYTES <= cache["rows"]:
+        return
+    if cache["dim"] is None:
+        with open(paths["meta"], "r", encoding="utf-8") as f:
+            cache["dim"] = json.load(f)["dim"]
+    # An interrupted write or a truncated file can leave a partial key or vector at the end;
+    # only rows with both a whole key and a whole vector count, the next writer overwrites the rest
+    try:
+        vector_rows = os.path.getsize(paths["vectors"]) // (cache["dim"] * 4)
+    except OSError:
+        vector_rows = 0
+    rows = min(key_bytes // EMBEDDING_KEY_BYTES, vector_rows)
+    if rows <= cache["rows"]:
+        return
+    with open(paths["keys"], "rb") as f:
+        f.seek(cache["rows"] * EMBEDDING_KEY_BYTES)
+        new_keys = f.read((rows - cache["rows"]) * EMBEDDING_KEY_BYTES)
+    for i in range(0, len(new_keys), EMBEDDING_KEY_BYTES):
+        cache["index"][new_keys[i:i + EMBEDDING_KEY_BYTES]] = cache["rows"]
+        cache["rows"] += 1
+    cache["vectors"] = None  # remap lazily at the new length
+
+def _get_embedding_cache():
+    """Open (once) the lookup index of the on-disk embedding cache for the current model."""
+    global _embedding_cache
+    if _embedding_cache is None:
+        paths = _embedding_cache_paths()
+        os.makedirs(paths["dir"], exist_ok=True)
+        cache = {"paths": paths, "index": {}, "rows": 0, "vectors": None, "dim": None}
+        with open(paths["lock"], "a+") as lock_file:
+            _lock_embedding_files(lock_file, exclusive=False)
+            _refresh_embedding_cache(cache)
+        _embedding_cache = cache
+    return _embedding_cache
+
+def _embedding_cache_vectors(cache):
+    if cache["vectors"] is None:
+        cache["vectors"] = np.memmap(cache["paths"]["vectors"], dtype=np.float32, mode="r",
+                                     shape=(cache["rows"], cache["dim"]))
+    return cache["vectors"]
+
+def _embedding_key(text):
+    return hashlib.sha1(f"{EMBEDDING_MODEL_NAME}\0{text}".encode("utf-8")).digest()
+
+def embed_documents_cached(texts):
+    """Embed texts, computing only those whose (model, text) pair has never been embedded before."""
+    if not EMBEDDING_CACHE_ENABLED:
+        return get_embeddings().embed_documents(texts)
+
+    keys = [_embedding_key(text) for text in texts]
+    with _embedding_cache_lock:
+        cache = _get_embedding_cache()
+        if any(key not in cache["index"] for key in keys):
+            _refresh_embedding_cache(cache)
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cache["index"]:
+                missing.setdefault(key, text)
+        _embedding_cache_stats["hits"] += len(texts) - len(missing)
+        _embedding_cache_stats["misses"] += len(missing)
+
+    computed = {}
+    if missing:
+        vectors = np.asarray(get_embeddings().embed_documents(list(missing.values())), dtype=np.float32)
+        computed = dict(zip(missing.keys(), vectors))
+        with _embedding_cache_lock:
+            paths = cache["paths"]
+            try:
+                with open(paths["lock"], "a+") as lock_file:
+                    _lock_embedding_files(lock_file, exclusive=True)
+                    _refresh_embedding_cache(cache)
+                    new_keys = [key for key in computed if key not in cache["index"]]
+                    if cache["dim"] is None:
+                        cache["dim"] = int(vectors.shape[1])
+                        with open(paths["meta"], "w", encoding="utf-8") as f:
+                            json.dump({"model": EMBEDDING_MODEL_NAME, "dim": cache["dim"]}, f)
+                    if new_keys:
+                        # Vectors first, then keys: a reader never sees a key without its row.
+                        # Partial rows and keys left behind by an interrupted write are overwritten.
+                        if os.path.exists(paths["vectors"]):
+                            os.truncate(paths["vectors"], cache["rows"] * cache["dim"] * 4)
+                        if os.path.exists(paths["keys"]):
+                            os.truncate(paths["keys"], cache["rows"] * EMBEDDING_KEY_BYTES)
+                        with open(paths["vectors"], "ab") as f:
+                            f.write(np.stack([computed[key] for key in new_keys]).tobytes())
+                        with open(paths["keys"], "ab") as f:
+                            f.write(b"".join(new_keys))
+                    _refresh_embedding_cache(cache)
+            except OSError as e:
+                logging.warning(f"Could not write to the embedding cache: {e}")
+
+    results = []
+    with _embedding_cache_lock:
+        for key in keys:
+            if key in computed:
+                results.append(computed[key].tolist())
+            else:
+                results.append(_embedding_cache_vectors(cache)[cache["index"][key]].tolist())
+    return results
+
+def get_embedding_cache_stats():
+    """Return hit/miss counters and the number of stored vectors of the embedding cache."""
+    stats = dict(_embedding_cache_stats)
+    stats["rows"] = _embedding_cache["rows"] if _embedding_cache is not None else 0
+    return stats
+
 def get_vector_store_from_texts(texts):
+    from langchain_community.vectorstores import FAISS
     if not texts:
         return None
     try:
-        embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
-        vector_store = FAISS.from_texts(texts, embedding=embeddings)
-        return vector_store
+        fingerprint = _fingerprint_texts(texts)
+        vector_store = acquire_shared_index(fingerprint) or load_cached_vector_store(fingerprint)
+        if vector_store is None:
+            embeddings = get_embeddings()
+            vectors = embed_documents_cached(texts)
+            vector_store = optimize_vector_store_index(FAISS.from_embeddings(list(zip(texts, vectors)), embeddings))
+            save_vector_store_to_cache(fingerprint, vector_store)  # so other processes can load (or map) it
+        return share_vector_store(fingerprint, vector_store)
     except Exception as e:
         logging.error(f"Failed to create vector store: {e}")
         return None
 
-def create_simple_answer(docs, question):
-    """Create a simple answer by extracting relevant text from documents."""
-    if not docs:
-        return "I couldn't find relevant information in your documents to answer this question."
+def _hash_file(path):
+    """Return the SHA-256 of a file's contents, memoised on path, size and mtime."""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _file_hashes_lock:
+        digest = _file_hashes.get(key)
+    if digest is not None:
+        return digest
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    digest = sha.hexdigest()
+    with _file_hashes_lock:
+        if len(_file_hashes) > 4096:
+            _file_hashes.clear()
+        _file_hashes[key] = digest
+    return digest
+
+def get_document_id(document):
+    """Stable per-document ID (content hash) used to tag every chunk of that document."""
+    return document.digest if isinstance(document, UploadedDocument) else _hash_file(document)
+
+def _index_settings():
+    """Index type and storage settings that shape a built index, for the fingerprint payloads."""
+    return {
+        "index_type": INDEX_TYPE,
+        "ann_index_type": ANN_INDEX_TYPE,
+        "ann_min_vectors": ANN_MIN_VECTORS,
+        "pq": INDEX_USE_PQ,
+        "storage": INDEX_STORAGE,
+        "binary_prefilter": INDEX_BINARY_PREFILTER,
+        "params": load_index_params(),
+    }
+
+def fingerprint_files(pdf_paths, txt_paths):
+    """Fingerprint an upload set from file contents plus the chunking/embedding/index parameters."""
+    payload = {
+        "version": INDEX_CACHE_VERSION,
+        # Sorted, so the same files uploaded in a different order share one cached index
+        "pdf": sorted(get_document_id(p) for p in pdf_paths),
+        "txt": sorted(get_document_id(p) for p in txt_paths),
+        "chunk_size": CHUNK_SIZE,
+        "chunk_overlap": CHUNK_OVERLAP,
+        "embedding_model": EMBEDDING_MODEL_NAME,
+        "index": _index_settings(),
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def _evict_index_cache():
+    """Drop least recently used cache entries until the cache fits in INDEX_CACHE_MAX_MB."""
+    if not os.path.isdir(INDEX_CACHE_DIR):
+        return
+    entries = []
+    for name in os.listdir(INDEX_CACHE_DIR):
+        path = os.path.join(INDEX_CACHE_DIR, name)
+        if os.path.isdir(path) and ".tmp-" not in name:
+            entries.append((os.path.getmtime(path), _dir_size(path), path))
+    budget = INDEX_CACHE_MAX_MB * 1024 * 1024
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= budget:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        _index_cache_stats["evictions"] += 1
+        logging.info(f"Evicted cached index {os.path.basename(path)} ({size / 1024 / 1024:.1f} MB)")
+
+def _read_index(index_path, mmap):
+    """Read a FAISS index, memory-mapped and read-only if asked and supported, else into memory."""
+    if mmap:
+        # Flat codes can only be mapped with IO_FLAG_MMAP_IFC (newer FAISS), but read_index rejects IVF
+        # indexes with that flag, so try with it first and fall back to plain IO_FLAG_MMAP for IVF lists
+        flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+        attempts = [flags | faiss.IO_FLAG_MMAP_IFC, flags] if hasattr(faiss, "IO_FLAG_MMAP_IFC") else [flags]
+        error = None
+        for attempt in attempts:
+            try:
+                index = faiss.read_index(index_path, attempt)
+                return index, _is_memory_mapped(index)
+            except Exception as e:
+                error = e
+        logging.warning(f"Could not memory-map {index_path}, reading it into memory: {error}")
+    return faiss.read_index(index_path), False
+
+def _is_memory_mapped(index):
+    """True only for indexes whose bulk data really is mapped: IVF lists on disk, or flat codes with IO_FLAG_MMAP_IFC.
+
+    Graph (HNSW) and refine indexes are read into memory whatever the flags, so they count at full size.
+    """
+    try:
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf is not None:
+            return isinstance(faiss.downcast_InvertedLists(ivf.invlists), faiss.OnDiskInvertedLists)
+        if hasattr(faiss, "IO_FLAG_MMAP_IFC") and hasattr(faiss, "IndexFlatCodes"):
+            return isinstance(faiss.downcast_index(index), faiss.IndexFlatCodes)
+        return False
+    except Exception:
+        return False
+
+def load_vector_store(path, mmap=None):
+    """Load a store saved by save_vector_store (or FAISS.save_local) from a directory.
+
+    With mmap (STUDYMATE_INDEX_MMAP by default) the index is memory-mapped read-only,
+    so it can answer before it is fully in RAM; the docstore is always read into memory.
+    """
+    from langchain_community.vectorstores import FAISS
+    mmap = INDEX_MMAP if mmap is None else mmap
+    index_path = os.path.join(path, "index.faiss")
+    index, mapped = _read_index(index_path, mmap)
+    # The pickle is written by save_vector_store below, never by a user upload
+    with open(os.path.join(path, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    vector_store = FAISS(get_embeddings(), index, docstore, index_to_docstore_id)
+    if mapped:
+        _memory_mapped_indexes[vector_store] = index_path
+    lexical_path = os.path.join(path, LEXICAL_INDEX_FILE)
+    if os.path.exists(lexical_path):
+        with open(lexical_path, "rb") as f:
+            lexical_index = pickle.load(f)
+        if "docstore_ids" in lexical_index:  # older files lack the chunk map and are rebuilt on first use
+            _lexical_indexes[vector_store] = lexical_index
+    return _track_vector_store(vector_store)
+
+def save_vector_store(vector_store, path):
+    """Save a store (index, docstore and lexical index) to a directory that load_vector_store can map."""
+    vector_store.save_local(path)
+    with open(os.path.join(path, LEXICAL_INDEX_FILE), "wb") as f:
+        pickle.dump(get_lexical_index(vector_store), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def load_cached_vector_store(fingerprint):
+    """Load a previously processed index for this fingerprint, or return None on a miss."""
+    path = os.path.join(INDEX_CACHE_DIR, fingerprint)
+    if not os.path.isdir(path):
+        with _index_cache_lock:
+            _index_cache_stats["misses"] += 1
+        return None
+    try:
+        with timed_stage("index_cache_load"):
+            vector_store = load_vector_store(path)
+        os.utime(path)  # mark as recently used for LRU eviction
+    except Exception as e:
+        logging.error(f"Failed to load cached index {fingerprint}: {e}")
+        shutil.rmtree(path, ignore_errors=True)
+        with _index_cache_lock:
+            _index_cache_stats["misses"] += 1
+        return None
+    with _index_cache_lock:
+        _index_cache_stats["hits"] += 1
+    mapped = " (memory-mapped)" if vector_store in _memory_mapped_indexes else ""
+    logging.info(f"Loaded cached index {fingerprint[:12]}{mapped}")
+    return vector_store
+
+def save_vector_store_to_cache(fingerprint, vector_store):
+    """Persist a vector store under its fingerprint and enforce the cache size cap."""
+    path = os.path.join(INDEX_CACHE_DIR, fingerprint)
+    tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    try:
+        os.makedirs(INDEX_CACHE_DIR, exist_ok=True)
+        save_vector_store(vector_store, tmp_path)
+        try:
+            os.replace(tmp_path, path)
+        except OSError:
+            # Another session stored the same upload set first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        with _index_cache_lock:
+            _index_cache_stats["stores"] += 1
+            _evict_index_cache()
+    except Exception as e:
+        logging.error(f"Failed to cache index {fingerprint}: {e}")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+def get_index_cache_stats():
+    """Return hit/miss/store/eviction counters for the index cache."""
+    with _index_cache_lock:
+        return dict(_index_cache_stats)
+
+def _fingerprint_texts(texts):
+    """Fingerprint pre-chunked texts (get_vector_store_from_texts) for the shared index registry."""
+    sha = hashlib.sha256(json.dumps({"version": INDEX_CACHE_VERSION, "texts": True,
+                                     "embedding_model": EMBEDDING_MODEL_NAME, "index": _index_settings()},
+                                    sort_keys=True).encode("utf-8"))
+    for text in texts:
+        sha.update(text.encode("utf-8", "ignore"))
+        sha.update(b"\0")
+    return sha.hexdigest()
+
+def _attach_handle(entry, handle=None):
+    """Give a session its own store object backed by the entry's shared index, docstore and lexical index.
+
+    The handle shares the master's FAISS index object, so the scoped-search tables built
+    by any session are reused by all of them.
+    """
+    handle = copy.copy(entry["store"]) if handle is None else handle
+    lexical_index = _lexical_indexes.get(entry["store"])
+    if lexical_index is not None:
+        _lexical_indexes[handle] = lexical_index
+    if entry["store"] in _memory_mapped_indexes:
+        _memory_mapped_indexes[handle] = _memory_mapped_indexes[entry["store"]]
+    entry["refs"] += 1
+    _shared_handles[handle] = weakref.finalize(handle, _release_shared_index, entry)
+    return _track_vector_store(handle)
+
+def _release_shared_index(entry):
+    # Runs when a session handle is garbage collected or detached; keep it to a counter update
+    with _shared_indexes_lock:
+        entry["refs"] -= 1
+
+def acquire_shared_index(fingerprint):
+    """Return a new session handle on the loaded index for this fingerprint, or None if it isn't loaded."""
+    with _shared_indexes_lock:
+        entry = _shared_indexes.get(fingerprint)
+        if entry is None:
+            _shared_index_stats["misses"] += 1
+            return None
+        _shared_indexes.move_to_end(fingerprint)
+        _shared_index_stats["hits"] += 1
+        return _attach_handle(entry)
+
+def share_vector_store(fingerprint, vector_store, persist=True):
+    """Register a built or loaded store under its fingerprint and return it as a session handle.
+
+    If another session registered the same material first, a handle on that copy is
+    returned instead and vector_store can be dropped. With persist=False the index is not
+    written to the disk cache on eviction (see _schedule_cache_save).
+    """
+    if vector_store is None or vector_store in _shared_handles:
+        return vector_store
+    lexical_index = get_lexical_index(vector_store)  # built once here rather than per session
+    with _shared_indexes_lock:
+        entry = _shared_indexes.get(fingerprint)
+        if entry is not None:
+            _shared_indexes.move_to_end(fingerprint)
+            return _attach_handle(entry)
+        # The registry keeps its own store object, so no session handle is ever the shared original
+        master = copy.copy(vector_store)
+        _lexical_indexes[master] = lexical_index
+        if vector_store in _memory_mapped_indexes:
+            _memory_mapped_indexes[master] = _memory_mapped_indexes[vector_store]
+        memory = get_store_memory(master)
+        resident_index_bytes = 0 if memory["memory_mapped"] else memory["index_bytes"]  # mapped pages are the OS's
+        entry = {"store": master, "refs": 0, "bytes": resident_index_bytes + memory["docstore_bytes"], "persist": persist}
+        _shared_indexes[fingerprint] = entry
+        handle = _attach_handle(entry, vector_store)
+    _evict_shared_indexes()
+    return handle
+
+def _schedule_cache_save(fingerprint):
+    """Write an incrementally updated index to the disk cache after INDEX_CACHE_SAVE_DELAY, if still in use.
+
+    Every added file gives the upload set a new fingerprint, so saving each intermediate
+    index would rewrite the whole corpus per file; only the state a session settles on is kept.
+    """
+    def save_if_still_used():
+        with _shared_indexes_lock:
+            entry = _shared_indexes.get(fingerprint)
+            if entry is None or entry["refs"] == 0:
+                return  # superseded by a later add, or the session is gone
+            entry["persist"] = True
+            store = entry["store"]
+        if not os.path.isdir(os.path.join(INDEX_CACHE_DIR, fingerprint)):
+            save_vector_store_to_cache(fingerprint, store)
+
+    timer = threading.Timer(INDEX_CACHE_SAVE_DELAY, save_if_still_used)
+    timer.daemon = True
+    timer.start()
+
+def _detach_shared_store(vector_store):
+    """Copy-on-write: give a store private, writable copies of shared or memory-mapped data before it changes."""
+    if vector_store is None:
+        return vector_store
+    finalizer = _shared_handles.pop(vector_store, None)
+    index_path = _memory_mapped_indexes.pop(vector_store, None)
+    if finalizer is None and index_path is None:
+        return vector_store
+    vector_store.index = _private_index_copy(vector_store, index_path)
+    if finalizer is not None:
+        from langchain_community.docstore.in_memory import InMemoryDocstore
+        vector_store.docstore = InMemoryDocstore(dict(vector_store.docstore._dict))
+        vector_store.index_to_docstore_id = dict(vector_store.index_to_docstore_id)
+        lexical_index = _lexical_indexes.get(vector_store)
+        if lexical_index is not None:
+            _lexical_indexes[vector_store] = copy.deepcopy(lexical_index)
+        finalizer()  # release this session's reference to the shared entry
+    logging.info(f"Copied index {get_vector_store_fingerprint(vector_store)[:12]} for a session update")
+    return vector_store
+
+def _private_index_copy(vector_store, index_path=None):
+    # A mapped index is re-read from its file, since FAISS can't clone mapped inverted lists; if that
+    # file was evicted since, or the index type can't be cloned, rebuild from the vectors instead
+    try:
+        return faiss.read_index(index_path) if index_path else faiss.clone_index(vector_store.index)
+    except Exception:
+        return build_faiss_index(_get_store_vectors(vector_store))
+
+def _evict_shared_indexes():
+    """Drop least recently used idle indexes until loaded indexes fit in SHARED_INDEX_MAX_MB.
+
+    Indexes a session still uses are never dropped, since their memory stays referenced
+    anyway. Evicted indexes are written to the on-disk index cache if it no longer has them.
+    """
+    budget = SHARED_INDEX_MAX_MB * 1024 * 1024
+    evicted = []
+    with _shared_indexes_lock:
+        total = sum(entry["bytes"] for entry in _shared_indexes.values())
+        for fingerprint, entry in list(_shared_indexes.items()):
+            if total <= budget:
+                break
+            if entry["refs"] > 0:
+                continue
+            del _shared_indexes[fingerprint]
+            total -= entry["bytes"]
+            _shared_index_stats["evictions"] += 1
+            evicted.append((fingerprint, entry))
+    for fingerprint, entry in evicted:
+        # A memory-mapped index can't be written back once its cache entry is gone; it is rebuilt if needed
+        if entry["persist"] and entry["store"] not in _memory_mapped_indexes and not os.path.isdir(os.path.join(INDEX_CACHE_DIR, fingerprint)):
+            save_vector_store_to_cache(fingerprint, entry["store"])
+        logging.info(f"Evicted shared index {fingerprint[:12]} ({entry['bytes'] / 1024 / 1024:.1f} MB) to disk")
+
+def get_shared_index_stats():
+    """Return registry counters plus loaded indexes, session references and their memory."""
+    with _shared_indexes_lock:
+        return dict(_shared_index_stats,
+                    loaded=len(_shared_indexes),
+                    references=sum(entry["refs"] for entry in _shared_indexes.values()),
+                    bytes=sum(entry["bytes"] for entry in _shared_indexes.values()),
+                    budget_bytes=int(SHARED_INDEX_MAX_MB * 1024 * 1024))
+
+def _iter_document_pages(path, is_pdf):
+    if is_pdf:
+        yield from iter_pdf_pages(path)
+    else:
+        yield _read_text_document(path)
+
+def iter_page_records(path, is_pdf=None, doc_id=None):
+    """Yield one record per page with doc_id, source, page (1-based), text and character offsets.
+
+    Offsets index into the document text formed by joining non-empty pages with newlines,
+    which is the text the chunker sees.
+    """
+    is_pdf = _document_name(path).lower().endswith(".pdf") if is_pdf is None else is_pdf
+    doc_id = get_document_id(path) if doc_id is None else doc_id
+    source = _document_name(path)
+    offset = 0
+    for page_num, page_text in enumerate(_iter_document_pages(path, is_pdf), start=1):
+        end = offset + len(page_text) + 1 if page_text else offset
+        yield {"doc_id": doc_id, "source": source, "page": page_num, "text": page_text,
+               "start_char": offset, "end_char": end}
+        offset = end
+
+def get_page_records(pdf_paths, txt_paths):
+    """Structured counterpart of get_all_pdf_text/get_txt_text: a list of page records for every file."""
+    records = []
+    for path in pdf_paths:
+        records.extend(iter_page_records(path, is_pdf=True))
+    for path in txt_paths:
+        records.extend(iter_page_records(path, is_pdf=False))
+    return records
+
+def _count_pages(path, is_pdf):
+    if not is_pdf:
+        return 1
+    try:
+        with _open_pdf(path) as doc:
+            return doc.page_count
+    except Exception as e:
+        logging.error(f"Failed to open {path}: {e}")
+        return 0
+
+def _iter_chunks(page_records):
+    """Chunk a stream of page records into (text, metadata) pairs, holding only a few chunks of text.
+
+    Metadata records the source document, the pages the chunk spans and its character
+    offsets in the document text.
+    """
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+    page_starts = []   # document offset where each non-empty page begins
+    page_numbers = []
+    buffer = ""
+    buffer_offset = 0  # document offset of buffer[0]
+    record = None
+
+    def located(chunks):
+        search_from = 0
+        for chunk in chunks:
+            index = buffer.find(chunk, search_from)
+            if index < 0:
+                index = buffer.find(chunk)
+            start = buffer_offset + max(index, 0)
+            end = start + len(chunk)
+            metadata = {
+                "doc_id": record["doc_id"],
+                "source": record["source"],
+                "page": page_numbers[max(bisect_right(page_starts, start) - 1, 0)],
+                "page_end": page_numbers[max(bisect_right(page_starts, end - 1) - 1, 0)],
+                "start_index": start,
+                "end_index": end,
+            }
+            search_from = max(index, 0) + max(len(chunk) - CHUNK_OVERLAP, 1)
+            yield index, chunk, metadata
+
+    for record in page_records:
+        if record["text"]:
+            page_starts.append(record["start_char"])
+            page_numbers.append(record["page"])
+            buffer += record["text"] + "\n"
+        if len(buffer) >= CHUNK_SIZE * 4:
+            pending = list(located(text_splitter.split_text(buffer)))
+            for _, chunk, metadata in pending[:-1]:
+                yield chunk, metadata
+            # The last chunk may still grow with the next page, so re-split it with what follows
+            if pending:
+                last_index = max(pending[-1][0], 0)
+                buffer = buffer[last_index:]
+                buffer_offset += last_index
+    if buffer and record is not None:
+        for _, chunk, metadata in located(text_splitter.split_text(buffer)):
+            yield chunk, metadata
+
+def _produce_chunk_batches(documents, batches, stop):
+    """Producer thread: extract and chunk documents, handing page ticks and chunk batches to the consumer."""
+    def put(item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def pages_with_progress(path, is_pdf, doc_id):
+        for record in iter_page_records(path, is_pdf, doc_id):
+            yield record
+            put(("page",))
+
+    try:
+        for path, is_pdf, doc_id in documents:
+            if stop.is_set():
+                break
+            chunk_count = 0
+            texts, metadatas = [], []
+            try:
+                for chunk, metadata in _iter_chunks(pages_with_progress(path, is_pdf, doc_id)):
+                    texts.append(chunk)
+                    metadatas.append(metadata)
+                    if len(texts) >= EMBEDDING_BATCH_SIZE:
+                        put(("batch", doc_id, chunk_count, texts, metadatas))
+                        chunk_count += len(texts)
+                        texts, metadatas = [], []
+                if texts:
+                    put(("batch", doc_id, chunk_count, texts, metadatas))
+                    chunk_count += len(texts)
+            except Exception as e:
+                logging.error(f"Failed to extract text from {path}: {e}")
+            if chunk_count == 0:
+                logging.warning(f"No text extracted from {path}")
+            else:
+                logging.info(f"Chunked {path} into {chunk_count} chunks")
+    finally:
+        put(("done",))
+
+def _progress_event(progress, started):
+    event = dict(progress)
+    pages_total = max(progress["pages_total"], 1)
+    fraction = min(progress["pages_done"] / pages_total, 1.0)
+    elapsed = time.monotonic() - started
+    event["fraction"] = fraction
+    event["eta_seconds"] = elapsed * (1 - fraction) / fraction if fraction > 0 else None
+    return event
+
+def iter_ingest_documents(pdf_paths, txt_paths, vector_store=None):
+    """Stream pages -> chunks -> embedding batches -> index inserts, yielding progress events.
+
+    Extraction and chunking run on a producer thread while this generator embeds and
+    inserts batches, so the stages overlap and only a few batches are held in memory.
+    Every event is a dict with stage, pages_done, pages_total, chunks_embedded,
+    fraction and eta_seconds; the final event (stage "done") also carries vector_store.
+    """
+    from langchain_community.vectorstores import FAISS
+    indexed_ids = {doc["doc_id"] for doc in list_indexed_documents(vector_store)}
+    documents = []
+    for path, is_pdf in [(p, True) for p in pdf_paths] + [(p, False) for p in txt_paths]:
+        doc_id = get_document_id(path)
+        if doc_id in indexed_ids:
+            logging.info(f"Skipping {path}, already indexed")
+            continue
+        indexed_ids.add(doc_id)
+        documents.append((path, is_pdf, doc_id))
+
+    progress = {
+        "stage": "extracting",
+        "pages_done": 0,
+        "pages_total": sum(_count_pages(path, is_pdf) for path, is_pdf, _ in documents),
+        "chunks_embedded": 0,
+    }
+    started = time.monotonic()
+    batches = queue.Queue(maxsize=INGEST_QUEUE_BATCHES)
+    stop = threading.Event()
+    producer = threading.Thread(target=_produce_chunk_batches, args=(documents, batches, stop), daemon=True)
+    producer.start()
+
+    embeddings = get_embeddings()
+    last_event = 0.0
+    try:
+        while True:
+            item = batches.get()
+            if item[0] == "done":
+                break
+            if item[0] == "page":
+                progress["pages_done"] += 1
+            else:
+                _, doc_id, first_index, texts, metadatas = item
+                progress["stage"] = "embedding"
+                ids = [f"{doc_id}:{first_index + i}" for i in range(len(texts))]
+                for chunk_id, metadata in zip(ids, metadatas):
+                    metadata["chunk_id"] = chunk_id
+                try:
+                    with timed_stage("ingest_embedding"):
+                        vectors = embed_documents_cached(texts)
+                    with timed_stage("ingest_index_insert"):
+                        if vector_store is None:
+                            vector_store = FAISS.from_embeddings(list(zip(texts, vectors)), embeddings,
+                                                                 metadatas=metadatas, ids=ids)
+                        else:
+                            # Copy a shared index only once something is actually added to it
+                            _detach_shared_store(vector_store)
+                            vector_store.add_embeddings(list(zip(texts, vectors)), metadatas=metadatas, ids=ids)
+                    progress["chunks_embedded"] += len(texts)
+                    _on_vector_store_changed(vector_store)
+                    _add_to_lexical_index(vector_store, ids, texts, ids)  # chunk IDs double as docstore IDs
+                except Exception as e:
+                    logging.error(f"Failed to index {len(texts)} chunks of {metadatas[0]['source']}: {e}")
+            now = time.monotonic()
+            if item[0] == "batch" or now - last_event >= INGEST_EVENT_INTERVAL:
+                last_event = now
+                yield _progress_event(progress, started)
+    finally:
+        stop.set()
+
+    try:
+        with timed_stage("index_optimize"):
+            vector_store = optimize_vector_store_index(vector_store)
+    except Exception as e:
+        logging.error(f"Failed to build an ANN index, keeping exact search: {e}")
+
+    record_latency("ingest_total", time.monotonic() - started)
+    increment_counter("documents_ingested_total", len(documents))
+    increment_counter("pages_extracted_total", progress["pages_done"])
+    increment_counter("chunks_embedded_total", progress["chunks_embedded"])
+    _track_vector_store(vector_store)
+    progress["stage"] = "done"
+    event = _progress_event(progress, started)
+    event["fraction"] = 1.0
+    event["eta_seconds"] = 0.0
+    event["vector_store"] = vector_store
+    yield event
+
+def add_documents_to_vector_store(vector_store, pdf_paths, txt_paths):
+    """Embed only documents not already in the store and add their chunks, tagged with their document ID."""
+    for event in iter_ingest_documents(pdf_paths, txt_paths, vector_store):
+        if event["stage"] == "done":
+            vector_store = event["vector_store"]
+    return vector_store
+
+def remove_document_from_vector_store(vector_store, doc_id):
+    """Remove every chunk of one document from the store without re-embedding anything."""
+    if vector_store is None:
+        return vector_store
+    docs = {docstore_id: doc for docstore_id, doc in vector_store.docstore._dict.items()
+            if doc.metadata.get("doc_id") == doc_id}
+    ids = list(docs)
+    if ids:
+        _detach_shared_store(vector_store)
+        _remove_from_lexical_index(vector_store, [doc.metadata.get("chunk_id", docstore_id)
+                                                  for docstore_id, doc in docs.items()])
+        if isinstance(vector_store.index, faiss.IndexFlat):
+            vector_store.delete(ids)
+        else:
+            # ANN indexes don't compact ids on removal, so rebuild from the remaining vectors
+            _rebuild_index_without(vector_store, set(ids))
+        _on_vector_store_changed(vector_store)
+        logging.info(f"Removed {len(ids)} chunks of document {doc_id[:12]}")
+    return vector_store
+
+def load_index_params():
+    """Index parameters: defaults overlaid with whatever tune_index.py last saved."""
+    params = dict(DEFAULT_INDEX_PARAMS)
+    try:
+        with open(INDEX_PARAMS_FILE, "r", encoding="utf-8") as f:
+            params.update(json.load(f))
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logging.warning(f"Ignoring unreadable index parameters in {INDEX_PARAMS_FILE}: {e}")
+    return params
+
+def save_index_params(params):
+    os.makedirs(os.path.dirname(INDEX_PARAMS_FILE) or ".", exist_ok=True)
+    with open(INDEX_PARAMS_FILE, "w", encoding="utf-8") as f:
+        json.dump(params, f, indent=2)
+    logging.info(f"Saved index parameters to {INDEX_PARAMS_FILE}")
+
+def choose_index_type(num_vectors, params=None):
+    if INDEX_TYPE != "auto":
+        return INDEX_TYPE
+    if num_vectors < ANN_MIN_VECTORS:
+        return "flat"
+    params = load_index_params() if params is None else params
+    return params.get("ann_index_type", ANN_INDEX_TYPE)
+
+def _uses_compact_storage(params):
+    return params.get("storage", INDEX_STORAGE) != "float32" or params.get("binary_prefilter", INDEX_BINARY_PREFILTER)
+
+def build_faiss_index(vectors, index_type=None, params=None):
+    """Build and fill a FAISS index for these vectors, picking the index type by corpus size.
+
+    storage (fp16/int8) keeps scalar-quantised vectors instead of float32; binary_prefilter
+    (flat indexes only) scans compact LSH codes and re-ranks the best candidates with the stored vectors.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    num_vectors, dim = vectors.shape
+    params = load_index_params() if params is None else {**DEFAULT_INDEX_PARAMS, **params}
+    index_type = index_type or choose_index_type(num_vectors, params)
+    use_pq = params.get("pq", INDEX_USE_PQ) and dim % params["pq_m"] == 0
+    storage = params.get("storage", INDEX_STORAGE)
+    qtype = getattr(faiss.ScalarQuantizer, SCALAR_QUANTIZER_TYPES[storage]) if storage in SCALAR_QUANTIZER_TYPES else None
+
+    if index_type == "ivf":
+        # Keep ~39+ training points per list, as FAISS recommends
+        nlist = int(params["nlist_factor"] * math.sqrt(num_vectors))
+        nlist = max(1, min(nlist, num_vectors // 39))
+        quantizer = faiss.IndexFlatL2(dim)
+        if use_pq:
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, params["pq_m"], 8)
+        elif qtype is not None:
+            index = faiss.IndexIVFScalarQuantizer(quantizer, dim, nlist, qtype, faiss.METRIC_L2)
+        else:
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist)
+        index.train(vectors)
+        index.nprobe = min(params["nprobe"], nlist)
+    elif index_type == "hnsw":
+        if use_pq:
+            index = faiss.IndexHNSWPQ(dim, params["pq_m"], params["M"])
+            index.train(vectors)
+        elif qtype is not None:
+            index = faiss.IndexHNSWSQ(dim, qtype, params["M"])
+            index.train(vectors)
+        else:
+            index = faiss.IndexHNSWFlat(dim, params["M"])
+        index.hnsw.efConstruction = params["efConstruction"]
+        index.hnsw.efSearch = params["efSearch"]
+    else:
+        index = faiss.IndexFlatL2(dim) if qtype is None else faiss.IndexScalarQuantizer(dim, qtype, faiss.METRIC_L2)
+        if params.get("binary_prefilter", INDEX_BINARY_PREFILTER):
+            prefilter = faiss.IndexLSH(dim, int(params["lsh_bits_per_dim"] * dim), True, True)
+            index = faiss.IndexRefine(prefilter, index)
+            index.k_factor = params["refine_k_factor"]
+        index.train(vectors)
+    index.add(vectors)
+    return index
+
+def _get_store_vectors(vector_store, positions=None):
+    """Full-precision vectors for the given index positions (all by default), in order."""
+    if positions is None:
+        positions = range(vector_store.index.ntotal)
+    positions = list(positions)
+    if isinstance(vector_store.index, faiss.IndexFlat):
+        return vector_store.index.reconstruct_n(0, vector_store.index.ntotal)[positions]
+    # ANN indexes may only hold compressed codes; the embedding cache has the exact vectors
+    texts = [vector_store.docstore.search(vector_store.index_to_docstore_id[p]).page_content for p in positions]
+    return np.asarray(embed_documents_cached(texts), dtype=np.float32)
+
+def _rebuild_index_without(vector_store, removed_ids):
+    keep = [(p, docstore_id) for p, docstore_id in sorted(vector_store.index_to_docstore_id.items())
+            if docstore_id not in removed_ids]
+    if keep:
+        vectors = _get_store_vectors(vector_store, [p for p, _ in keep])
+        vector_store.index = build_faiss_index(vectors)
+    else:
+        vector_store.index = faiss.IndexFlatL2(vector_store.index.d)
+    vector_store.index_to_docstore_id = {i: docstore_id for i, (_, docstore_id) in enumerate(keep)}
+    vector_store.docstore.delete(list(removed_ids))
+
+def optimize_vector_store_index(vector_store):
+    """Swap a float32 flat index for an ANN index once the corpus is large enough, or for compact storage."""
+    if vector_store is None or not isinstance(vector_store.index, faiss.IndexFlat):
+        return vector_store
+    num_vectors = vector_store.index.ntotal
+    params = load_index_params()
+    index_type = choose_index_type(num_vectors, params)
+    if index_type == "flat" and not _uses_compact_storage(params):
+        return vector_store
+    started = time.monotonic()
+    vector_store.index = build_faiss_index(_get_store_vectors(vector_store), index_type, params)
+    _on_vector_store_changed(vector_store)
+    logging.info(f"Built {index_type} index over {num_vectors} vectors in {time.monotonic() - started:.1f}s")
+    return vector_store
+
+def list_indexed_documents(vector_store):
+    """List the documents in a store as dicts with doc_id, source and chunk count."""
+    if vector_store is None:
+        return []
+    documents = {}
+    for doc in vector_store.docstore._dict.values():
+        doc_id = doc.metadata.get("doc_id")
+        if doc_id is None:
+            continue
+        entry = documents.setdefault(doc_id, {"doc_id": doc_id, "source": doc.metadata.get("source", ""), "chunks": 0})
+        entry["chunks"] += 1
+    return list(documents.values())
+
+def _on_vector_store_changed(vector_store):
+    """Forget derived state (scoped-search tables, fingerprint) after documents are added or removed."""
+    if vector_store is not None:
+        _chunk_scopes.pop(vector_store.index, None)
+        _store_fingerprints.pop(vector_store, None)
+
+def get_vector_store_fingerprint(vector_store):
+    """Fingerprint of a store's content: its document IDs plus the chunking/embedding/index parameters.
+
+    Chunks without a document ID (stores built by get_vector_store_from_texts) are covered
+    by a hash of their text, so different text-built stores never share a fingerprint.
+    """
+    fingerprint = _store_fingerprints.get(vector_store)
+    if fingerprint is None:
+        positions = sorted(vector_store.index_to_docstore_id)
+        docs = [vector_store.docstore._dict.get(vector_store.index_to_docstore_id[p]) for p in positions]
+        untagged = [doc.page_content for doc in docs if doc is not None and doc.metadata.get("doc_id") is None]
+        payload = {
+            "version": INDEX_CACHE_VERSION,
+            "doc_ids": sorted(doc["doc_id"] for doc in list_indexed_documents(vector_store)),
+            "texts": _fingerprint_texts(untagged) if untagged else None,
+            "chunk_size": CHUNK_SIZE,
+            "chunk_overlap": CHUNK_OVERLAP,
+            "embedding_model": EMBEDDING_MODEL_NAME,
+            "index": _index_settings(),
+        }
+        fingerprint = hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+        _store_fingerprints[vector_store] = fingerprint
+    return fingerprint
+
+def _get_chunk_scopes(vector_store):
+    """Document ID and page span of every index position, for scoped search; cached per FAISS index.
+
+    Only metadata is kept: scoped queries search the main index restricted to the
+    positions in scope, so no vectors are copied. Every session handle on a shared
+    index uses the same table.
+    """
+    scopes = _chunk_scopes.get(vector_store.index)
+    if scopes is not None:
+        return scopes
+    with _chunk_scopes_lock:
+        scopes = _chunk_scopes.get(vector_store.index)
+        if scopes is not None:
+            return scopes
+        positions = np.array(sorted(vector_store.index_to_docstore_id), dtype=np.int64)
+        docs = [vector_store.docstore._dict.get(vector_store.index_to_docstore_id[p]) for p in positions]
+        metadatas = [doc.metadata if doc is not None else {} for doc in docs]
+        scopes = {
+            "positions": positions,
+            "doc_ids": [metadata.get("doc_id") for metadata in metadatas],
+            "first_page": np.array([metadata.get("page", 1) for metadata in metadatas], dtype=np.int64),
+            "last_page": np.array([metadata.get("page_end", metadata.get("page", 1)) for metadata in metadatas],
+                                  dtype=np.int64),
+        }
+        _chunk_scopes[vector_store.index] = scopes
+        return scopes
+
+def _scoped_positions(vector_store, doc_ids, pages):
+    scopes = _get_chunk_scopes(vector_store)
+    mask = np.ones(len(scopes["positions"]), dtype=bool)
+    if doc_ids:
+        wanted = set(doc_ids)
+        mask &= np.fromiter((doc_id in wanted for doc_id in scopes["doc_ids"]), dtype=bool, count=len(mask))
+    if pages:
+        first, last = pages
+        mask &= (scopes["first_page"] <= last) & (scopes["last_page"] >= first)
+    return scopes["positions"][mask]
+
+def _selector_params(index, selector, k):
+    """Search parameters restricting this index type to the selector's IDs."""
+    if isinstance(index, faiss.IndexIVF):
+        # Probe every list: a small scope may sit in lists the usual nprobe would skip
+        return faiss.SearchParametersIVF(sel=selector, nprobe=index.nlist)
+    if isinstance(index, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=max(index.hnsw.efSearch, k))
+    return faiss.SearchParameters(sel=selector)
+
+def _search_positions(index, query_vector, k, positions):
+    """Search the main index restricted to some positions; returns [(distance, position)], nearest first.
+
+    Uses a FAISS ID selector where the index type supports one, else over-fetches from the
+    whole index and filters, doubling the fetch until enough in-scope hits turn up.
+    """
+    k = min(k, len(positions))
+    if k == 0:
+        return []
+    query_vector = np.ascontiguousarray(query_vector, dtype=np.float32).reshape(1, -1)
+    hits = []
+    try:
+        selector = faiss.IDSelectorBatch(len(positions), faiss.swig_ptr(positions))
+        distances, found = index.search(query_vector, k, params=_selector_params(index, selector, k))
+        hits = [(float(d), int(p)) for d, p in zip(distances[0], found[0]) if p >= 0]
+    except Exception as e:
+        logging.debug(f"No ID selector support for {type(index).__name__}, filtering after the search: {e}")
+    if len(hits) >= k:
+        return hits
+    in_scope = set(positions.tolist())
+    fetch_k = min(index.ntotal, 4 * k)
+    while True:
+        distances, found = index.search(query_vector, fetch_k)
+        hits = [(float(d), int(p)) for d, p in zip(distances[0], found[0]) if p >= 0 and int(p) in in_scope]
+        if len(hits) >= k or fetch_k >= index.ntotal:
+            return hits[:k]
+        fetch_k = min(index.ntotal, fetch_k * 2)
+
+def _page_in_range(doc, pages):
+    first, last = pages
+    return doc.metadata.get("page", 1) <= last and doc.metadata.get("page_end", doc.metadata.get("page", 1)) >= first
+
+class MicroBatcher:
+    """Collect calls from many threads for a short window and run them as one batch.
+
+    Calls are grouped by key (e.g. one group per index); process_batch(items) gets the items
+    of one group and returns one result per item. A background thread collects calls, and
+    each group's batch runs on a small thread pool, so batches for different keys don't
+    wait behind each other while each key's calls still grow into larger batches under load.
+    A window of 0 runs every call directly.
+    """
+
+    def __init__(self, name, process_batch, window_ms, max_batch):
+        self.name = name
+        self._process_batch = process_batch
+        self._window = window_ms / 1000.0
+        self._max_batch = max(max_batch, 1)
+        self._pending = queue.Queue()
+        self._thread = None
+        self._executor = None
+        self._lock = threading.Lock()
+        self._stats = {"calls": 0, "batches": 0, "largest_batch": 0}
+
+    def submit(self, key, item):
+        if self._window <= 0:
+            self._record(1)
+            return self._process_batch([item])[0]
+        request = {"key": key, "item": item, "done": threading.Event(), "result": None, "error": None}
+        self._start()
+        self._pending.put(request)
+        request["done"].wait()
+        if request["error"] is not None:
+            raise request["error"]
+        return request["result"]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["mean_batch"] = stats["calls"] / stats["batches"] if stats["batches"] else 0.0
+        return stats
 
-    # Combine all document content
-    context_text = "\n\n".join([doc.page_content for doc in docs])
+    def _record(self, size):
+        with self._lock:
+            self._stats["calls"] += size
+            self._stats["batches"] += 1
+            self._stats["largest_batch"] = max(self._stats["largest_batch"], size)
 
-    # Simple keyword-based relevance scoring
-    question_words = set(question.lower().split())
+    def _start(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    # A few threads even on one core, so a slow batch can't hold up other keys
+                    self._executor = ThreadPoolExecutor(max_workers=max(CPU_WORKERS, 4),
+                                                        thread_name_prefix=f"studymate-{self.name}-batch")
+                    self._thread = threading.Thread(target=self._run, name=f"studymate-{self.name}-batcher",
+                                                    daemon=True)
+                    self._thread.start()
 
-    # Split context into sentences
+    def _run(self):
+        while True:
+            batch = [self._pending.get()]
+            deadline = time.monotonic() + self._window
+            while len(batch) < self._max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            groups = {}
+            for request in batch:
+                groups.setdefault(request["key"], []).append(request)
+            for requests in groups.values():
+                self._executor.submit(self._run_group, requests)
+
+    def _run_group(self, requests):
+        self._record(len(requests))
+        try:
+            results = self._process_batch([request["item"] for request in requests])
+            for request, result in zip(requests, results):
+                request["result"] = result
+        except Exception as e:
+            logging.error(f"Batched {self.name} failed for {len(requests)} calls: {e}")
+            for request in requests:
+                request["error"] = e
+        finally:
+            for request in requests:
+                request["done"].set()
+
+def _embed_query_batch(items):
+    """One forward pass for many questions that share an embedding model."""
+    embedding_function = items[0][0]
+    vectors = embedding_function.embed_documents([query for _, query in items])
+    return [np.array(vector, dtype=np.float32) for vector in vectors]
+
+def _search_index_batch(items):
+    """One FAISS search for many query vectors against the same store."""
+    vector_store = items[0][0]
+    max_k = max(k for _, _, k in items)
+    query_vectors = np.stack([query_vector for _, query_vector, _ in items]).astype(np.float32)
+    distances, positions = vector_store.index.search(query_vectors, max_k)
+    results = []
+    for (_, _, k), row_distances, row_positions in zip(items, distances, positions):
+        docs = []
+        for distance, position in zip(row_distances[:k], row_positions[:k]):
+            if position < 0:
+                continue
+            doc = vector_store.docstore.search(vector_store.index_to_docstore_id[int(position)])
+            docs.append((doc, float(distance)))
+        results.append(docs)
+    return results
+
+_query_embedder = MicroBatcher("embedding", _embed_query_batch, QUERY_BATCH_WINDOW_MS, QUERY_BATCH_MAX)
+_index_searcher = MicroBatcher("search", _search_index_batch, QUERY_BATCH_WINDOW_MS, QUERY_BATCH_MAX)
+
+def get_query_batching_stats():
+    """Return call and batch counts for the shared query embedder and index searcher."""
+    return {"embedding": _query_embedder.stats(), "search": _index_searcher.stats()}
+
+def embed_query(vector_store, query):
+    """Embed a question once so retrieval and the answer cache can share the vector.
+
+    Questions arriving together from different sessions are embedded in one batch.
+    """
+    embedding_function = vector_store.embedding_function
+    with timed_stage("query_embedding"):
+        return _query_embedder.submit(id(embedding_function), (embedding_function, query))
+
+def search_documents(vector_store, query, k=10, doc_ids=None, pages=None, query_vector=None, hybrid=False,
+                     with_scores=False):
+    """Similarity search, optionally scoped to some documents and/or an inclusive (first, last) page range.
+
+    Scoped queries search the main index restricted to the chunks of the selected documents and pages.
+    Pass query_vector to reuse an embedding that was already computed for the query.
+    With hybrid=True, vector and BM25 rankings are merged with reciprocal rank fusion.
+    with_scores=True returns (doc, L2 distance) pairs; chunks found only by BM25 have distance None.
+    """
+    if hybrid:
+        results = _hybrid_search(vector_store, query, k, doc_ids, pages, query_vector)
+        return results if with_scores else [doc for doc, _ in results]
+    if query_vector is None:
+        query_vector = embed_query(vector_store, query)
+    if not doc_ids and not pages:
+        # Searches of the same index from concurrent sessions (shared handles included) share one FAISS call
+        results = _index_searcher.submit(id(vector_store.index), (vector_store, query_vector, k))
+        return results if with_scores else [doc for doc, _ in results]
+
+    positions = _scoped_positions(vector_store, doc_ids, pages)
+    results = [(vector_store.docstore.search(vector_store.index_to_docstore_id[position]), distance)
+               for distance, position in _search_positions(vector_store.index, query_vector, k, positions)]
+    return results if with_scores else [doc for doc, _ in results]
+
+def _hybrid_search(vector_store, query, k, doc_ids, pages, query_vector):
+    vector_results = search_documents(vector_store, query, k=2 * k, doc_ids=doc_ids, pages=pages,
+                                      query_vector=query_vector, with_scores=True)
+    lexical_index = get_lexical_index(vector_store)
+
+    def chunk_doc(chunk_id):
+        return vector_store.docstore._dict.get(lexical_index["docstore_ids"].get(chunk_id))
+
+    def in_scope(chunk_id):
+        doc = chunk_doc(chunk_id)
+        if doc is None:
+            return False
+        if doc_ids and doc.metadata.get("doc_id") not in doc_ids:
+            return False
+        return not pages or _page_in_range(doc, pages)
+
+    fused = {}
+    for ranking in (
+        [(doc.metadata.get("chunk_id", id(doc)), doc, distance) for doc, distance in vector_results],
+        [(chunk_id, chunk_doc(chunk_id), None)
+         for chunk_id, _ in bm25_search(lexical_index, query, 2 * k, in_scope)],
+    ):
+        for rank, (key, doc, distance) in enumerate(ranking):
+            score, _, known_distance = fused.get(key, (0.0, doc, None))
+            fused[key] = (score + 1.0 / (HYBRID_RRF_K + rank + 1), doc,
+                          distance if known_distance is None else known_distance)
+    ranked = sorted(fused.values(), key=lambda item: item[0], reverse=True)
+    return [(doc, distance) for _, doc, distance in ranked[:k]]
+
+def _load_tokenizer():
+    global _tokenizer
+    try:
+        from transformers import AutoTokenizer
+        try:
+            _tokenizer = AutoTokenizer.from_pretrained(LLM_MODEL_ID, local_files_only=True)
+        except Exception:
+            _tokenizer = AutoTokenizer.from_pretrained(LLM_MODEL_ID)  # first run: download it once
+        logging.info(f"Loaded tokenizer for {LLM_MODEL_ID}")
+    except Exception as e:
+        logging.warning(f"Tokenizer for {LLM_MODEL_ID} unavailable, estimating token counts: {e}")
+        _tokenizer = False
+
+def _estimate_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+def count_tokens(text):
+    """Count prompt tokens with the answer model's tokenizer, estimating them until it has loaded.
+
+    The tokenizer loads on a background thread started by the first call, so no question
+    waits on it; if it can't be loaded, counts stay estimates.
+    """
+    global _tokenizer_loading
+    if _tokenizer is None and not _tokenizer_loading:
+        with _tokenizer_lock:
+            if not _tokenizer_loading:
+                _tokenizer_loading = True
+                threading.Thread(target=_load_tokenizer, name="studymate-tokenizer", daemon=True).start()
+    if _tokenizer:
+        return len(_tokenizer.encode(text, add_special_tokens=False))
+    return _estimate_tokens(text)
+
+def _merge_chunks(results):
+    """Merge overlapping or adjacent chunks of the same document into passages.
+
+    Takes (doc, similarity) pairs and returns (passage, similarity) pairs, where a passage's
+    similarity is that of its best chunk.
+    """
+    from langchain.schema import Document
+    by_document = {}
+    passages = []
+    for doc, similarity in results:
+        if doc.metadata.get("start_index") is None or doc.metadata.get("doc_id") is None:
+            passages.append((doc, similarity))
+        else:
+            by_document.setdefault(doc.metadata["doc_id"], []).append((doc, similarity))
+
+    for chunks in by_document.values():
+        chunks.sort(key=lambda item: item[0].metadata["start_index"])
+        text, metadata, best = None, None, None
+        for doc, similarity in chunks:
+            start, end = doc.metadata["start_index"], doc.metadata["end_index"]
+            if text is not None and start <= metadata["end_index"] + 1:
+                if start >= metadata["end_index"]:
+                    text += "\n" + doc.page_content
+                elif end > metadata["end_index"]:
+                    text += doc.page_content[metadata["end_index"] - start:]
+                metadata["end_index"] = max(end, metadata["end_index"])
+                metadata["page_end"] = max(doc.metadata.get("page_end", 1), metadata.get("page_end", 1))
+                metadata["chunk_ids"].append(doc.metadata.get("chunk_id"))
+                best = _max_similarity(best, similarity)
+                continue
+            if text is not None:
+                passages.append((Document(page_content=text, metadata=metadata), best))
+            text, best = doc.page_content, similarity
+            metadata = dict(doc.metadata, chunk_ids=[doc.metadata.get("chunk_id")])
+        passages.append((Document(page_content=text, metadata=metadata), best))
+    return passages
+
+def _max_similarity(a, b):
+    if a is None:
+        return b
+    return a if b is None else max(a, b)
+
+def _is_near_duplicate(words, kept_words):
+    # Jaccard rather than containment, so a short passage isn't dropped just because a long one uses its words
+    for other in kept_words:
+        overlap = len(words & other) / float(max(len(words | other), 1))
+        if overlap >= CONTEXT_DUPLICATE_SIMILARITY:
+            return True
+    return False
+
+def pack_context(results, token_budget=None):
+    """Turn (doc, L2 distance) search results into the passages that go into the prompt.
+
+    Chunks below the similarity threshold are dropped, overlapping and adjacent chunks are
+    merged, near-duplicate passages are skipped, and the best passages are added until the
+    token budget is full, so the number of passages adapts to how much relevant text there is.
+    """
+    from langchain.schema import Document
+    if token_budget is None:
+        token_budget = CONTEXT_TOKEN_BUDGET
+    if not results:
+        return []
+
+    # The embedding model returns unit vectors, so squared L2 distance maps to cosine as 1 - d / 2
+    scored = [(doc, None if distance is None else 1.0 - distance / 2.0) for doc, distance in results]
+    relevant = [(doc, sim) for doc, sim in scored if sim is None or sim >= CONTEXT_MIN_SIMILARITY]
+    if not relevant:
+        relevant = scored[:1]  # always answer from the best match rather than from nothing
+
+    # Best passages first; passages without a vector score (BM25-only hybrid hits) go last
+    passages = _merge_chunks(relevant)
+    passages.sort(key=lambda item: (item[1] is None, -(item[1] or 0.0)))
+
+    packed, kept_words, used_tokens = [], [], 0
+    for passage, _ in passages:
+        words = set(_tokenize(passage.page_content))
+        if _is_near_duplicate(words, kept_words):
+            continue
+        tokens = count_tokens(passage.page_content)
+        if used_tokens + tokens > token_budget:
+            if packed:
+                continue  # a shorter passage further down may still fit
+            # Never send an empty context: trim the best passage to the budget
+            passage = Document(page_content=passage.page_content[:token_budget * CHARS_PER_TOKEN],
+                               metadata=passage.metadata)
+            tokens = count_tokens(passage.page_content)
+        packed.append(passage)
+        kept_words.append(words)
+        used_tokens += tokens
+
+    # Estimated on both sides: tokenizing the baseline chunks only for this log line isn't worth it
+    baseline_tokens = sum(_estimate_tokens(doc.page_content) for doc, _ in results[:CONTEXT_BASELINE_K])
+    packed_estimate = sum(_estimate_tokens(passage.page_content) for passage in packed)
+    logging.info(f"Packed {len(results)} chunks into {len(packed)} passages: {used_tokens} tokens "
+                 f"(saved ~{baseline_tokens - packed_estimate} vs top-{CONTEXT_BASELINE_K} chunks)")
+    return packed
+
+def retrieve_context(vector_store, query, doc_ids=None, pages=None, query_vector=None, hybrid=False):
+    """Retrieve candidate chunks and pack them into a token-budgeted context."""
+    with timed_stage("search"):
+        results = search_documents(vector_store, query, k=CONTEXT_FETCH_K, doc_ids=doc_ids, pages=pages,
+                                   query_vector=query_vector, hybrid=hybrid, with_scores=True)
+    with timed_stage("context_packing"):
+        return pack_context(results)
+
+def format_sources(docs):
+    """Summarise which files and pages a set of retrieved chunks came from."""
+    pages_by_source = {}
+    for doc in docs:
+        source = doc.metadata.get("source")
+        if source:
+            page = doc.metadata.get("page")
+            page_end = doc.metadata.get("page_end") or page
+            pages = range(page, page_end + 1) if isinstance(page, int) and isinstance(page_end, int) else [page]
+            pages_by_source.setdefault(source, set()).update(pages)
+    parts = []
+    for source, pages in pages_by_source.items():
+        page_list = sorted(p for p in pages if p)
+        if source.lower().endswith(".pdf") and page_list:
+            parts.append(f"{source} (p. {', '.join(str(p) for p in page_list)})")
+        else:
+            parts.append(source)
+    return "; ".join(parts)
+
+def iter_vector_store_for_files(pdf_paths, txt_paths, vector_store=None):
+    """Progress-event version of get_vector_store_for_files; the final event carries vector_store.
+
+    A fresh build is written to the disk cache right away; an incremental update of
+    vector_store is written later, once the session stops adding files.
+    """
+    fingerprint = fingerprint_files(pdf_paths, txt_paths)
+    cached_store = acquire_shared_index(fingerprint)
+    if cached_store is not None:
+        with _index_cache_lock:
+            _index_cache_stats["hits"] += 1
+            _index_cache_stats["memory_hits"] += 1
+    else:
+        cached_store = share_vector_store(fingerprint, load_cached_vector_store(fingerprint))
+    if cached_store is not None:
+        yield {"stage": "done", "cached": True, "pages_done": 0, "pages_total": 0, "chunks_embedded": 0,
+               "fraction": 1.0, "eta_seconds": 0.0, "vector_store": cached_store}
+        return
+
+    incremental = vector_store is not None
+    if incremental:
+        # Drop documents that are no longer part of the upload set
+        wanted_ids = {get_document_id(p) for p in list(pdf_paths) + list(txt_paths)}
+        for doc in list_indexed_documents(vector_store):
+            if doc["doc_id"] not in wanted_ids:
+                remove_document_from_vector_store(vector_store, doc["doc_id"])
+
+    for event in iter_ingest_documents(pdf_paths, txt_paths, vector_store):
+        if event["stage"] == "done":
+            vector_store = event["vector_store"]
+            if vector_store is None or vector_store.index.ntotal == 0:
+                event["vector_store"] = None
+            elif incremental:
+                event["vector_store"] = share_vector_store(fingerprint, vector_store, persist=False)
+                _schedule_cache_save(fingerprint)
+            else:
+                save_vector_store_to_cache(fingerprint, vector_store)
+                event["vector_store"] = share_vector_store(fingerprint, vector_store)
+        yield event
+
+def get_vector_store_for_files(pdf_paths, txt_paths, vector_store=None):
+    """Build the vector store for an upload set, reusing the cached index or updating vector_store in place."""
+    for event in iter_vector_store_for_files(pdf_paths, txt_paths, vector_store):
+        if event["stage"] == "done":
+            return event["vector_store"]
+    return None
+
+def _tokenize(text):
+    return text.lower().split()
+
+def _split_sentences(text):
     sentences = []
-    for text in context_text.split('.'):
-        sentence = text.strip()
-        if len(sentence) > 20:  # Filter out very short fragments
+    for fragment in text.split('.'):
+        sentence = fragment.strip()
+        if len(sentence) > MIN_SENTENCE_CHARS:  # Filter out very short fragments
             sentences.append(sentence)
+    return sentences
+
+def _new_lexical_index():
+    return {"vocab": {}, "chunks": {}, "postings": {}, "docstore_ids": {}, "total_length": 0}
+
+def _embed_sentences(texts):
+    """Embed every sentence of these chunks in one batch for semantic extraction; one unit-row array per chunk."""
+    chunk_sentences = [_split_sentences(text) for text in texts]
+    flat = [sentence for sentences in chunk_sentences for sentence in sentences]
+    if not flat:
+        return [None] * len(texts)
+    vectors = np.asarray(get_embeddings().embed_documents(flat), dtype=np.float32)
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    per_chunk, offset = [], 0
+    for sentences in chunk_sentences:
+        per_chunk.append(vectors[offset:offset + len(sentences)] if sentences else None)
+        offset += len(sentences)
+    return per_chunk
+
+def _index_chunk(lexical_index, chunk_id, text, docstore_id=None, sentence_vectors=None):
+    """Segment and tokenise one chunk: sentence term rows (CSR layout) for extraction, term counts for BM25.
+
+    docstore_id maps the chunk back to its document in the store, so BM25 hits resolve without a scan.
+    sentence_vectors (from _embed_sentences) are kept for semantic extraction.
+    """
+    vocab = lexical_index["vocab"]
+    sentences = _split_sentences(text)
+    sentence_terms = [sorted({vocab.setdefault(term, len(vocab)) for term in _tokenize(sentence)})
+                      for sentence in sentences]
+    sentence_indptr = np.zeros(len(sentences) + 1, dtype=np.int64)
+    sentence_indptr[1:] = np.cumsum([len(terms) for terms in sentence_terms])
+    sentence_indices = np.fromiter((t for terms in sentence_terms for t in terms), dtype=np.int64,
+                                   count=int(sentence_indptr[-1]))
+    tokens = _tokenize(text)
+    term_counts = {}
+    for term in tokens:
+        term_id = vocab.setdefault(term, len(vocab))
+        term_counts[term_id] = term_counts.get(term_id, 0) + 1
+    for term_id, count in term_counts.items():
+        lexical_index["postings"].setdefault(term_id, {})[chunk_id] = count
+    lexical_index["chunks"][chunk_id] = {
+        "sentences": sentences,
+        "sentence_indptr": sentence_indptr,
+        "sentence_indices": sentence_indices,
+        "terms": list(term_counts),
+        "length": len(tokens),
+    }
+    if sentence_vectors is not None:
+        lexical_index["chunks"][chunk_id]["sentence_vectors"] = sentence_vectors
+    lexical_index["total_length"] += len(tokens)
+    if docstore_id is not None:
+        lexical_index["docstore_ids"][chunk_id] = docstore_id
+
+def _unindex_chunk(lexical_index, chunk_id):
+    entry = lexical_index["chunks"].pop(chunk_id, None)
+    lexical_index["docstore_ids"].pop(chunk_id, None)
+    if entry is None:
+        return
+    lexical_index["total_length"] -= entry["length"]
+    for term_id in entry["terms"]:
+        postings = lexical_index["postings"].get(term_id)
+        if postings is not None:
+            postings.pop(chunk_id, None)
+            if not postings:
+                del lexical_index["postings"][term_id]
+
+def get_lexical_index(vector_store):
+    """Return the store's lexical index, building it from the docstore if it wasn't built at ingestion."""
+    lexical_index = _lexical_indexes.get(vector_store)
+    if lexical_index is not None:
+        return lexical_index
+    with _lexical_lock:
+        lexical_index = _lexical_indexes.get(vector_store)
+        if lexical_index is None:
+            lexical_index = _new_lexical_index()
+            items = list(vector_store.docstore._dict.items())
+            vectors = (_embed_sentences([doc.page_content for _, doc in items]) if EXTRACTIVE_MODE == "semantic"
+                       else [None] * len(items))
+            for (docstore_id, doc), sentence_vectors in zip(items, vectors):
+                _index_chunk(lexical_index, doc.metadata.get("chunk_id", docstore_id), doc.page_content,
+                             docstore_id, sentence_vectors)
+            _lexical_indexes[vector_store] = lexical_index
+        return lexical_index
+
+def _add_to_lexical_index(vector_store, chunk_ids, texts, docstore_ids):
+    # Embedded before taking the lock, so other stores' lookups don't wait on the model
+    vectors = _embed_sentences(texts) if EXTRACTIVE_MODE == "semantic" else [None] * len(texts)
+    with _lexical_lock:
+        lexical_index = _lexical_indexes.get(vector_store)
+        if lexical_index is None:
+            if vector_store.index.ntotal != len(texts):
+                return  # pre-existing store without an index; built in full on first use
+            lexical_index = _lexical_indexes[vector_store] = _new_lexical_index()
+        for chunk_id, text, docstore_id, sentence_vectors in zip(chunk_ids, texts, docstore_ids, vectors):
+            _index_chunk(lexical_index, chunk_id, text, docstore_id, sentence_vectors)
 
-    # Score sentences based on question word overlap
-    scored_sentences = []
-    for sentence in sentences:
-        sentence_words = set(sentence.lower().split())
-        overlap = len(question_words.intersection(sentence_words))
-        if overlap > 0:
-            scored_sentences.append((overlap, sentence))
+def _remove_from_lexical_index(vector_store, chunk_ids):
+    with _lexical_lock:
+        lexical_index = _lexical_indexes.get(vector_store)
+        if lexical_index is not None:
+            for chunk_id in chunk_ids:
+                _unindex_chunk(lexical_index, chunk_id)
 
-    # Sort by relevance and take top sentences
-    scored_sentences.sort(reverse=True, key=lambda x: x[0])
-    top_sentences = [sent[1] for sent in scored_sentences[:3]]
+def bm25_search(lexical_index, query, k=10, chunk_filter=None):
+    """Rank chunks by BM25 over the precomputed postings; returns [(chunk_id, score)], best first."""
+    chunks = lexical_index["chunks"]
+    if not chunks:
+        return []
+    avg_length = lexical_index["total_length"] / len(chunks)
+    scores = {}
+    for term in set(_tokenize(query)):
+        term_id = lexical_index["vocab"].get(term)
+        postings = lexical_index["postings"].get(term_id) if term_id is not None else None
+        if not postings:
+            continue
+        idf = math.log(1 + (len(chunks) - len(postings) + 0.5) / (len(postings) + 0.5))
+        for chunk_id, count in postings.items():
+            if chunk_filter is not None and not chunk_filter(chunk_id):
+                continue
+            norm = count + BM25_K1 * (1 - BM25_B + BM25_B * chunks[chunk_id]["length"] / avg_length)
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * count * (BM25_K1 + 1) / norm
+    return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+def _stack_sentences(chunk_entries, num_terms):
+    """Stack the chunks' sentence rows into one binary sentence x term matrix; repeated sentences are masked out."""
+    sentences = [sentence for entry in chunk_entries for sentence in entry["sentences"]]
+    lengths = np.concatenate([np.diff(entry["sentence_indptr"]) for entry in chunk_entries])
+    indices = np.concatenate([entry["sentence_indices"] for entry in chunk_entries])
+    indptr = np.concatenate([[0], np.cumsum(lengths)])
+    matrix = sparse.csr_matrix((np.ones(len(indices), dtype=np.float32), indices, indptr),
+                               shape=(len(sentences), num_terms))
+    # Overlapping chunks repeat sentences; keep the first occurrence of each
+    first_seen = {}
+    for i, sentence in enumerate(sentences):
+        first_seen.setdefault(sentence, i)
+    unique = np.fromiter(first_seen.values(), dtype=np.int64, count=len(first_seen))
+    return sentences, matrix, unique
+
+def _top_k_indices(scores, k):
+    """Indices of the k highest positive scores, best first; ties keep document order."""
+    candidates = np.flatnonzero(scores > 0)
+    if len(candidates) > k:
+        # Partial selection: only the candidates at or above the k-th best score are ordered
+        kth_best = np.partition(scores[candidates], len(candidates) - k)[len(candidates) - k]
+        candidates = candidates[scores[candidates] >= kth_best]
+    order = np.lexsort((candidates, -scores[candidates]))
+    return candidates[order][:k]
+
+def _score_sentences(lexical_index, chunk_entries, question, query_vector=None):
+    """Score every sentence of the retrieved chunks at once; returns (sentences, scores)."""
+    vocab = lexical_index["vocab"]
+    sentences, matrix, unique = _stack_sentences(chunk_entries, len(vocab))
+    scores = np.zeros(len(sentences), dtype=np.float32)
+    if not len(unique):
+        return sentences, scores
+
+    if query_vector is not None and EXTRACTIVE_MODE == "semantic":
+        with_sentences = [entry for entry in chunk_entries if entry["sentences"]]
+        if all(entry.get("sentence_vectors") is not None for entry in with_sentences):
+            # Sentence vectors were embedded and normalised at ingestion, so this is one matrix product
+            sentence_vectors = np.concatenate([entry["sentence_vectors"] for entry in with_sentences])
+            scores[unique] = sentence_vectors[unique] @ _normalise(np.asarray(query_vector, dtype=np.float32))
+            return sentences, scores
+        logging.debug("No sentence vectors for these chunks, ranking sentences lexically")
+
+    # Simple keyword-based relevance scoring: number of distinct question words in each sentence
+    question_terms = np.zeros(len(vocab), dtype=np.float32)
+    question_ids = [vocab[term] for term in set(_tokenize(question)) if term in vocab]
+    question_terms[question_ids] = 1.0
+    scores[unique] = (matrix @ question_terms)[unique]
+    return sentences, scores
+
+def create_simple_answer(docs, question, lexical_index=None, query_vector=None):
+    """Create a simple answer by extracting relevant text from documents.
+
+    With a lexical index the sentences and their terms come precomputed from ingestion;
+    otherwise the retrieved text is segmented and tokenised here. Pass the question's
+    embedding to rank sentences semantically when STUDYMATE_EXTRACTIVE_MODE=semantic; that
+    uses sentence vectors computed at ingestion and falls back to lexical ranking without them.
+    """
+    if not docs:
+        return "I couldn't find relevant information in your documents to answer this question."
+
+    chunk_entries = None
+    if lexical_index is not None:
+        chunk_entries = [lexical_index["chunks"].get(chunk_id) for doc in docs
+                         for chunk_id in doc.metadata.get("chunk_ids") or [doc.metadata.get("chunk_id")]]
+        if not all(chunk_entries):
+            chunk_entries = None
+    if chunk_entries is None:
+        lexical_index = _new_lexical_index()
+        for i, doc in enumerate(docs):
+            _index_chunk(lexical_index, i, doc.page_content)
+        chunk_entries = [lexical_index["chunks"][i] for i in range(len(docs))]
+
+    sentences, scores = _score_sentences(lexical_index, chunk_entries, question, query_vector)
+    top_sentences = [sentences[i] for i in _top_k_indices(scores, EXTRACTIVE_TOP_SENTENCES)]
 
     if top_sentences:
         answer = "Based on your study materials:\n\n" + "\n\n".join(top_sentences)
         return answer
     else:
+        context_text = "\n\n".join([doc.page_content for doc in docs])
         return f"I found some relevant content in your documents, but couldn't extract a specific answer to '{question}'. Here's some related information:\n\n{context_text[:500]}..."
 
-def get_conversational_chain():
-    """Create a conversational chain for Q&A using IBM Granite 13B Instruct model."""
-    prompt_template = """You are StudyMate, an AI academic assistant designed to help students understand their study materials.
+QA_PROMPT_TEMPLATE = """You are StudyMate, an AI academic assistant designed to help students understand their study materials.
 Use the following pieces of retrieved context from the uploaded documents to answer the question accurately and comprehensively.
 
 Instructions:
@@ -147,30 +2286,364 @@ Question: {question}
 StudyMate Answer:
 """
 
+def _configure_http_pool():
+    """Give huggingface_hub keep-alive sessions with a connection pool sized for concurrent sessions."""
     try:
-        # Using IBM Granite 13B Instruct model
-        model_id = "ibm/granite-13b-instruct-v2"
-        llm = HuggingFaceEndpoint(
-            repo_id=model_id,
-            huggingfacehub_api_token=HF_API_KEY,
-            temperature=0.3,
-            max_new_tokens=512,
-            top_p=0.9,
-            repetition_penalty=1.1
-        )
-        logging.info(f"Successfully loaded IBM Granite model: {model_id}")
+        import requests
+        from requests.adapters import HTTPAdapter
+        from huggingface_hub import configure_http_backend
+    except ImportError:
+        return
 
-        prompt = PromptTemplate(template=prompt_template, input_variables=["context", "question"])
-        return load_qa_chain(llm, chain_type="stuff", prompt=prompt)
+    def backend_factory():
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=LLM_HTTP_POOL_SIZE, pool_maxsize=LLM_HTTP_POOL_SIZE)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
 
+    configure_http_backend(backend_factory=backend_factory)
+
+def _ensure_hf_login():
+    """Authenticate with Hugging Face the first time a remote model is needed."""
+    global _hf_logged_in
+    if _hf_logged_in:
+        return True
+    if not HF_API_KEY:
+        logging.error("Hugging Face API key not found.")
+        return False
+    try:
+        from huggingface_hub import login
+        login(token=HF_API_KEY)
+        _hf_logged_in = True
+        logging.info("Hugging Face authentication successful.")
     except Exception as e:
-        logging.error(f"Failed to load IBM Granite model: {e}")
-        # Fallback to simple text processing if model fails
-        logging.warning("Falling back to simple text processing")
+        logging.error(f"Hugging Face login failed. Error: {e}")
+    return _hf_logged_in
+
+def _build_qa_chain(llm):
+    from langchain.prompts import PromptTemplate
+    from langchain.chains.question_answering import load_qa_chain
+    prompt = PromptTemplate(template=QA_PROMPT_TEMPLATE, input_variables=["context", "question"])
+    return load_qa_chain(llm, chain_type="stuff", prompt=prompt)
+
+def set_conversational_llm(llm):
+    """Answer with llm instead of the Hugging Face endpoint (e.g. a local stub); None restores the endpoint."""
+    global _qa_chain, _llm_override, _llm_failed_at
+    with _llm_lock:
+        _llm_override = llm
+        _qa_chain = None
+        _llm_failed_at = float("-inf")
+    clear_answer_cache()
+
+def get_conversational_chain():
+    """Return the process-wide Q&A chain for the IBM Granite 13B Instruct model, building it on first use.
+
+    Returns None if the model can't be loaded (including a missing or rejected API key);
+    a new attempt is made after LLM_RETRY_SECONDS.
+    """
+    global _qa_chain, _llm_failed_at
+    if _qa_chain is not None:
+        return _qa_chain
+    with _llm_lock:
+        if _qa_chain is not None:
+            return _qa_chain
+        if _llm_override is not None:
+            _qa_chain = _build_qa_chain(_llm_override)
+            return _qa_chain
+        if time.monotonic() - _llm_failed_at < LLM_RETRY_SECONDS:
+            return None
+        if not LLM_ENDPOINT_URL and not _ensure_hf_login():
+            _llm_failed_at = time.monotonic()
+            logging.warning("Falling back to simple text processing")
+            return None
+        try:
+            from langchain_huggingface import HuggingFaceEndpoint
+            _configure_http_pool()
+            target = {"endpoint_url": LLM_ENDPOINT_URL} if LLM_ENDPOINT_URL else {"repo_id": LLM_MODEL_ID}
+            llm = HuggingFaceEndpoint(
+                **target,
+                huggingfacehub_api_token=HF_API_KEY,
+                temperature=0.3,
+                max_new_tokens=512,
+                top_p=0.9,
+                repetition_penalty=1.1
+            )
+            logging.info(f"Successfully loaded IBM Granite model: {LLM_ENDPOINT_URL or LLM_MODEL_ID}")
+
+            _qa_chain = _build_qa_chain(llm)
+            return _qa_chain
+
+        except Exception as e:
+            _llm_failed_at = time.monotonic()
+            logging.error(f"Failed to load IBM Granite model: {e}")
+            # Fallback to simple text processing if model fails
+            logging.warning("Falling back to simple text processing")
+            return None
+
+def get_llm():
+    """Return the shared LLM behind the Q&A chain, or None if it is unavailable."""
+    chain = get_conversational_chain()
+    return chain.llm_chain.llm if chain is not None else None
+
+def reset_conversational_chain():
+    """Drop the shared chain so the next question reconnects to the endpoint."""
+    global _qa_chain
+    with _llm_lock:
+        _qa_chain = None
+    logging.info("Reset shared LLM chain, will reconnect on next question")
+
+class ConcurrencyLimiter:
+    """A counting semaphore that threads and coroutines on any event loop can share.
+
+    Use `with limiter:` from threads and `async with limiter:` from coroutines; waiting
+    coroutines don't block their loop. Slots are handed out first come, first served.
+    """
+
+    def __init__(self, slots):
+        self._slots = slots
+        self._lock = threading.Lock()
+        self._waiters = deque()  # threading.Event for threads, (loop, future) for coroutines
+
+    def acquire(self):
+        with self._lock:
+            if self._slots > 0 and not self._waiters:
+                self._slots -= 1
+                return
+            event = threading.Event()
+            self._waiters.append(event)
+        event.wait()
+
+    async def aacquire(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._slots > 0 and not self._waiters:
+                self._slots -= 1
+                return
+            waiter = (loop, loop.create_future())
+            self._waiters.append(waiter)
+        try:
+            await waiter[1]
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    raise
+            # The slot was handed over as we were cancelled; pass it on
+            if waiter[1].done() and not waiter[1].cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        with self._lock:
+            while self._waiters:
+                waiter = self._waiters.popleft()
+                if isinstance(waiter, threading.Event):
+                    waiter.set()
+                    return
+                loop, future = waiter
+                if not loop.is_closed():
+                    loop.call_soon_threadsafe(self._grant, future)
+                    return
+            self._slots += 1
+
+    def _grant(self, future):
+        if future.cancelled():
+            self.release()
+        else:
+            future.set_result(None)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    async def __aenter__(self):
+        await self.aacquire()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+_llm_slots = ConcurrencyLimiter(LLM_CONCURRENCY)
+_cpu_slots = ConcurrencyLimiter(CPU_WORKERS)
+
+def _run_cpu(func, *args, **kwargs):
+    """Run CPU-bound question work (embedding, search, extraction) within the process-wide CPU limit.
+
+    The sync and streamed paths call this directly and the async path through _run_blocking,
+    so every session shares the same CPU_WORKERS slots.
+    """
+    with _cpu_slots:
+        return func(*args, **kwargs)
+
+def _get_cpu_executor():
+    global _cpu_executor
+    if _cpu_executor is None:
+        with _cpu_executor_lock:
+            if _cpu_executor is None:
+                _cpu_executor = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix="studymate-cpu")
+    return _cpu_executor
+
+async def _run_blocking(func, *args, **kwargs):
+    """Run blocking work (extraction, embedding, FAISS search) on the shared executor.
+
+    The executor is shared by all sessions and event loops, and each call takes a CPU slot
+    (_run_cpu), so async work and sync questions share one limit.
+    """
+    loop = asyncio.get_running_loop()
+    # Carry the caller's context along so stage timings land in the right question's breakdown
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(_get_cpu_executor(), functools.partial(context.run, _run_cpu, func, *args, **kwargs))
+
+def _answer_cache_key(vector_store, doc_ids, pages, hybrid=False):
+    scope = (tuple(sorted(doc_ids)) if doc_ids else None, tuple(pages) if pages else None, hybrid)
+    return (get_vector_store_fingerprint(vector_store), scope)
+
+def _normalise(vector):
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+def _lookup_cached_answer(cache_key, query_vector):
+    """Return the cached answer for the most similar earlier question, if it clears the threshold."""
+    now = time.monotonic()
+    query_vector = _normalise(query_vector)
+    with _answer_cache_lock:
+        for key in [k for k, entry in _answer_cache.items() if now - entry["created"] > ANSWER_CACHE_TTL]:
+            del _answer_cache[key]
+        candidates = [(key, entry) for key, entry in _answer_cache.items() if key[0] == cache_key]
+        if candidates:
+            similarities = np.stack([entry["vector"] for _, entry in candidates]) @ query_vector
+            best = int(np.argmax(similarities))
+            if similarities[best] >= ANSWER_CACHE_SIMILARITY:
+                key, entry = candidates[best]
+                _answer_cache.move_to_end(key)
+                _answer_cache_stats["hits"] += 1
+                return entry["answer"]
+        _answer_cache_stats["misses"] += 1
         return None
 
-def process_question(user_question, vector_store):
-    """Process a user question using the vector store and LLM chain."""
+def _store_cached_answer(cache_key, user_question, query_vector, answer):
+    with _answer_cache_lock:
+        _answer_cache[(cache_key, user_question.strip().lower())] = {
+            "vector": _normalise(query_vector),
+            "answer": answer,
+            "created": time.monotonic(),
+        }
+        while len(_answer_cache) > ANSWER_CACHE_MAX_ENTRIES:
+            _answer_cache.popitem(last=False)
+
+def get_answer_cache_stats():
+    """Return answer cache counters plus the current hit rate."""
+    with _answer_cache_lock:
+        stats = dict(_answer_cache_stats)
+        stats["entries"] = len(_answer_cache)
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+    return stats
+
+def clear_answer_cache():
+    with _answer_cache_lock:
+        _answer_cache.clear()
+
+def _join_flight(flight_key):
+    """Register interest in answering a question; returns (flight, is_leader)."""
+    with _answer_cache_lock:
+        flight = _answers_in_flight.get(flight_key)
+        if flight is not None:
+            return flight, False
+        flight = {"done": threading.Event(), "answer": None}
+        _answers_in_flight[flight_key] = flight
+        return flight, True
+
+def _coalesced_answer(flight, finished):
+    if finished and flight["answer"]:
+        with _answer_cache_lock:
+            _answer_cache_stats["coalesced"] += 1
+        return flight["answer"]
+    return None
+
+def _finish_flight(flight_key, flight):
+    flight["done"].set()
+    with _answer_cache_lock:
+        _answers_in_flight.pop(flight_key, None)
+
+def _extractive_answer(docs, user_question, lexical_index=None, query_vector=None):
+    increment_counter("extractive_answers_total")
+    with timed_stage("extractive_answer"):
+        return create_simple_answer(docs, user_question, lexical_index, query_vector)
+
+def _generate_answer(user_question, docs, lexical_index=None, query_vector=None):
+    """Answer from retrieved chunks; returns (answer, from_llm)."""
+    chain = get_conversational_chain()
+    if not chain:
+        logging.warning("No LLM chain available, using simple text extraction")
+        # Fallback to simple text-based response
+        return _run_cpu(_extractive_answer, docs, user_question, lexical_index, query_vector), False
+
+    # Generate response using the newer invoke method
+    try:
+        increment_counter("llm_calls_total")
+        with _llm_slots, timed_stage("llm_invoke"):
+            response = chain.invoke({"input_documents": docs, "question": user_question})
+        return response.get("output_text", "").strip(), True
+    except Exception as invoke_error:
+        increment_counter("llm_invoke_errors_total")
+        logging.warning(f"Invoke method failed, trying legacy call: {invoke_error}")
+        try:
+            # Fallback to legacy method if invoke fails
+            increment_counter("llm_legacy_calls_total")
+            with _llm_slots, timed_stage("llm_legacy_call"):
+                response = chain({"input_documents": docs, "question": user_question}, return_only_outputs=True)
+            return response.get("output_text", "").strip(), True
+        except Exception as legacy_error:
+            increment_counter("llm_errors_total")
+            logging.error(f"Both invoke and legacy methods failed: {legacy_error}")
+            reset_conversational_chain()
+            # Final fallback to simple text processing
+            return _run_cpu(_extractive_answer, docs, user_question, lexical_index, query_vector), False
+
+def _answer_question(user_question, vector_store, doc_ids, pages, query_vector, hybrid=False):
+    """Retrieve and answer; returns (answer, cacheable)."""
+    docs = _run_cpu(retrieve_context, vector_store, user_question, doc_ids=doc_ids, pages=pages,
+                    query_vector=query_vector, hybrid=hybrid)
+    if not docs:
+        logging.warning("No relevant documents found for the question")
+        return "I couldn't find relevant information in your uploaded documents to answer this question. Please try rephrasing your question or check if the information is available in your documents.", False
+
+    logging.info(f"Found {len(docs)} relevant passages")
+    answer, from_llm = _generate_answer(user_question, docs, get_lexical_index(vector_store), query_vector)
+    if not answer:
+        logging.warning("Empty response generated")
+        return "I'm having trouble generating a response. Please try rephrasing your question.", False
+
+    sources = format_sources(docs)
+    if sources:
+        answer += f"\n\nSources: {sources}"
+    # Only model answers are cached; extractive fallbacks should be retried once the model is back
+    return answer, from_llm
+
+def process_question(user_question, vector_store, doc_ids=None, pages=None, hybrid=None):
+    """Process a user question using the vector store and LLM chain.
+
+    doc_ids and pages (an inclusive (first, last) tuple) restrict retrieval to part of the corpus.
+    hybrid switches to lexical + vector retrieval (defaults to STUDYMATE_HYBRID_SEARCH).
+    Answers are served from the semantic answer cache when a close enough question was
+    already answered for the same index, and identical questions in flight share one LLM call.
+    Stage timings are recorded in the metrics; get_last_request_timings() returns them.
+    """
+    _begin_request_timings()
+    increment_counter("questions_total")
+    started = time.perf_counter()
+    try:
+        return _process_question(user_question, vector_store, doc_ids, pages, hybrid)
+    finally:
+        record_latency("question_total", time.perf_counter() - started)
+        _maybe_write_metrics()
+
+def _process_question(user_question, vector_store, doc_ids, pages, hybrid):
     if not vector_store:
         logging.warning("Vector store is not initialized")
         return "Please upload and process your documents first before asking questions."
@@ -181,39 +2654,258 @@ def process_question(user_question, vector_store):
     try:
         logging.info(f"Processing question: {user_question[:100]}...")
 
-        # Search for relevant documents
-        docs = vector_store.similarity_search(user_question, k=10)  # Increased the number of documents to consider
-        if not docs:
-            logging.warning("No relevant documents found for the question")
-            return "I couldn't find relevant information in your uploaded documents to answer this question. Please try rephrasing your question or check if the information is available in your documents."
+        query_vector = _run_cpu(embed_query, vector_store, user_question)
+        if hybrid is None:
+            hybrid = HYBRID_SEARCH
+        cache_key = _answer_cache_key(vector_store, doc_ids, pages, hybrid)
+        cached_answer = _lookup_cached_answer(cache_key, query_vector)
+        if cached_answer is not None:
+            logging.info("Answer served from cache")
+            return cached_answer
 
-        logging.info(f"Found {len(docs)} relevant document chunks")
+        # Single-flight: the first caller answers, identical concurrent questions wait for it
+        flight_key = (cache_key, user_question.strip().lower())
+        flight, is_leader = _join_flight(flight_key)
+        if not is_leader:
+            answer = _coalesced_answer(flight, flight["done"].wait(ANSWER_INFLIGHT_TIMEOUT))
+            if answer is not None:
+                return answer
 
-        # Create conversational chain
-        chain = get_conversational_chain()
-        if not chain:
-            logging.warning("No LLM chain available, using simple text extraction")
-            # Fallback to simple text-based response
-            answer = create_simple_answer(docs, user_question)
-        else:
-            # Generate response using the newer invoke method
-            try:
-                response = chain.invoke({"input_documents": docs, "question": user_question})
-                answer = response.get("output_text", "").strip()
-            except Exception as invoke_error:
-                logging.warning(f"Invoke method failed, trying legacy call: {invoke_error}")
-                try:
-                    # Fallback to legacy method if invoke fails
-                    response = chain({"input_documents": docs, "question": user_question}, return_only_outputs=True)
-                    answer = response.get("output_text", "").strip()
-                except Exception as legacy_error:
-                    logging.error(f"Both invoke and legacy methods failed: {legacy_error}")
-                    # Final fallback to simple text processing
-                    answer = create_simple_answer(docs, user_question)
-
-        if not answer:
-            logging.warning("Empty response generated")
-            return "I'm having trouble generating a response. Please try rephrasing your question."
+        try:
+            answer, cacheable = _answer_question(user_question, vector_store, doc_ids, pages, query_vector, hybrid)
+            if cacheable:
+                _store_cached_answer(cache_key, user_question, query_vector, answer)
+            if is_leader:
+                flight["answer"] = answer
+        finally:
+            if is_leader:
+                _finish_flight(flight_key, flight)
+
+        logging.info("Successfully generated response")
+        return answer
+
+    except Exception as e:
+        logging.error(f"Error processing question: {e}")
+        traceback.print_exc()
+        return f"I encountered an error while processing your question. Please try again or contact support if the issue persists."
+
+def stream_question(user_question, vector_store, doc_ids=None, pages=None, hybrid=None):
+    """Streaming variant of process_question that yields answer text as the model produces it.
+
+    If the endpoint fails before or during generation, the remaining answer comes from
+    create_simple_answer instead. Identical questions in flight share one answer, as in
+    process_question; a waiting caller receives the finished text in one piece.
+    """
+    _begin_request_timings()
+    increment_counter("questions_total")
+    started = time.perf_counter()
+    try:
+        yield from _stream_question(user_question, vector_store, doc_ids, pages, hybrid)
+    finally:
+        record_latency("question_total", time.perf_counter() - started)
+        _maybe_write_metrics()
+
+def _stream_question(user_question, vector_store, doc_ids, pages, hybrid):
+    if not vector_store:
+        logging.warning("Vector store is not initialized")
+        yield "Please upload and process your documents first before asking questions."
+        return
+
+    if not user_question or len(user_question.strip()) < 3:
+        yield "Please provide a more detailed question."
+        return
+
+    try:
+        logging.info(f"Streaming answer for question: {user_question[:100]}...")
+        query_vector = _run_cpu(embed_query, vector_store, user_question)
+        if hybrid is None:
+            hybrid = HYBRID_SEARCH
+        cache_key = _answer_cache_key(vector_store, doc_ids, pages, hybrid)
+        cached_answer = _lookup_cached_answer(cache_key, query_vector)
+        if cached_answer is not None:
+            logging.info("Answer served from cache")
+            yield cached_answer
+            return
+    except Exception as e:
+        logging.error(f"Error processing question: {e}")
+        traceback.print_exc()
+        yield "I encountered an error while processing your question. Please try again or contact support if the issue persists."
+        return
+
+    # Single-flight, shared with process_question: a follower replays the leader's finished text
+    flight_key = (cache_key, user_question.strip().lower())
+    flight, is_leader = _join_flight(flight_key)
+    if not is_leader:
+        answer = _coalesced_answer(flight, flight["done"].wait(ANSWER_INFLIGHT_TIMEOUT))
+        if answer is not None:
+            yield answer
+            return
+
+    try:
+        pieces = []
+        for piece in _stream_answer(user_question, vector_store, doc_ids, pages, query_vector, hybrid, cache_key):
+            pieces.append(piece)
+            yield piece
+        if is_leader:
+            flight["answer"] = "".join(pieces)
+    except Exception as e:
+        logging.error(f"Error processing question: {e}")
+        traceback.print_exc()
+        yield "I encountered an error while processing your question. Please try again or contact support if the issue persists."
+    finally:
+        if is_leader:
+            _finish_flight(flight_key, flight)
+
+def _stream_answer(user_question, vector_store, doc_ids, pages, query_vector, hybrid, cache_key):
+    docs = _run_cpu(retrieve_context, vector_store, user_question, doc_ids=doc_ids, pages=pages,
+                    query_vector=query_vector, hybrid=hybrid)
+    if not docs:
+        logging.warning("No relevant documents found for the question")
+        yield "I couldn't find relevant information in your uploaded documents to answer this question. Please try rephrasing your question or check if the information is available in your documents."
+        return
+
+    logging.info(f"Found {len(docs)} relevant passages")
+    llm = get_llm()
+    streamed = False
+    completed = False
+    answer = ""
+    if llm is not None:
+        # Same prompt the "stuff" chain builds: chunks joined by blank lines
+        prompt = QA_PROMPT_TEMPLATE.format(
+            context="\n\n".join(doc.page_content for doc in docs),
+            question=user_question
+        )
+        increment_counter("llm_calls_total")
+        try:
+            with _llm_slots:
+                stream_started = time.perf_counter()
+                for token in llm.stream(prompt):
+                    if token:
+                        if not streamed:
+                            record_latency("llm_first_token", time.perf_counter() - stream_started)
+                        streamed = True
+                        answer += token
+                        yield token
+                record_latency("llm_stream", time.perf_counter() - stream_started)
+            completed = streamed
+        except Exception as stream_error:
+            increment_counter("llm_errors_total")
+            logging.error(f"Streaming from the model failed: {stream_error}")
+            reset_conversational_chain()
+    else:
+        logging.warning("No LLM chain available, using simple text extraction")
+
+    if not completed:
+        fallback = _run_cpu(_extractive_answer, docs, user_question, get_lexical_index(vector_store), query_vector)
+        if streamed:
+            if fallback.startswith(answer):
+                fallback = fallback[len(answer):]  # pick up where the partial answer stopped
+            else:
+                yield "\n\n_(Lost connection to the model, continuing from your study materials.)_\n\n"
+        yield fallback
+
+    sources = format_sources(docs)
+    if sources:
+        yield f"\n\nSources: {sources}"
+        answer += f"\n\nSources: {sources}"
+    if completed:
+        _store_cached_answer(cache_key, user_question, query_vector, answer.strip())
+
+async def _agenerate_answer(user_question, docs, lexical_index=None, query_vector=None):
+    """Async _generate_answer: the model call is non-blocking HTTP, the fallback runs on the executor."""
+    chain = await _run_blocking(get_conversational_chain)
+    if chain:
+        try:
+            increment_counter("llm_calls_total")
+            async with _llm_slots:
+                started = time.perf_counter()
+                response = await chain.ainvoke({"input_documents": docs, "question": user_question})
+                record_latency("llm_invoke", time.perf_counter() - started)
+            return response.get("output_text", "").strip(), True
+        except Exception as e:
+            increment_counter("llm_errors_total")
+            logging.error(f"Async model call failed: {e}")
+            reset_conversational_chain()
+    else:
+        logging.warning("No LLM chain available, using simple text extraction")
+    answer = await _run_blocking(_extractive_answer, docs, user_question, lexical_index, query_vector)
+    return answer, False
+
+async def _aanswer_question(user_question, vector_store, doc_ids, pages, query_vector, hybrid=False):
+    """Async _answer_question; returns (answer, cacheable)."""
+    docs = await _run_blocking(retrieve_context, vector_store, user_question, doc_ids=doc_ids, pages=pages,
+                               query_vector=query_vector, hybrid=hybrid)
+    if not docs:
+        logging.warning("No relevant documents found for the question")
+        return "I couldn't find relevant information in your uploaded documents to answer this question. Please try rephrasing your question or check if the information is available in your documents.", False
+
+    logging.info(f"Found {len(docs)} relevant passages")
+    lexical_index = await _run_blocking(get_lexical_index, vector_store)
+    answer, from_llm = await _agenerate_answer(user_question, docs, lexical_index, query_vector)
+    if not answer:
+        logging.warning("Empty response generated")
+        return "I'm having trouble generating a response. Please try rephrasing your question.", False
+
+    sources = format_sources(docs)
+    if sources:
+        answer += f"\n\nSources: {sources}"
+    return answer, from_llm
+
+async def aprocess_question(user_question, vector_store, doc_ids=None, pages=None, hybrid=None):
+    """Async process_question for event-loop callers.
+
+    Embedding, search and extraction run on the shared executor and the model is called over
+    non-blocking HTTP, so a waiting question holds no thread. It shares the answer cache,
+    single-flight deduplication and concurrency limits with process_question.
+    """
+    _begin_request_timings()
+    increment_counter("questions_total")
+    started = time.perf_counter()
+    try:
+        return await _aprocess_question(user_question, vector_store, doc_ids, pages, hybrid)
+    finally:
+        record_latency("question_total", time.perf_counter() - started)
+        _maybe_write_metrics()
+
+async def _aprocess_question(user_question, vector_store, doc_ids, pages, hybrid):
+    if not vector_store:
+        logging.warning("Vector store is not initialized")
+        return "Please upload and process your documents first before asking questions."
+
+    if not user_question or len(user_question.strip()) < 3:
+        return "Please provide a more detailed question."
+
+    try:
+        logging.info(f"Processing question: {user_question[:100]}...")
+
+        query_vector = await _run_blocking(embed_query, vector_store, user_question)
+        if hybrid is None:
+            hybrid = HYBRID_SEARCH
+        cache_key = _answer_cache_key(vector_store, doc_ids, pages, hybrid)
+        cached_answer = _lookup_cached_answer(cache_key, query_vector)
+        if cached_answer is not None:
+            logging.info("Answer served from cache")
+            return cached_answer
+
+        flight_key = (cache_key, user_question.strip().lower())
+        flight, is_leader = _join_flight(flight_key)
+        if not is_leader:
+            # Wait on a plain thread rather than the CPU executor so waiters can't starve real work
+            finished = await asyncio.to_thread(flight["done"].wait, ANSWER_INFLIGHT_TIMEOUT)
+            answer = _coalesced_answer(flight, finished)
+            if answer is not None:
+                return answer
+
+        try:
+            answer, cacheable = await _aanswer_question(user_question, vector_store, doc_ids, pages,
+                                                        query_vector, hybrid)
+            if cacheable:
+                _store_cached_answer(cache_key, user_question, query_vector, answer)
+            if is_leader:
+                flight["answer"] = answer
+        finally:
+            if is_leader:
+                _finish_flight(flight_key, flight)
 
         logging.info("Successfully generated response")
         return answer
@@ -221,4 +2913,27 @@ def process_question(user_question, vector_store):
     except Exception as e:
         logging.error(f"Error processing question: {e}")
         traceback.print_exc()
-        return f"I encountered an error while processing your question. Please try again or contact support if the issue persists."
\ No newline at end of file
+        return f"I encountered an error while processing your question. Please try again or contact support if the issue persists."
+
+async def aiter_vector_store_for_files(pdf_paths, txt_paths, vector_store=None):
+    """Async iter_vector_store_for_files: each ingestion step runs on the shared executor."""
+    events = iter_vector_store_for_files(pdf_paths, txt_paths, vector_store)
+    try:
+        while True:
+            event = await _run_blocking(next, events, None)
+            if event is None:
+                return
+            yield event
+    finally:
+        await _run_blocking(events.close)
+
+async def aget_vector_store_for_files(pdf_paths, txt_paths, vector_store=None):
+    """Async get_vector_store_for_files."""
+    events = aiter_vector_store_for_files(pdf_paths, txt_paths, vector_store)
+    try:
+        async for event in events:
+            if event["stage"] == "done":
+                return event["vector_store"]
+        return None
+    finally:
+        await events.aclose()
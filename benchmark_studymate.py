@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Offline stage-by-stage benchmark for StudyMate
+
+Generates a synthetic corpus (text PDFs, image-only PDFs and TXT files), times every
+pipeline stage against fresh caches with a local stub LLM, and writes the results as
+JSON so runs can be compared across versions and corpus sizes.
+
+Usage:
+    python benchmark_studymate.py --pdf-docs 4 --scanned-docs 1 --txt-docs 2 --pages 20 --output bench.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+TOPICS = ["photosynthesis", "mitochondria", "thermodynamics", "entropy", "algorithms", "recursion",
+          "probability", "derivatives", "integrals", "democracy", "revolution", "enzymes",
+          "gravity", "momentum", "electrons", "genetics", "ecosystems", "inflation", "vectors", "matrices"]
+VERBS = ["explains", "describes", "depends on", "is related to", "determines", "influences", "defines", "limits"]
+NOUNS = ["energy transfer", "the rate of change", "cell structure", "a stable equilibrium", "the main theorem",
+         "market behaviour", "the reaction speed", "information flow", "the boundary conditions", "natural selection"]
+
+def make_paragraph(rng, sentences=6):
+    parts = []
+    for _ in range(sentences):
+        parts.append(f"The study of {rng.choice(TOPICS)} {rng.choice(VERBS)} {rng.choice(NOUNS)} "
+                     f"in ways that students of {rng.choice(TOPICS)} should review carefully.")
+    return " ".join(parts)
+
+def make_page_text(rng, paragraphs):
+    return "\n\n".join(make_paragraph(rng) for _ in range(paragraphs))
+
+def write_text_pdf(path, rng, pages, paragraphs):
+    import fitz
+    with fitz.open() as doc:
+        for _ in range(pages):
+            page = doc.new_page()
+            page.insert_textbox(page.rect + (50, 50, -50, -50), make_page_text(rng, paragraphs), fontsize=10)
+        doc.save(path)
+
+def write_scanned_pdf(path, rng, pages, paragraphs, dpi=150):
+    """Image-only PDF: each page is a rendered picture of text, with no text layer."""
+    import fitz
+    with fitz.open() as source, fitz.open() as scanned:
+        for _ in range(pages):
+            page = source.new_page()
+            page.insert_textbox(page.rect + (50, 50, -50, -50), make_page_text(rng, paragraphs), fontsize=10)
+            pixmap = page.get_pixmap(dpi=dpi)
+            scanned.new_page(width=page.rect.width, height=page.rect.height).insert_image(page.rect, pixmap=pixmap)
+        scanned.save(path)
+
+def write_txt(path, rng, pages, paragraphs):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n\n".join(make_page_text(rng, paragraphs) for _ in range(pages)))
+
+def generate_corpus(corpus_dir, args):
+    rng = random.Random(args.seed)
+    corpus = {"text_pdfs": [], "scanned_pdfs": [], "txts": []}
+    for i in range(args.pdf_docs):
+        path = os.path.join(corpus_dir, f"text_{i}.pdf")
+        write_text_pdf(path, rng, args.pages, args.paragraphs)
+        corpus["text_pdfs"].append(path)
+    for i in range(args.scanned_docs):
+        path = os.path.join(corpus_dir, f"scanned_{i}.pdf")
+        write_scanned_pdf(path, rng, args.pages, args.paragraphs)
+        corpus["scanned_pdfs"].append(path)
+    for i in range(args.txt_docs):
+        path = os.path.join(corpus_dir, f"notes_{i}.txt")
+        write_txt(path, rng, args.pages, args.paragraphs)
+        corpus["txts"].append(path)
+    return corpus
+
+def make_questions(count, seed):
+    rng = random.Random(seed + 1)
+    return [f"How does {rng.choice(TOPICS)} relate to {rng.choice(NOUNS)}?" for _ in range(count)]
+
+def make_stub_llm(latency_ms):
+    """A local LLM that answers instantly (or after a fixed delay) from the start of its context."""
+    from langchain_core.language_models.llms import LLM
+
+    class StubLLM(LLM):
+        latency_ms: float = 0.0
+
+        @property
+        def _llm_type(self):
+            return "studymate-stub"
+
+        def _call(self, prompt, stop=None, run_manager=None, **kwargs):
+            if self.latency_ms:
+                time.sleep(self.latency_ms / 1000.0)
+            context = prompt.split("Context:", 1)[-1].split("Question:", 1)[0].strip()
+            return "Stub answer based on: " + context[:200]
+
+    return StubLLM(latency_ms=latency_ms)
+
+def timed(stage_results, name, func, count=1, **details):
+    """Run func once, record its wall time under name, and return its result.
+
+    count is the number of items processed, or a function of the result that returns it.
+    """
+    started = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - started
+    count = count(result) if callable(count) else count
+    stage_results[name] = dict(details, seconds=seconds, count=count,
+                               per_item_ms=seconds * 1000 / count if count else None)
+    print(f"   {name:<20} {seconds:8.3f} s  ({count} items)")
+    return result
+
+def latency_summary(latencies_ms):
+    import numpy as np
+    return {
+        "count": len(latencies_ms),
+        "seconds": sum(latencies_ms) / 1000.0,
+        "mean_ms": float(np.mean(latencies_ms)),
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p95_ms": float(np.percentile(latencies_ms, 95)),
+        "max_ms": float(np.max(latencies_ms)),
+    }
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10).stdout.strip() or None
+    except Exception:
+        return None
+
+def run_benchmark(args, work_dir):
+    # Fresh caches for every run, so each stage is measured cold
+    os.environ["STUDYMATE_INDEX_CACHE_DIR"] = os.path.join(work_dir, "indexes")
+    os.environ["STUDYMATE_EMBEDDING_CACHE_DIR"] = os.path.join(work_dir, "embeddings")
+    os.environ["STUDYMATE_INDEX_PARAMS_FILE"] = os.path.join(work_dir, "index_params.json")
+    import numpy as np
+    from backend import (
+        build_faiss_index,
+        clear_answer_cache,
+        embed_query,
+        get_embeddings,
+        get_pdf_text_with_ocr,
+        get_text_chunks,
+        get_txt_text,
+        get_vector_store_for_files,
+        process_question,
+        search_documents,
+        set_conversational_llm
+    )
+
+    corpus_dir = os.path.join(work_dir, "corpus")
+    os.makedirs(corpus_dir, exist_ok=True)
+    stages = {}
+    print("📝 Generating synthetic corpus...")
+    corpus = timed(stages, "corpus_generation", lambda: generate_corpus(corpus_dir, args),
+                   count=args.pdf_docs + args.scanned_docs + args.txt_docs, unit="documents")
+    text_pages = args.pdf_docs * args.pages
+    scanned_pages = args.scanned_docs * args.pages
+
+    print("⏱️ Timing stages...")
+    timed(stages, "model_load", get_embeddings, unit="model")
+
+    text = timed(stages, "extraction",
+                 lambda: "".join(get_pdf_text_with_ocr(p, workers=args.workers) for p in corpus["text_pdfs"]),
+                 count=text_pages, unit="pages")
+    if corpus["scanned_pdfs"] and shutil.which("tesseract"):
+        text += timed(stages, "ocr",
+                      lambda: "".join(get_pdf_text_with_ocr(p, workers=args.workers) for p in corpus["scanned_pdfs"]),
+                      count=scanned_pages, unit="pages")
+    elif corpus["scanned_pdfs"]:
+        stages["ocr"] = {"skipped": "tesseract not installed"}
+        print("   ocr                  skipped (tesseract not installed)")
+    text += timed(stages, "txt_read", lambda: get_txt_text(corpus["txts"]), count=len(corpus["txts"]), unit="files")
+
+    chunks = timed(stages, "chunking", lambda: get_text_chunks(text), count=len, unit="chunks")
+    if not chunks:
+        print("❌ The synthetic corpus produced no chunks")
+        return None
+    vectors = timed(stages, "embedding", lambda: np.asarray(get_embeddings().embed_documents(chunks), dtype=np.float32),
+                    count=len(chunks), unit="chunks")
+    timed(stages, "indexing", lambda: build_faiss_index(vectors), count=len(chunks), unit="vectors")
+
+    vector_store = timed(stages, "ingest_end_to_end",
+                         lambda: get_vector_store_for_files(corpus["text_pdfs"] + corpus["scanned_pdfs"], corpus["txts"]),
+                         count=args.pdf_docs + args.scanned_docs + args.txt_docs, unit="documents")
+    if vector_store is None:
+        print("❌ Ingestion produced no vector store")
+        return None
+
+    questions = make_questions(args.queries, args.seed)
+    search_latencies = []
+    for question in questions:
+        started = time.perf_counter()
+        search_documents(vector_store, question, k=10, query_vector=embed_query(vector_store, question))
+        search_latencies.append((time.perf_counter() - started) * 1000)
+    stages["search"] = latency_summary(search_latencies)
+    print(f"   {'search':<20} p50 {stages['search']['p50_ms']:.2f} ms · p95 {stages['search']['p95_ms']:.2f} ms")
+
+    set_conversational_llm(make_stub_llm(args.llm_latency_ms))
+    answer_latencies = []
+    try:
+        for question in questions:
+            clear_answer_cache()  # measure generation, not cache hits
+            started = time.perf_counter()
+            process_question(question, vector_store)
+            answer_latencies.append((time.perf_counter() - started) * 1000)
+    finally:
+        set_conversational_llm(None)
+    stages["answer"] = latency_summary(answer_latencies)
+    stages["answer"]["stub_llm_latency_ms"] = args.llm_latency_ms
+    print(f"   {'answer':<20} p50 {stages['answer']['p50_ms']:.2f} ms · p95 {stages['answer']['p95_ms']:.2f} ms")
+
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "label": args.label,
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "corpus": {
+            "text_pdfs": args.pdf_docs,
+            "scanned_pdfs": args.scanned_docs,
+            "txt_files": args.txt_docs,
+            "pages_per_document": args.pages,
+            "paragraphs_per_page": args.paragraphs,
+            "characters": len(text),
+            "chunks": len(chunks),
+            "seed": args.seed,
+        },
+        "settings": {"workers": args.workers, "queries": args.queries},
+        "stages": stages,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark StudyMate's pipeline stages on a synthetic corpus")
+    parser.add_argument("--pdf-docs", type=int, default=3, help="Text PDFs to generate")
+    parser.add_argument("--scanned-docs", type=int, default=1, help="Image-only PDFs to generate (need tesseract)")
+    parser.add_argument("--txt-docs", type=int, default=2, help="TXT files to generate")
+    parser.add_argument("--pages", type=int, default=10, help="Pages per document")
+    parser.add_argument("--paragraphs", type=int, default=3, help="Paragraphs per page")
+    parser.add_argument("--queries", type=int, default=50, help="Questions for the search and answer stages")
+    parser.add_argument("--workers", type=int, default=None, help="PDF extraction worker processes")
+    parser.add_argument("--llm-latency-ms", type=float, default=0.0, help="Delay added by the stub LLM")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--label", help="Free-form label stored with the results, e.g. a version")
+    parser.add_argument("--output", default=os.path.join(".studymate_cache", "benchmark_results.json"),
+                        help="Where to write the JSON results")
+    parser.add_argument("--keep", help="Keep the corpus and caches in this directory instead of a temp dir")
+    args = parser.parse_args()
+
+    print("🎓 StudyMate Benchmark")
+    print("=" * 50)
+
+    if args.keep:
+        os.makedirs(args.keep, exist_ok=True)
+        results = run_benchmark(args, args.keep)
+    else:
+        with tempfile.TemporaryDirectory(prefix="studymate-bench-") as work_dir:
+            results = run_benchmark(args, work_dir)
+
+    if results is None:
+        return False
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"\n💾 Results written to {args.output}")
+    return True
+
+if __name__ == "__main__":
+    success = main()
+    sys.exit(0 if success else 1)
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""
+Load test for StudyMate with many concurrent simulated student sessions
+
+Starts a local stand-in for the Hugging Face text-generation endpoint (configurable
+latency and failure rate), then ramps up the number of concurrent sessions. Each
+session goes through the same backend calls as the app: extract its uploads, chunk
+them, build a vector store and ask questions. Each concurrency level reports
+p50/p95/p99 latency, throughput and peak RSS.
+
+Usage:
+    python loadtest_studymate.py --concurrency 1,4,16,32 --llm-latency-ms 800 --failure-rate 0.02
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmark_studymate import make_questions, write_text_pdf, write_txt
+
+class StandInEndpoint:
+    """Local HTTP server that answers like a Hugging Face text-generation endpoint."""
+
+    def __init__(self, latency_ms, jitter_ms, failure_rate, tokens, seed):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.failure_rate = failure_rate
+        self.tokens = tokens
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "failures": 0}
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _plan(self):
+        """Decide this request's latency and whether it fails."""
+        with self.lock:
+            self.stats["requests"] += 1
+            fail = self.rng.random() < self.failure_rate
+            if fail:
+                self.stats["failures"] += 1
+            latency = max(0.0, self.latency_ms + self.rng.uniform(-self.jitter_ms, self.jitter_ms)) / 1000.0
+        return latency, fail
+
+    def _handler(self):
+        endpoint = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, status, payload):
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self._send_json(200, {"model_id": "stand-in", "max_total_tokens": 8192})
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+                latency, fail = endpoint._plan()
+                if fail:
+                    time.sleep(latency / 2)
+                    self._send_json(503, {"error": "Model is overloaded (simulated)"})
+                    return
+
+                words = [f"word{i}" for i in range(endpoint.tokens)]
+                if not request.get("stream"):
+                    time.sleep(latency)
+                    self._send_json(200, [{"generated_text": " ".join(words)}])
+                    return
+
+                # Server-sent events, one token at a time, spreading the latency over the tokens
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+                for i, word in enumerate(words):
+                    time.sleep(latency / len(words))
+                    last = i == len(words) - 1
+                    event = {
+                        "index": i,
+                        "token": {"id": i, "text": word + ("" if last else " "), "logprob": 0.0, "special": False},
+                        "generated_text": " ".join(words) if last else None,
+                        "details": None,
+                    }
+                    self.wfile.write(f"data:{json.dumps(event)}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+
+        return Handler
+
+def resident_bytes():
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except Exception:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class PeakRSSMonitor:
+    """Samples the process RSS on a background thread and remembers the peak."""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, resident_bytes())
+            self.stopped.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = resident_bytes()
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, resident_bytes())
+
+def percentiles(latencies_ms):
+    import numpy as np
+    if not latencies_ms:
+        return {"count": 0}
+    return {
+        "count": len(latencies_ms),
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p95_ms": float(np.percentile(latencies_ms, 95)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+        "max_ms": float(np.max(latencies_ms)),
+    }
+
+def make_uploads(corpus_dir, args):
+    """A fixed set of 'uploaded' files every simulated student works with."""
+    rng = random.Random(args.seed)
+    pdf_paths, txt_paths = [], []
+    for i in range(args.pdf_docs):
+        path = os.path.join(corpus_dir, f"lecture_{i}.pdf")
+        write_text_pdf(path, rng, args.pages, 3)
+        pdf_paths.append(path)
+    for i in range(args.txt_docs):
+        path = os.path.join(corpus_dir, f"notes_{i}.txt")
+        write_txt(path, rng, args.pages, 3)
+        txt_paths.append(path)
+    return pdf_paths, txt_paths
+
+def run_session(session_index, args, uploads, backend, shared_store, results):
+    """One simulated student: process the uploads (like the app's process button), then ask questions."""
+    rng = random.Random(args.seed * 1000 + session_index)
+    try:
+        if shared_store is None:
+            started = time.perf_counter()
+            text = backend.get_all_pdf_text(uploads[0]) + backend.get_txt_text(uploads[1])
+            vector_store = backend.get_vector_store_from_texts(backend.get_text_chunks(text))
+            with results["lock"]:
+                results["ingest_ms"].append((time.perf_counter() - started) * 1000)
+        else:
+            vector_store = shared_store
+
+        for question in make_questions(args.questions, args.seed + session_index):
+            time.sleep(rng.uniform(0, args.think_time_ms) / 1000.0)
+            started = time.perf_counter()
+            answer = backend.process_question(question, vector_store)
+            with results["lock"]:
+                results["question_ms"].append((time.perf_counter() - started) * 1000)
+                if not answer:
+                    results["errors"] += 1
+    except Exception as e:
+        with results["lock"]:
+            results["errors"] += 1
+            results["error_messages"].append(str(e))
+
+def run_level(concurrency, args, uploads, backend, shared_store):
+    results = {"question_ms": [], "ingest_ms": [], "errors": 0, "error_messages": [], "lock": threading.Lock()}
+    counters_before = dict(backend.get_metrics()["counters"])
+    threads = [threading.Thread(target=run_session, args=(i, args, uploads, backend, shared_store, results))
+               for i in range(concurrency)]
+    started = time.perf_counter()
+    with PeakRSSMonitor() as rss:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = time.perf_counter() - started
+    counters = backend.get_metrics()["counters"]
+
+    return {
+        "concurrency": concurrency,
+        "seconds": elapsed,
+        "questions": percentiles(results["question_ms"]),
+        "ingest": percentiles(results["ingest_ms"]),
+        "throughput_qps": len(results["question_ms"]) / elapsed if elapsed else 0.0,
+        "errors": results["errors"],
+        "error_samples": results["error_messages"][:5],
+        "model_calls": counters.get("llm_calls_total", 0) - counters_before.get("llm_calls_total", 0),
+        "extractive_fallbacks": (counters.get("extractive_answers_total", 0)
+                                 - counters_before.get("extractive_answers_total", 0)),
+        "peak_rss_mb": rss.peak / (1024 * 1024),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Ramp up concurrent simulated StudyMate sessions")
+    parser.add_argument("--concurrency", default="1,2,4,8,16", help="Comma-separated session counts to ramp through")
+    parser.add_argument("--questions", type=int, default=5, help="Questions per session")
+    parser.add_argument("--think-time-ms", type=float, default=500, help="Max random pause before each question")
+    parser.add_argument("--pdf-docs", type=int, default=2)
+    parser.add_argument("--txt-docs", type=int, default=1)
+    parser.add_argument("--pages", type=int, default=5)
+    parser.add_argument("--shared-store", action="store_true",
+                        help="Process the uploads once and share the store instead of once per session")
+    parser.add_argument("--llm-latency-ms", type=float, default=800, help="Mean stand-in endpoint latency")
+    parser.add_argument("--llm-jitter-ms", type=float, default=200, help="Uniform +/- jitter on the latency")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of endpoint calls that fail with 503")
+    parser.add_argument("--tokens", type=int, default=64, help="Tokens in each generated answer")
+    parser.add_argument("--answer-cache", action="store_true", help="Keep the semantic answer cache enabled")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the report as JSON to this file")
+    args = parser.parse_args()
+
+    print("🎓 StudyMate Load Test")
+    print("=" * 50)
+
+    endpoint = StandInEndpoint(args.llm_latency_ms, args.llm_jitter_ms, args.failure_rate, args.tokens, args.seed).start()
+    print(f"🛰️ Stand-in endpoint at {endpoint.url} · {args.llm_latency_ms:.0f}±{args.llm_jitter_ms:.0f} ms · "
+          f"{args.failure_rate:.0%} failures")
+
+    with tempfile.TemporaryDirectory(prefix="studymate-load-") as work_dir:
+        os.environ["STUDYMATE_LLM_ENDPOINT_URL"] = endpoint.url
+        os.environ["STUDYMATE_INDEX_CACHE_DIR"] = os.path.join(work_dir, "indexes")
+        os.environ["STUDYMATE_EMBEDDING_CACHE_DIR"] = os.path.join(work_dir, "embeddings")
+        if not args.answer_cache:
+            os.environ["STUDYMATE_ANSWER_CACHE_SIMILARITY"] = "2"  # cosine never exceeds 1, so nothing is reused
+        import backend
+
+        corpus_dir = os.path.join(work_dir, "corpus")
+        os.makedirs(corpus_dir)
+        uploads = make_uploads(corpus_dir, args)
+        backend.get_embeddings()  # load the model once, outside the measurements
+
+        shared_store = None
+        if args.shared_store:
+            text = backend.get_all_pdf_text(uploads[0]) + backend.get_txt_text(uploads[1])
+            shared_store = backend.get_vector_store_from_texts(backend.get_text_chunks(text))
+
+        levels = []
+        print(f"\n{'sessions':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'q/s':>7} {'errors':>6} "
+              f"{'fallbacks':>9} {'peak RSS':>9}")
+        for concurrency in [int(c) for c in args.concurrency.split(",") if c.strip()]:
+            level = run_level(concurrency, args, uploads, backend, shared_store)
+            levels.append(level)
+            q = level["questions"]
+            print(f"{concurrency:>8} {q.get('p50_ms', 0):>9.0f} {q.get('p95_ms', 0):>9.0f} {q.get('p99_ms', 0):>9.0f} "
+                  f"{level['throughput_qps']:>7.2f} {level['errors']:>6} {level['extractive_fallbacks']:>9} "
+                  f"{level['peak_rss_mb']:>7.0f}MB")
+
+    endpoint.stop()
+    report = {
+        "settings": vars(args),
+        "endpoint": dict(endpoint.stats),
+        "levels": levels,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"\n💾 Report written to {args.output}")
+    return all(level["errors"] == 0 for level in levels)
+
+if __name__ == "__main__":
+    success = main()
+    sys.exit(0 if success else 1)
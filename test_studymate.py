@@ -5,25 +5,96 @@ Test script for StudyMate functionality
 
 import os
 import sys
+import asyncio
+import subprocess
+import tempfile
+import threading
+import numpy as np
+import backend
 from backend import (
     get_all_pdf_text,
-    get_txt_text,
+    iter_pdf_pages,
     get_text_chunks,
     get_vector_store_from_texts,
-    process_question
+    get_vector_store_for_files,
+    get_index_cache_stats,
+    save_vector_store,
+    load_vector_store,
+    add_documents_to_vector_store,
+    remove_document_from_vector_store,
+    list_indexed_documents,
+    get_document_id,
+    UploadedDocument,
+    UPLOAD_TEMP_DIR,
+    cleanup_upload_dir,
+    build_faiss_index,
+    embed_documents_cached,
+    get_embedding_cache_stats,
+    search_documents,
+    get_lexical_index,
+    get_query_batching_stats,
+    pack_context,
+    process_question,
+    aprocess_question,
+    stream_question,
+    set_conversational_llm,
+    get_metrics,
+    get_answer_cache_stats,
+    clear_answer_cache,
+    get_last_request_timings,
+    export_metrics_prometheus
 )
+from langchain.schema import Document
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))  # sample PDFs live next to this script
+
+HEAVY_MODULES = ["numpy", "scipy", "faiss", "fitz", "torch", "sentence_transformers", "transformers",
+                 "langchain", "langchain_community", "langchain_huggingface", "PIL", "pytesseract", "pdf2image"]
+
+def test_import_time():
+    """Test that importing backend is fast and doesn't load heavy libraries or log in"""
+    print("\n⏱️ Testing backend import time...")
+
+    budget = float(os.getenv("STUDYMATE_IMPORT_BUDGET_S", "1.0"))
+    script = (
+        "import sys, time\n"
+        "started = time.perf_counter()\n"
+        "import backend\n"
+        "elapsed = time.perf_counter() - started\n"
+        f"heavy = [m for m in {HEAVY_MODULES!r} if m in sys.modules]\n"
+        "print(f'{elapsed:.3f}', ','.join(heavy))\n"
+    )
+    try:
+        env = dict(os.environ, HUGGINGFACEHUB_API_TOKEN="")
+        result = subprocess.run([sys.executable, "-c", script], cwd=TEST_DIR,
+                                env=env, capture_output=True, text=True, timeout=60)
+        if result.returncode != 0:
+            print(f"❌ Importing backend failed: {result.stderr.strip()[-300:]}")
+            return False
+        elapsed, _, heavy = result.stdout.strip().splitlines()[-1].partition(" ")
+        if heavy:
+            print(f"❌ Importing backend loaded heavy modules: {heavy}")
+            return False
+        if float(elapsed) > budget:
+            print(f"❌ Importing backend took {elapsed}s (budget {budget}s)")
+            return False
+        print(f"✅ backend imported in {elapsed}s without an API key or heavy modules")
+        return True
+    except Exception as e:
+        print(f"❌ Import time test error: {e}")
+        return False
 
 def test_pdf_processing():
     """Test PDF text extraction"""
     print("🔍 Testing PDF processing...")
     
     # Check if sample PDFs exist
-    pdf_files = [f for f in os.listdir('.') if f.endswith('.pdf')]
+    pdf_files = [os.path.join(TEST_DIR, f) for f in sorted(os.listdir(TEST_DIR)) if f.endswith('.pdf')]
     if not pdf_files:
-        print("❌ No PDF files found in current directory")
+        print("❌ No PDF files found next to the test script")
         return False
     
-    print(f"📄 Found PDF files: {pdf_files}")
+    print(f"📄 Found PDF files: {[os.path.basename(f) for f in pdf_files]}")
     
     try:
         # Test PDF text extraction
@@ -38,6 +109,35 @@ def test_pdf_processing():
         print(f"❌ PDF processing error: {e}")
         return False
 
+def test_parallel_pdf_extraction():
+    """Test that extracting a PDF on worker processes gives the same pages as serial extraction"""
+    print("\n🔍 Testing parallel PDF extraction...")
+
+    import fitz
+    saved = backend.PDF_PARALLEL_MIN_PAGES, backend.PDF_PAGES_PER_TASK
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "multi_page.pdf")
+            with fitz.open() as doc:
+                for page_num in range(7):
+                    doc.new_page().insert_text((72, 72), f"Page {page_num + 1} covers topic number {page_num * 7}.")
+                doc.save(path)
+            backend.PDF_PARALLEL_MIN_PAGES, backend.PDF_PAGES_PER_TASK = 1, 2  # 4 ranges, the last one short
+            serial = list(iter_pdf_pages(path, workers=1))
+            parallel = list(iter_pdf_pages(path, workers=3))
+
+        if len(serial) == 7 and parallel == serial:
+            print(f"✅ Parallel extraction matches serial extraction on {len(serial)} pages")
+            return True
+        else:
+            print(f"❌ Parallel pages differ: {parallel} vs {serial}")
+            return False
+    except Exception as e:
+        print(f"❌ Parallel PDF extraction error: {e}")
+        return False
+    finally:
+        backend.PDF_PARALLEL_MIN_PAGES, backend.PDF_PAGES_PER_TASK = saved
+
 def test_text_chunking():
     """Test text chunking functionality"""
     print("\n🔍 Testing text chunking...")
@@ -62,6 +162,99 @@ def test_text_chunking():
         print(f"❌ Text chunking error: {e}")
         return False
 
+EMBEDDING_CACHE_WRITER = (
+    "import sys, backend\n"
+    "from langchain_core.embeddings import DeterministicFakeEmbedding\n"
+    "backend._embeddings = DeterministicFakeEmbedding(size=16)\n"
+    "backend.embed_documents_cached([f'{sys.argv[1]} note {i}' for i in range(200)] +\n"
+    "                               [f'shared note {i}' for i in range(50)])\n"
+)
+
+def test_embedding_cache_processes():
+    """Test that processes appending to one embedding cache at once see each other's vectors"""
+    print("\n🔍 Testing embedding cache shared between processes...")
+
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+    model = DeterministicFakeEmbedding(size=16)
+    saved = backend.EMBEDDING_CACHE_DIR, backend._embedding_cache, backend._embeddings
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            backend.EMBEDDING_CACHE_DIR, backend._embedding_cache, backend._embeddings = tmp_dir, None, model
+            embed_documents_cached(["parent note"])  # open the cache before the other processes append
+
+            env = dict(os.environ, STUDYMATE_EMBEDDING_CACHE_DIR=tmp_dir)
+            writers = [subprocess.Popen([sys.executable, "-c", EMBEDDING_CACHE_WRITER, name],
+                                        cwd=TEST_DIR, env=env,
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+                       for name in ("alpha", "beta")]
+            errors = [writer.communicate(timeout=300)[1] for writer in writers]
+            if any(writer.returncode != 0 for writer in writers):
+                print(f"❌ Cache writer failed: {' '.join(e.strip()[-300:] for e in errors)}")
+                return False
+
+            texts = ([f"{name} note {i}" for name in ("alpha", "beta") for i in range(200)] +
+                     [f"shared note {i}" for i in range(50)])
+            misses = get_embedding_cache_stats()["misses"]
+            vectors = embed_documents_cached(texts)
+            reloaded = get_embedding_cache_stats()["misses"] == misses
+            rows = get_embedding_cache_stats()["rows"]
+            exact = np.allclose(vectors, model.embed_documents(texts), atol=1e-6)
+
+        if reloaded and rows == len(texts) + 1 and exact:
+            print(f"✅ Two writer processes appended {rows - 1} rows without duplicates or lost vectors")
+            return True
+        else:
+            print(f"❌ Shared cache: reloaded={reloaded} · rows={rows} · exact={exact}")
+            return False
+    except Exception as e:
+        print(f"❌ Embedding cache process error: {e}")
+        return False
+    finally:
+        backend.EMBEDDING_CACHE_DIR, backend._embedding_cache, backend._embeddings = saved
+
+def test_embedding_cache_truncated_tail():
+    """Test that an embedding cache with a partial key and vector at the end is repaired on the next write"""
+    print("\n🔍 Testing embedding cache recovery from a truncated tail...")
+
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+    model = DeterministicFakeEmbedding(size=16)
+    saved = backend.EMBEDDING_CACHE_DIR, backend._embedding_cache, backend._embeddings
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            backend.EMBEDDING_CACHE_DIR, backend._embedding_cache, backend._embeddings = tmp_dir, None, model
+            first = [f"first note {i}" for i in range(20)]
+            embed_documents_cached(first)
+
+            # A writer that died mid-append: the last vector is cut in half and a key is half written
+            paths = backend._embedding_cache_paths()
+            os.truncate(paths["vectors"], 19 * 16 * 4 + 32)
+            with open(paths["keys"], "ab") as f:
+                f.write(b"\1" * 7)
+
+            backend._embedding_cache = None  # as a freshly started process would open it
+            texts = first + [f"second note {i}" for i in range(20)]
+            vectors = embed_documents_cached(texts)
+            backend._embedding_cache = None
+            misses = get_embedding_cache_stats()["misses"]
+            reread = embed_documents_cached(texts)
+            all_cached = get_embedding_cache_stats()["misses"] == misses
+            sizes_ok = (os.path.getsize(paths["keys"]) == 40 * backend.EMBEDDING_KEY_BYTES and
+                        os.path.getsize(paths["vectors"]) == 40 * 16 * 4)
+            expected = model.embed_documents(texts)
+            exact = np.allclose(vectors, expected, atol=1e-6) and np.allclose(reread, expected, atol=1e-6)
+
+        if all_cached and sizes_ok and exact:
+            print("✅ Partial tail dropped, the cut-off vector re-embedded and every row readable")
+            return True
+        else:
+            print(f"❌ Truncated cache: all_cached={all_cached} · sizes_ok={sizes_ok} · exact={exact}")
+            return False
+    except Exception as e:
+        print(f"❌ Embedding cache recovery error: {e}")
+        return False
+    finally:
+        backend.EMBEDDING_CACHE_DIR, backend._embedding_cache, backend._embeddings = saved
+
 def test_vector_store():
     """Test vector store creation"""
     print("\n🔍 Testing vector store creation...")
@@ -84,6 +277,444 @@ def test_vector_store():
         print(f"❌ Vector store creation error: {e}")
         return None
 
+def test_text_store_answer_cache():
+    """Test that two stores built from different texts never share an answer cache entry"""
+    print("\n🔍 Testing answer cache isolation between text-built stores...")
+
+    try:
+        store_a = get_vector_store_from_texts(["Mitochondria are the powerhouse of the cell and make ATP."])
+        store_b = get_vector_store_from_texts(["The French Revolution began in 1789 with the storming of the Bastille."])
+        question = "What is this about?"
+        query_vector = backend.embed_query(store_a, question)
+        clear_answer_cache()
+        key_a = backend._answer_cache_key(store_a, None, None)
+        key_b = backend._answer_cache_key(store_b, None, None)
+        backend._store_cached_answer(key_a, question, query_vector, "ANSWER FROM A")
+        leaked = backend._lookup_cached_answer(key_b, query_vector)
+        clear_answer_cache()
+
+        if key_a != key_b and leaked is None:
+            print("✅ Each text-built store has its own answer cache entries")
+            return True
+        else:
+            print(f"❌ Store B was served store A's answer: {leaked}")
+            return False
+    except Exception as e:
+        print(f"❌ Answer cache isolation error: {e}")
+        return False
+
+def test_index_cache():
+    """Test that a repeated upload set is served from the index cache"""
+    print("\n🔍 Testing index cache...")
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            txt_path = os.path.join(tmp_dir, "notes.txt")
+            with open(txt_path, "w", encoding="utf-8") as f:
+                f.write("Supervised learning trains models on labelled examples. " * 20)
+
+            first = get_vector_store_for_files([], [txt_path])
+            hits_before = get_index_cache_stats()["hits"]
+            second = get_vector_store_for_files([], [txt_path])
+            hits_after = get_index_cache_stats()["hits"]
+
+            # An index built with other storage settings must not be reused
+            fingerprint = backend.fingerprint_files([], [txt_path])
+            saved = backend.INDEX_STORAGE
+            backend.INDEX_STORAGE = "int8" if saved != "int8" else "float32"
+            try:
+                storage_fingerprint = backend.fingerprint_files([], [txt_path])
+            finally:
+                backend.INDEX_STORAGE = saved
+
+        if not (first and second and hits_after == hits_before + 1):
+            print("❌ Index cache did not serve the repeated upload")
+            return False
+        if storage_fingerprint == fingerprint:
+            print("❌ Changing the index storage kept the same cache key")
+            return False
+        print("✅ Index cache hit on repeated upload, keyed by index settings")
+        return True
+    except Exception as e:
+        print(f"❌ Index cache error: {e}")
+        return False
+
+def test_memory_mapped_index(vector_store):
+    """Test that a saved index can be opened memory-mapped and still be updated"""
+    print("\n🔍 Testing memory-mapped index loading...")
+
+    if not vector_store:
+        print("❌ Cannot test memory-mapped loading without vector store")
+        return False
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            save_vector_store(vector_store, os.path.join(tmp_dir, "index"))
+            mapped = load_vector_store(os.path.join(tmp_dir, "index"), mmap=True)
+            query = "What is deep learning?"
+            same_results = ([d.page_content for d in search_documents(mapped, query, k=2)] ==
+                            [d.page_content for d in search_documents(vector_store, query, k=2)])
+
+            # Updates go to a private in-memory copy, never to the mapped file
+            txt_path = os.path.join(tmp_dir, "extra.txt")
+            with open(txt_path, "w", encoding="utf-8") as f:
+                f.write("Reinforcement learning rewards good actions. " * 20)
+            updated = add_documents_to_vector_store(mapped, [], [txt_path])
+            grew = updated.index.ntotal > vector_store.index.ntotal
+
+            # IVF indexes (what large corpora get) must map their inverted lists too
+            import faiss
+            vectors = np.random.default_rng(0).normal(size=(2000, 384)).astype(np.float32)
+            ivf_path = os.path.join(tmp_dir, "ivf.faiss")
+            faiss.write_index(build_faiss_index(vectors, "ivf", {"storage": "float32"}), ivf_path)
+            ivf_index, _ = backend._read_index(ivf_path, True)
+            ivf_mapped = backend._is_memory_mapped(ivf_index)
+            del ivf_index
+
+        if same_results and grew and ivf_mapped:
+            print("✅ Memory-mapped index answers like the original, accepts updates, and IVF lists are mapped")
+            return True
+        else:
+            print(f"❌ Memory-mapped index mismatch: same_results={same_results} · grew={grew} · ivf_mapped={ivf_mapped}")
+            return False
+    except Exception as e:
+        print(f"❌ Memory-mapped index error: {e}")
+        return False
+
+def test_compact_storage():
+    """Test that compact index storage saves memory and still finds the nearest chunk"""
+    print("\n🔍 Testing compact index storage...")
+
+    try:
+        import faiss
+        rng = np.random.default_rng(0)
+        vectors = rng.normal(size=(2000, 384)).astype(np.float32)
+        queries = vectors[:100] + rng.normal(scale=0.1, size=(100, 384)).astype(np.float32)
+        flat_bytes = faiss.serialize_index(build_faiss_index(vectors, "flat", {"storage": "float32"})).nbytes
+
+        ok = True
+        for params in [{"storage": "fp16"}, {"storage": "int8"}, {"storage": "int8", "binary_prefilter": True}]:
+            index = build_faiss_index(vectors, "flat", params)
+            _, found = index.search(queries, 1)
+            recall = float(np.mean(found[:, 0] == np.arange(100)))
+            ratio = faiss.serialize_index(index).nbytes / flat_bytes
+            print(f"   {params}: recall@1 {recall:.2f} · {ratio:.0%} of float32 memory")
+            ok = ok and recall >= 0.9 and (params.get("binary_prefilter") or ratio < 0.6)
+
+        if ok:
+            print("✅ Compact storage keeps recall with less memory")
+            return True
+        else:
+            print("❌ Compact storage lost recall or saved no memory")
+            return False
+    except Exception as e:
+        print(f"❌ Compact storage error: {e}")
+        return False
+
+def test_compact_scoped_search():
+    """Test that scoped search on an int8 store searches the compact index without float32 copies"""
+    print("\n🔍 Testing scoped search on compact storage...")
+
+    import tracemalloc
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+    from langchain_community.vectorstores import FAISS
+    original_get_store_vectors = backend._get_store_vectors
+    try:
+        vectors = np.random.default_rng(1).normal(size=(5000, 384)).astype(np.float32)
+        docs = {str(i): Document(page_content=f"chunk {i}", metadata={"doc_id": "a" if i < 2500 else "b"})
+                for i in range(len(vectors))}
+        store = FAISS(backend.get_embeddings(), build_faiss_index(vectors, "flat", {"storage": "int8"}),
+                      InMemoryDocstore(docs), {i: str(i) for i in range(len(vectors))})
+
+        copies = []
+        backend._get_store_vectors = lambda *args, **kwargs: copies.append(args) or original_get_store_vectors(*args, **kwargs)
+        tracemalloc.start()
+        results = search_documents(store, "", k=3, doc_ids=["b"], query_vector=vectors[4000])
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        found_nearest = results and results[0].page_content == "chunk 4000"
+        in_scope = all(doc.metadata["doc_id"] == "b" for doc in results)
+        if found_nearest and in_scope and not copies and peak < vectors.nbytes / 10:
+            print(f"✅ Scoped int8 search peaked at {peak / 1024:.0f} KB (float32 copy would be {vectors.nbytes / 1024:.0f} KB)")
+            return True
+        else:
+            print(f"❌ Scoped int8 search: nearest={found_nearest} · in_scope={in_scope} · "
+                  f"vector copies={len(copies)} · peak {peak / 1024:.0f} KB")
+            return False
+    except Exception as e:
+        print(f"❌ Compact scoped search error: {e}")
+        return False
+    finally:
+        backend._get_store_vectors = original_get_store_vectors
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+def test_shared_index():
+    """Test that sessions with the same upload set share one index and keep their changes private"""
+    print("\n🔍 Testing shared index registry...")
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = []
+            for name, body in [("chemistry.txt", "Atoms bond by sharing or transferring electrons. "),
+                               ("history.txt", "The printing press spread ideas across Europe. ")]:
+                path = os.path.join(tmp_dir, name)
+                with open(path, "w", encoding="utf-8") as f:
+                    f.write(body * 30)
+                paths.append(path)
+
+            first = get_vector_store_for_files([], paths)
+            second = get_vector_store_for_files([], paths)
+            shared = first is not second and first.index is second.index
+
+            # A session that changes its store gets a private copy first
+            remove_document_from_vector_store(first, get_document_id(paths[0]))
+            sources_first = [doc["source"] for doc in list_indexed_documents(first)]
+            sources_second = sorted(doc["source"] for doc in list_indexed_documents(second))
+
+        if shared and sources_first == ["history.txt"] and sources_second == ["chemistry.txt", "history.txt"]:
+            print("✅ Sessions share one index and copy it on write")
+            return True
+        else:
+            print(f"❌ Unexpected sharing: shared={shared} · {sources_first} / {sources_second}")
+            return False
+    except Exception as e:
+        print(f"❌ Shared index error: {e}")
+        return False
+
+def test_in_memory_upload():
+    """Test that uploads are ingested from memory without writing temp files"""
+    print("\n🔍 Testing in-memory upload ingestion...")
+
+    try:
+        data = ("Photosynthesis turns light into chemical energy. " * 30).encode("utf-8")
+        upload = UploadedDocument("notes.txt", data)
+        files_before = set(os.listdir(UPLOAD_TEMP_DIR)) if os.path.isdir(UPLOAD_TEMP_DIR) else set()
+        vector_store = get_vector_store_for_files([], [upload])
+        files_after = set(os.listdir(UPLOAD_TEMP_DIR)) if os.path.isdir(UPLOAD_TEMP_DIR) else set()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "notes.txt")
+            with open(path, "wb") as f:
+                f.write(data)
+            same_id = get_document_id(path) == get_document_id(upload)
+
+        sources = [doc["source"] for doc in list_indexed_documents(vector_store)] if vector_store else []
+        if sources == ["notes.txt"] and same_id and files_after == files_before:
+            print("✅ Upload ingested from memory with a content-hash document ID")
+            return True
+        else:
+            print(f"❌ Unexpected in-memory ingestion: {sources} · same_id={same_id} · "
+                  f"{len(files_after - files_before)} temp files written")
+            return False
+    except Exception as e:
+        print(f"❌ In-memory upload error: {e}")
+        return False
+
+def test_upload_cleanup():
+    """Test that temp upload cleanup only removes spilled uploads"""
+    print("\n🔍 Testing temp upload cleanup...")
+
+    saved = backend.UPLOAD_TEMP_DIR, backend.UPLOAD_TEMP_TTL
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            backend.UPLOAD_TEMP_DIR, backend.UPLOAD_TEMP_TTL = tmp_dir, 0  # everything counts as expired
+            foreign = os.path.join(tmp_dir, "lecture notes.pdf")
+            in_flight = os.path.join(tmp_dir, "a" * 64 + ".pdf.tmp-1-2")
+            spilled = os.path.join(tmp_dir, "b" * 64 + ".pdf")
+            for path in [foreign, in_flight, spilled]:
+                with open(path, "wb") as f:
+                    f.write(b"%PDF-1.4")
+            cleanup_upload_dir()
+            survivors = sorted(os.listdir(tmp_dir))
+
+        if survivors == sorted([os.path.basename(foreign), os.path.basename(in_flight)]):
+            print("✅ Cleanup removed the spilled upload and kept other files")
+            return True
+        else:
+            print(f"❌ Unexpected files after cleanup: {survivors}")
+            return False
+    except Exception as e:
+        print(f"❌ Upload cleanup error: {e}")
+        return False
+    finally:
+        backend.UPLOAD_TEMP_DIR, backend.UPLOAD_TEMP_TTL = saved
+
+def test_incremental_documents():
+    """Test adding and removing single documents on a live vector store"""
+    print("\n🔍 Testing incremental document updates...")
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = []
+            for name, body in [("ml.txt", "Machine learning finds patterns in data. "),
+                               ("nlp.txt", "Natural language processing analyses text. ")]:
+                path = os.path.join(tmp_dir, name)
+                with open(path, "w", encoding="utf-8") as f:
+                    f.write(body * 30)
+                paths.append(path)
+
+            vector_store = add_documents_to_vector_store(None, [], paths[:1])
+            vector_store = add_documents_to_vector_store(vector_store, [], paths)
+            sources_after_add = sorted(doc["source"] for doc in list_indexed_documents(vector_store))
+
+            remove_document_from_vector_store(vector_store, get_document_id(paths[0]))
+            sources_after_remove = [doc["source"] for doc in list_indexed_documents(vector_store)]
+
+        if sources_after_add == ["ml.txt", "nlp.txt"] and sources_after_remove == ["nlp.txt"]:
+            print("✅ Incremental add/remove successful")
+            return True
+        else:
+            print(f"❌ Unexpected indexed documents: {sources_after_add} / {sources_after_remove}")
+            return False
+    except Exception as e:
+        print(f"❌ Incremental update error: {e}")
+        return False
+
+def test_hybrid_after_removal():
+    """Test that BM25 hits still resolve to the right chunks after removing a middle document"""
+    print("\n🔍 Testing hybrid search after document removal...")
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = []
+            for name, body in [("biology.txt", "Cells divide through mitosis and meiosis. "),
+                               ("physics.txt", "Force equals mass times acceleration. "),
+                               ("chemistry.txt", "Valence electrons decide how atoms bond. "),
+                               ("history.txt", "The printing press spread books across Europe. ")]:
+                path = os.path.join(tmp_dir, name)
+                with open(path, "w", encoding="utf-8") as f:
+                    f.write(body * 30)
+                paths.append(path)
+
+            vector_store = add_documents_to_vector_store(None, [], paths[:2])
+            vector_store = add_documents_to_vector_store(vector_store, [], paths[:3])
+            remove_document_from_vector_store(vector_store, get_document_id(paths[1]))
+            vector_store = add_documents_to_vector_store(vector_store, [], paths)
+
+            lexical_index = get_lexical_index(vector_store)
+            mapping = lexical_index["docstore_ids"]
+            resolved = all(vector_store.docstore._dict.get(docstore_id) is not None and
+                           vector_store.docstore._dict[docstore_id].metadata.get("chunk_id") == chunk_id
+                           for chunk_id, docstore_id in mapping.items())
+            complete = set(mapping) == set(lexical_index["chunks"]) and len(mapping) == len(vector_store.docstore._dict)
+            docs = search_documents(vector_store, "valence electrons atoms bond", k=3, hybrid=True)
+            sources = [doc.metadata["source"] for doc in docs]
+
+        if resolved and complete and sources and sources[0] == "chemistry.txt" and "physics.txt" not in sources:
+            print(f"✅ {len(mapping)} chunks resolve after removal, hybrid hits from: {sources}")
+            return True
+        else:
+            print(f"❌ Hybrid after removal: resolved={resolved} · complete={complete} · sources={sources}")
+            return False
+    except Exception as e:
+        print(f"❌ Hybrid after removal error: {e}")
+        return False
+
+def test_scoped_search():
+    """Test that document-scoped retrieval only returns chunks from the selected document"""
+    print("\n🔍 Testing document-scoped search...")
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = []
+            for name, body in [("biology.txt", "Cells divide through mitosis and meiosis. "),
+                               ("physics.txt", "Force equals mass times acceleration. ")]:
+                path = os.path.join(tmp_dir, name)
+                with open(path, "w", encoding="utf-8") as f:
+                    f.write(body * 30)
+                paths.append(path)
+
+            vector_store = add_documents_to_vector_store(None, [], paths)
+            physics_id = get_document_id(paths[1])
+            docs = search_documents(vector_store, "How do cells divide?", k=3, doc_ids=[physics_id])
+
+        if docs and all(doc.metadata["source"] == "physics.txt" for doc in docs):
+            print(f"✅ Scoped search returned {len(docs)} chunks from the selected document")
+            return True
+        else:
+            print("❌ Scoped search returned chunks from other documents")
+            return False
+    except Exception as e:
+        print(f"❌ Scoped search error: {e}")
+        return False
+
+def test_search_batching():
+    """Test that micro-batched searches from many threads return exactly what a direct FAISS search does"""
+    print("\n🔍 Testing batched search equivalence...")
+
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+    from langchain_community.vectorstores import FAISS
+    try:
+        rng = np.random.default_rng(2)
+        stores = []
+        for name in ("left", "right"):  # two indexes, so batches for different keys run side by side
+            vectors = rng.normal(size=(2000, 64)).astype(np.float32)
+            docs = {f"{name}:{i}": Document(page_content=f"{name} chunk {i}") for i in range(len(vectors))}
+            stores.append(FAISS(backend.get_embeddings(), build_faiss_index(vectors, "flat", {"storage": "float32"}),
+                                InMemoryDocstore(docs), {i: f"{name}:{i}" for i in range(len(vectors))}))
+        queries = [(stores[i % 2], rng.normal(size=64).astype(np.float32), 1 + i % 10) for i in range(48)]
+
+        batched = [None] * len(queries)
+        start = threading.Barrier(len(queries))
+        def search(i):
+            store, query_vector, k = queries[i]
+            start.wait()
+            batched[i] = search_documents(store, "", k=k, query_vector=query_vector, with_scores=True)
+        threads = [threading.Thread(target=search, args=(i,)) for i in range(len(queries))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        same = True
+        for (store, query_vector, k), results in zip(queries, batched):
+            distances, positions = store.index.search(query_vector.reshape(1, -1), k)
+            expected = [store.docstore.search(store.index_to_docstore_id[int(p)]).page_content for p in positions[0]]
+            same = same and [doc.page_content for doc, _ in results] == expected
+            same = same and np.allclose([distance for _, distance in results], distances[0], rtol=1e-5)
+
+        largest = get_query_batching_stats()["search"]["largest_batch"]
+        if same:
+            print(f"✅ {len(queries)} concurrent searches match direct FAISS results (largest batch {largest})")
+            return True
+        else:
+            print("❌ Batched search results differ from direct FAISS search")
+            return False
+    except Exception as e:
+        print(f"❌ Batched search error: {e}")
+        return False
+
+def test_context_packing():
+    """Test that overlapping chunks are merged and duplicates dropped before prompting"""
+    print("\n📦 Testing context packing...")
+
+    try:
+        text = "Photosynthesis turns light into chemical energy. " * 40
+        chunks = []
+        for i, start in enumerate([0, 800, 1600]):
+            metadata = {"doc_id": "bio", "source": "bio.txt", "page": 1, "page_end": 1,
+                        "start_index": start, "end_index": min(start + 1000, len(text)), "chunk_id": f"bio:{i}"}
+            chunks.append((Document(page_content=text[start:start + 1000], metadata=metadata), 0.2))
+        copy = Document(page_content=text[:1000], metadata={"doc_id": "copy", "source": "copy.txt",
+                                                            "start_index": 0, "end_index": 1000})
+        unrelated = Document(page_content="Completely unrelated text about ships. " * 20,
+                             metadata={"doc_id": "ships", "source": "ships.txt", "start_index": 0, "end_index": 780})
+
+        packed = pack_context(chunks + [(copy, 0.3), (unrelated, 1.9)], token_budget=1000)
+        sources = [doc.metadata["source"] for doc in packed]
+
+        if sources == ["bio.txt"] and packed[0].page_content == text[:2000]:
+            print("✅ Overlapping chunks merged into one passage, duplicate and irrelevant chunks dropped")
+            return True
+        else:
+            print(f"❌ Unexpected packed context from: {sources}")
+            return False
+    except Exception as e:
+        print(f"❌ Context packing error: {e}")
+        return False
+
 def test_question_processing(vector_store):
     """Test question processing"""
     print("\n🔍 Testing question processing...")
@@ -107,25 +738,212 @@ def test_question_processing(vector_store):
         print(f"❌ Question processing error: {e}")
         return False
 
+def test_metrics(vector_store):
+    """Test that answering a question records a timing breakdown and exports metrics"""
+    print("\n📈 Testing metrics...")
+
+    if not vector_store:
+        print("❌ Cannot test metrics without vector store")
+        return False
+
+    try:
+        process_question("What topics do these notes cover?", vector_store)
+        timings = get_last_request_timings()
+        exported = export_metrics_prometheus()
+        if "question_total" in timings and "search" in timings and "studymate_questions_total" in exported:
+            stages = ", ".join(f"{stage} {seconds * 1000:.0f} ms" for stage, seconds in timings.items())
+            print(f"✅ Timing breakdown recorded: {stages}")
+            return True
+        else:
+            print(f"❌ Missing timings or metrics: {sorted(timings)}")
+            return False
+    except Exception as e:
+        print(f"❌ Metrics error: {e}")
+        return False
+
+def test_async_question_processing(vector_store):
+    """Test the async question API"""
+    print("\n⚡ Testing async question processing...")
+
+    if not vector_store:
+        print("❌ Cannot test async question processing without vector store")
+        return False
+
+    try:
+        questions = ["What is machine learning?", "What is deep learning?"]
+        async def ask_all():
+            return await asyncio.gather(*(aprocess_question(q, vector_store) for q in questions))
+        responses = asyncio.run(ask_all())
+        if all(response and len(response.strip()) > 10 for response in responses):
+            print(f"✅ Answered {len(responses)} concurrent questions")
+            return True
+        else:
+            print("❌ Empty or too short async response")
+            return False
+    except Exception as e:
+        print(f"❌ Async question processing error: {e}")
+        return False
+
+def test_stream_fallback(vector_store):
+    """Test that a model failing mid-stream is followed by the extractive answer"""
+    print("\n🌊 Testing streaming fallback...")
+
+    if not vector_store:
+        print("❌ Cannot test streaming fallback without vector store")
+        return False
+
+    from langchain_core.language_models.fake import FakeStreamingListLLM
+    try:
+        # Streams one character per token and raises on the sixth
+        set_conversational_llm(FakeStreamingListLLM(responses=["Machine learning is..."], error_on_chunk_number=5))
+        before = get_metrics()["counters"].get("extractive_answers_total", 0)
+        answer = "".join(stream_question("What is machine learning?", vector_store))
+        fallbacks = get_metrics()["counters"].get("extractive_answers_total", 0) - before
+        continuation = answer.split("Sources:")[0].split("study materials.)_")[-1].strip()
+        if answer.startswith("Machi") and fallbacks == 1 and len(continuation) > 20:
+            print(f"✅ Partial answer continued from the study materials: {answer[:100]}...")
+            return True
+        else:
+            print(f"❌ Missing extractive continuation: {answer[:200]}")
+            return False
+    except Exception as e:
+        print(f"❌ Streaming fallback error: {e}")
+        return False
+    finally:
+        set_conversational_llm(None)
+
+def test_answer_cache(vector_store):
+    """Test the answer cache similarity threshold, its TTL and single-flight streaming"""
+    print("\n🧠 Testing answer cache...")
+
+    if not vector_store:
+        print("❌ Cannot test answer cache without vector store")
+        return False
+
+    from langchain_core.language_models.fake import FakeStreamingListLLM
+    saved_ttl = backend.ANSWER_CACHE_TTL
+    try:
+        key = ("test-index", None)
+        stored = np.array([1.0, 0.0], dtype=np.float32)
+        close = np.array([0.99, 0.14], dtype=np.float32)  # cosine ~0.99
+        far = np.array([0.5, 0.87], dtype=np.float32)  # cosine ~0.5
+        clear_answer_cache()
+        backend._store_cached_answer(key, "What is a neuron?", stored, "cached")
+        threshold_ok = (backend._lookup_cached_answer(key, close) == "cached"
+                        and backend._lookup_cached_answer(key, far) is None)
+        backend.ANSWER_CACHE_TTL = -1  # every entry has expired
+        ttl_ok = backend._lookup_cached_answer(key, stored) is None
+        backend.ANSWER_CACHE_TTL = saved_ttl
+
+        # Two identical streamed questions: the second waits for the first and replays its text
+        set_conversational_llm(FakeStreamingListLLM(responses=["A slowly streamed answer."], sleep=0.05))
+        before = get_metrics()["counters"].get("llm_calls_total", 0)
+        coalesced_before = get_answer_cache_stats()["coalesced"]
+        answers = [None, None]
+        def ask(index):
+            answers[index] = "".join(stream_question("What is deep learning?", vector_store))
+        threads = [threading.Thread(target=ask, args=(i,)) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        calls = get_metrics()["counters"].get("llm_calls_total", 0) - before
+        coalesced = get_answer_cache_stats()["coalesced"] - coalesced_before
+        coalescing_ok = calls == 1 and coalesced == 1 and answers[0] == answers[1]
+
+        if threshold_ok and ttl_ok and coalescing_ok:
+            print("✅ Threshold, TTL and coalescing behave as expected")
+            return True
+        else:
+            print(f"❌ threshold {threshold_ok}, TTL {ttl_ok}, coalescing {coalescing_ok} ({calls} model calls)")
+            return False
+    except Exception as e:
+        print(f"❌ Answer cache error: {e}")
+        return False
+    finally:
+        backend.ANSWER_CACHE_TTL = saved_ttl
+        set_conversational_llm(None)
+
 def main():
     """Run all tests"""
     print("🎓 StudyMate Functionality Test")
     print("=" * 50)
     
     results = []
+
+    # Test import time
+    results.append(test_import_time())
     
     # Test PDF processing
     results.append(test_pdf_processing())
+
+    # Test parallel PDF extraction
+    results.append(test_parallel_pdf_extraction())
     
     # Test text chunking
     results.append(test_text_chunking())
     
+    # Test the embedding cache across processes and after an interrupted write
+    results.append(test_embedding_cache_processes())
+    results.append(test_embedding_cache_truncated_tail())
+
     # Test vector store
     vector_store = test_vector_store()
     results.append(vector_store is not None)
+
+    # Test answer cache isolation between text-built stores
+    results.append(test_text_store_answer_cache())
+
+    # Test index cache
+    results.append(test_index_cache())
+
+    # Test memory-mapped index loading
+    results.append(test_memory_mapped_index(vector_store))
+
+    # Test compact index storage
+    results.append(test_compact_storage())
+
+    # Test scoped search on compact storage
+    results.append(test_compact_scoped_search())
+
+    # Test shared index registry
+    results.append(test_shared_index())
+
+    # Test in-memory upload ingestion
+    results.append(test_in_memory_upload())
+
+    # Test temp upload cleanup
+    results.append(test_upload_cleanup())
+
+    # Test incremental document updates
+    results.append(test_incremental_documents())
+
+    # Test hybrid search after removing a document
+    results.append(test_hybrid_after_removal())
+
+    # Test document-scoped search
+    results.append(test_scoped_search())
     
+    # Test batched search
+    results.append(test_search_batching())
+
+    # Test context packing
+    results.append(test_context_packing())
+
     # Test question processing
     results.append(test_question_processing(vector_store))
+
+    # Test metrics
+    results.append(test_metrics(vector_store))
+
+    # Test async question processing
+    results.append(test_async_question_processing(vector_store))
+
+    # Test streaming fallback
+    results.append(test_stream_fallback(vector_store))
+
+    # Test answer cache
+    results.append(test_answer_cache(vector_store))
     
     # Summary
     print("\n" + "=" * 50)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Recall/latency tuner for StudyMate's approximate search indexes
+
+Measures recall@k and query latency of IVF and HNSW indexes against exact (flat)
+search on a real, already processed corpus, then saves the fastest parameters that
+meet the target recall. Indexes built afterwards use the saved parameters.
+
+With --storage it instead compares compact vector storage (float16, int8, binary
+prefilter with re-ranking) against the float32 flat index: memory used and recall kept.
+
+Usage:
+    python tune_index.py .studymate_cache/indexes/<fingerprint> --target-recall 0.95
+    python tune_index.py .studymate_cache/indexes/<fingerprint> --storage
+"""
+
+import argparse
+import json
+import os
+import pickle
+import sys
+import time
+import numpy as np
+import faiss
+from backend import (
+    build_faiss_index,
+    embed_documents_cached,
+    get_embeddings,
+    save_index_params
+)
+
+def load_corpus_vectors(index_dir):
+    """Load the full-precision chunk vectors of a cached index"""
+    index = faiss.read_index(os.path.join(index_dir, "index.faiss"))
+    if isinstance(index, faiss.IndexFlat):
+        return index.reconstruct_n(0, index.ntotal)
+
+    # Approximate indexes may only hold compressed codes, so re-read vectors via the embedding cache
+    with open(os.path.join(index_dir, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    texts = [docstore.search(index_to_docstore_id[i]).page_content for i in range(index.ntotal)]
+    return np.asarray(embed_documents_cached(texts), dtype=np.float32)
+
+def load_queries(vectors, questions_file, num_queries, seed):
+    """Embed real questions if given, otherwise sample perturbed corpus vectors"""
+    if questions_file:
+        with open(questions_file, "r", encoding="utf-8") as f:
+            questions = [line.strip() for line in f if line.strip()]
+        return np.asarray(get_embeddings().embed_documents(questions), dtype=np.float32)
+
+    rng = np.random.default_rng(seed)
+    sample = vectors[rng.choice(len(vectors), size=min(num_queries, len(vectors)), replace=False)]
+    noise = rng.normal(scale=0.1 * float(vectors.std()), size=sample.shape).astype(np.float32)
+    return sample + noise
+
+def measure(index, queries, ground_truth, k):
+    """Return (recall@k, median single-query latency in ms)"""
+    _, found = index.search(queries, k)
+    hits = sum(len(set(row) & set(truth)) for row, truth in zip(found, ground_truth))
+    recall = hits / float(ground_truth.size)
+
+    latencies = []
+    for query in queries:
+        started = time.perf_counter()
+        index.search(query.reshape(1, -1), k)
+        latencies.append((time.perf_counter() - started) * 1000)
+    return recall, float(np.median(latencies))
+
+def candidate_results(vectors, queries, ground_truth, k, use_pq):
+    """Yield (params, recall, latency_ms) for every IVF and HNSW setting in the sweep"""
+    for nlist_factor in [1, 2, 4, 8]:
+        params = {"ann_index_type": "ivf", "nlist_factor": nlist_factor, "pq": use_pq}
+        index = build_faiss_index(vectors, "ivf", params)
+        for nprobe in [1, 2, 4, 8, 16, 32, 64, 128]:
+            if nprobe > index.nlist:
+                break
+            index.nprobe = nprobe
+            recall, latency = measure(index, queries, ground_truth, k)
+            yield dict(params, nprobe=nprobe), recall, latency
+
+    for m in [16, 32, 48]:
+        params = {"ann_index_type": "hnsw", "M": m, "pq": use_pq}
+        index = build_faiss_index(vectors, "hnsw", params)
+        for ef_search in [16, 32, 64, 128, 256]:
+            index.hnsw.efSearch = ef_search
+            recall, latency = measure(index, queries, ground_truth, k)
+            yield dict(params, efSearch=ef_search), recall, latency
+
+STORAGE_MODES = [
+    {"storage": "fp16"},
+    {"storage": "int8"},
+    {"storage": "float32", "binary_prefilter": True},
+    {"storage": "fp16", "binary_prefilter": True},
+    {"storage": "int8", "binary_prefilter": True},
+]
+
+def index_bytes(index):
+    """Serialized size of an index, which is what it holds in memory (codes plus small training data)"""
+    return int(faiss.serialize_index(index).nbytes)
+
+def storage_results(vectors, queries, ground_truth, k):
+    """Yield (params, bytes, recall, latency_ms) for every compact storage mode, as flat indexes"""
+    for params in STORAGE_MODES:
+        index = build_faiss_index(vectors, "flat", params)
+        recall, latency = measure(index, queries, ground_truth, k)
+        yield params, index_bytes(index), recall, latency
+
+def compare_storage(vectors, queries, ground_truth, k, flat, flat_latency, json_path):
+    flat_bytes = index_bytes(flat)
+    print(f"\n💾 Storage comparison against float32 flat ({flat_bytes / 1024 / 1024:.1f} MB):")
+    results = []
+    for params, size, recall, latency in storage_results(vectors, queries, ground_truth, k):
+        results.append({"params": params, "bytes": size, "memory_ratio": size / flat_bytes,
+                        "recall": recall, "latency_ms": latency})
+        name = params["storage"] + (" + binary prefilter" if params.get("binary_prefilter") else "")
+        print(f"   {name:<28} {size / 1024 / 1024:8.1f} MB ({size / flat_bytes:5.1%}) · "
+              f"recall {recall:.3f} · {latency:.3f} ms/query")
+    print("\n💡 Set STUDYMATE_INDEX_STORAGE / STUDYMATE_INDEX_BINARY_PREFILTER to use a mode for new indexes")
+
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump({"flat_bytes": flat_bytes, "flat_latency_ms": flat_latency, "results": results}, f, indent=2)
+    return bool(results)
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune approximate index parameters on a processed corpus")
+    parser.add_argument("index_dir", help="Cached index directory (contains index.faiss and index.pkl)")
+    parser.add_argument("--target-recall", type=float, default=0.95, help="Minimum recall@k to accept")
+    parser.add_argument("--k", type=int, default=10, help="Number of neighbours per query")
+    parser.add_argument("--queries", type=int, default=200, help="Sampled queries when no questions file is given")
+    parser.add_argument("--questions", help="Text file with one real student question per line")
+    parser.add_argument("--pq", action="store_true", help="Tune product-quantised variants")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--dry-run", action="store_true", help="Report results without saving parameters")
+    parser.add_argument("--storage", action="store_true",
+                        help="Compare compact storage modes (memory and recall) instead of tuning ANN parameters")
+    parser.add_argument("--json", help="Write all measurements to this JSON file")
+    args = parser.parse_args()
+
+    print("🎓 StudyMate Index Tuner")
+    print("=" * 50)
+
+    vectors = load_corpus_vectors(args.index_dir)
+    queries = load_queries(vectors, args.questions, args.queries, args.seed)
+    k = min(args.k, len(vectors))
+    print(f"📚 {len(vectors)} vectors · {len(queries)} queries · recall@{k} target {args.target_recall:.2f}")
+
+    flat = faiss.IndexFlatL2(vectors.shape[1])
+    flat.add(vectors)
+    _, ground_truth = flat.search(queries, k)
+    _, flat_latency = measure(flat, queries, ground_truth, k)
+    print(f"📏 Flat baseline: recall 1.000 · {flat_latency:.3f} ms/query")
+    if args.storage:
+        return compare_storage(vectors, queries, ground_truth, k, flat, flat_latency, args.json)
+
+    results = []
+    for params, recall, latency in candidate_results(vectors, queries, ground_truth, k, args.pq):
+        results.append({"params": params, "recall": recall, "latency_ms": latency})
+        print(f"   {json.dumps(params, sort_keys=True)}: recall {recall:.3f} · {latency:.3f} ms/query")
+
+    meeting_target = [r for r in results if r["recall"] >= args.target_recall]
+    if meeting_target:
+        best = min(meeting_target, key=lambda r: r["latency_ms"])
+        print(f"\n✅ Fastest setting meeting the target: {best['params']} "
+              f"(recall {best['recall']:.3f}, {best['latency_ms']:.3f} ms vs {flat_latency:.3f} ms flat)")
+    else:
+        best = max(results, key=lambda r: r["recall"]) if results else None
+        print("\n⚠️ No setting met the target recall; using the most accurate one")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"flat_latency_ms": flat_latency, "results": results}, f, indent=2)
+
+    if best and not args.dry_run:
+        save_index_params(best["params"])
+        print("💾 Saved parameters for future indexes")
+    return best is not None
+
+if __name__ == "__main__":
+    success = main()
+    sys.exit(0 if success else 1)